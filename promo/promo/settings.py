@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'promo_codes.metrics.MetricsMiddleware',
+    'promo_codes.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,6 +92,84 @@ DATABASES = {
     }
 }
 
+# Reads of the listing, retrieve, redeemed and stats endpoints can go to the replicas listed in PROMO_READ_REPLICAS,
+# e.g. a 'replica' database with 'TEST': {'MIRROR': 'default'}, see promo_codes.replicas.
+DATABASE_ROUTERS = ['promo_codes.replicas.ReplicaRouter']
+
+# Cache
+# The Promo Code lookups are cached in a small in-process LRU in front of this shared cache, point it to
+# memcached or redis in production.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+PROMO_CODE_CACHE = 'default'
+PROMO_CODE_CACHE_TIMEOUT = 300
+PROMO_CODE_LOCAL_CACHE_SIZE = 10000
+PROMO_CODE_LOCAL_CACHE_TIMEOUT = 5
+
+# Seconds a worker keeps a leased block of a Promo Code quota before giving back what it didn't use.
+PROMO_CODE_LEASE_TTL = 30
+
+# Seconds the responses of redeems with an Idempotency-Key stay in the cache, purge_idempotency_keys cleans the table.
+PROMO_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# Listings are cursor paginated, clients can ask for up to PROMO_MAX_PAGE_SIZE rows with ?page_size=.
+PROMO_PAGE_SIZE = 100
+PROMO_MAX_PAGE_SIZE = 1000
+
+# Substring code search keeps a trigram index of every code, turn it off to only search by prefix.
+PROMO_CODE_SUBSTRING_SEARCH = True
+# A substring search only checks the newest codes having all the trigrams of the term, at most this many.
+PROMO_SEARCH_MAX_CANDIDATES = 10000
+
+# Per view metrics are served at /metrics, workers share their counters through PROMO_METRICS_DIR (emptied on
+# restart, None to only report the worker which serves the scrape).
+PROMO_METRICS_DIR = None
+PROMO_METRICS_FLUSH_INTERVAL = 5
+
+# archive_expired_promo_codes moves the Promo Codes expired for more than these days to the archive tables.
+PROMO_ARCHIVE_AFTER_DAYS = 90
+
+# On MySQL the claims are partitioned by month, manage_claim_partitions keeps partitions ready this many months ahead.
+PROMO_CLAIM_PARTITIONS_AHEAD = 3
+
+# The async views run their database work in the threads of the executor, True queues it all on one thread instead.
+PROMO_ASYNC_THREAD_SENSITIVE = False
+
+# Aliases of the read replicas, and for how many seconds a client which wrote keeps reading from the primary.
+PROMO_READ_REPLICAS = []
+PROMO_PRIMARY_STICKINESS = 5
+
+# Every process answers the lookups of unknown codes from a Bloom filter of the codes, sized for this false positive
+# rate, and rebuilt every interval seconds.  The syncs add the codes updated since the last one minus the margin.
+# None turns it on only when PROMO_CODE_CACHE is shared between the processes, True forces it for a single process.
+PROMO_BLOOM_FILTER = None
+PROMO_BLOOM_FP_RATE = 0.01
+PROMO_BLOOM_REBUILD_INTERVAL = 3600
+PROMO_BLOOM_SYNC_MARGIN = 60
+
+# Token buckets of the code probes (retrieve, quote) and redeems per user and per client IP, in this cache.  The
+# lookups which found nothing spend from the stricter miss budget, see promo_codes.throttling.  None turns a bucket off.
+PROMO_THROTTLE_CACHE = 'default'
+PROMO_THROTTLE_RATES = {
+    'probe': {'user': '120/min', 'ip': '300/min'},
+    'redeem': {'user': '30/min', 'ip': '120/min'},
+    'miss': {'user': '10/min', 'ip': '30/min'},
+}
+
+# Seconds the pages of /promocode/redeemable stay cached, a redeem of the user drops them at once.
+PROMO_REDEEMABLE_CACHE_TIMEOUT = 60
+
+# Most items a POST /promocode/quote can hold.
+PROMO_QUOTE_MAX = 1000
+
+# purge_change_events keeps the change feed events of the last days.
+PROMO_CHANGE_RETENTION_DAYS = 7
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -123,6 +203,9 @@ MULTILINGUAL_LANGUAGES = (
     "en-us",
     "ar-ae",
 )
+# Request threads only queue the records, promo_codes.logs.BackgroundFileHandler writes them from a thread of each
+# worker, dropping them (and counting) when the queue is full.  The SQL statements of django.db.backends (DEBUG only)
+# are sampled.
 LOGGING = {
     'version': 1,
     'loggers': {
@@ -131,26 +214,37 @@ LOGGING = {
             'level': 'DEBUG'
         }
     },
+    'filters': {
+        'sample': {
+            '()': 'promo_codes.logs.SamplingFilter',
+            'rates': {'django.db.backends': 0.01},
+        }
+    },
     'handlers': {
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'promo_codes.logs.BackgroundFileHandler',
             'filename': './promo/logs/debug1.log',
             'formatter': 'simpleRe',
         },
         'file2': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'promo_codes.logs.BackgroundFileHandler',
             'filename': './promo/logs/debug2.log',
-            'formatter': 'simpleRe',
+            'filters': ['sample'],
+            'formatter': 'json',
+            'maxsize': 10000,
+            'batch_size': 500,
         }
     },
     'formatters': {
         'simpleRe': {
             'format': '{levelname} {asctime} {module} {process:d} {thread:d} {message}',
             'style': '{',
+        },
+        'json': {
+            '()': 'promo_codes.logs.JsonFormatter',
         }
-
     }
 }
 
@@ -0,0 +1 @@
+default_app_config = 'promo_codes.apps.PromoCodesConfig'
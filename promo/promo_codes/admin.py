@@ -1,7 +1,16 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import PromoCode, ClaimedPromoCode
+from .models import PromoCode, ClaimedPromoCode, PromoCodeUsage, PromoCodeLease, RedemptionRollup, IdempotencyKey, \
+    ArchivedPromoCode, ArchivedClaimedPromoCode, ChangeEvent, ChangeFeed
 
 admin.site.register(PromoCode)
 admin.site.register(ClaimedPromoCode)
+admin.site.register(PromoCodeUsage)
+admin.site.register(PromoCodeLease)
+admin.site.register(RedemptionRollup)
+admin.site.register(IdempotencyKey)
+admin.site.register(ArchivedPromoCode)
+admin.site.register(ArchivedClaimedPromoCode)
+admin.site.register(ChangeEvent)
+admin.site.register(ChangeFeed)
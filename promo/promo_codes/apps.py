@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class PromoCodesConfig(AppConfig):
     name = 'promo_codes'
+
+    def ready(self):
+        # Connect the cache invalidation, Bloom filter, search indexing, query timing, change feed and rollup signals.
+        from promo_codes import bloom, cache, changes, metrics, rollups, search  # noqa
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils.timezone import now
+
+from promo_codes import changes
+from promo_codes.models import PromoCode, ClaimedPromoCode, ArchivedPromoCode, ArchivedClaimedPromoCode
+
+# Expired Promo Codes and their claims are moved to the archive tables in batches of about batch_size rows, each in
+# its own short transaction.  A Promo Code always moves together with all of its claims, so its history is never
+# split between the two tables.  The usage counters, leases, trigrams and Idempotency-Keys of the code are dropped
+# with it, the rollups are kept.  The change feed gets one promocode.archived event per code, its claims aren't
+# deleted but archived with it.
+
+
+def _copy(model, row, **extra):
+    values = {f.attname: getattr(row, f.attname) for f in model._meta.concrete_fields
+              if hasattr(row, f.attname)}
+    values.update(extra)
+
+    return model(**values)
+
+
+def archive_codes(ids, cutoff):
+    """
+    Move the Promo Codes with these ids still expired before cutoff, and their claims.  Returns how many codes and
+    claims were moved.
+    """
+
+    archived = now()
+    with transaction.atomic():
+        # Locks the rows of the batch only, against an update of their expiry while they're moved.
+        codes = list(PromoCode.objects.select_for_update().filter(pk__in=ids, expires__lt=cutoff).order_by('id'))
+        ids = [c.id for c in codes]
+        claims = list(ClaimedPromoCode.objects.filter(promoCode_id__in=ids).order_by('id'))
+
+        ArchivedPromoCode.objects.bulk_create([_copy(ArchivedPromoCode, c, archived=archived) for c in codes])
+        ArchivedClaimedPromoCode.objects.bulk_create([_copy(ArchivedClaimedPromoCode, c) for c in claims],
+                                                     batch_size=1000)
+
+        changes.record(changes.PROMOCODE_ARCHIVED, codes)
+
+        with changes.archiving():
+            ClaimedPromoCode.objects.filter(promoCode_id__in=ids).delete()
+            PromoCode.objects.filter(pk__in=ids).delete()
+
+    return len(codes), len(claims)
+
+
+def archive_expired(days=None, batch_size=500):
+    """
+    Archive the Promo Codes expired for more than days, batch after batch.  Yields how many codes and claims each
+    batch moved.  A code with more than batch_size claims is moved alone.
+    """
+
+    if days is None:
+        days = getattr(settings, 'PROMO_ARCHIVE_AFTER_DAYS', 90)
+    cutoff = now() - timedelta(days=days)
+
+    while True:
+        candidates = list(PromoCode.objects.filter(expires__lt=cutoff).order_by('expires', 'id')
+                          .values_list('id', flat=True)[:batch_size])
+        if not candidates:
+            return
+
+        claims = dict(ClaimedPromoCode.objects.filter(promoCode_id__in=candidates).values('promoCode_id')
+                      .annotate(count=Count('id')).values_list('promoCode_id', 'count').order_by())
+
+        ids = []
+        rows = 0
+        for pk in candidates:
+            if ids and rows + claims.get(pk, 0) + 1 > batch_size:
+                break
+            ids.append(pk)
+            rows += claims.get(pk, 0) + 1
+
+        yield archive_codes(ids, cutoff)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import Http404, HttpResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException, Throttled, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from promo_codes.cache import get_by_code, get_by_pk, peek_by_code, peek_by_pk
+from promo_codes.serializers import PromoCodeSerializer
+from promo_codes.throttling import check, missed
+from promo_codes.views import list_redeemed, redeem_promocode
+
+# Async native versions of the hot endpoints, for the ASGI application.  Django 3.1 has neither an async ORM nor an
+# async cache API, so the in-process tier of the lookup cache is read right in the event loop, and whatever needs the
+# database or the shared cache runs in sync_to_async.  The answers are the same as the PromoCodeViewSet ones.
+#
+# Not thread sensitive by default: each call runs in a thread of the executor with its own connection and transaction,
+# instead of every request queuing for the one thread sensitive thread.  The executor threads outlive the requests and
+# keep their connection like a persistent one, dropped once it broke.
+
+
+def render(data, status_code=status.HTTP_200_OK, headers=None):
+    response = HttpResponse(JSONRenderer().render(data), status=status_code, content_type='application/json')
+    for name, value in (headers or {}).items():
+        response[name] = value
+
+    return response
+
+
+def method_not_allowed(method):
+    return render({'detail': 'Method "%s" not allowed.' % method}, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+def authenticate(request):
+    """
+    Wrap the request the way the viewsets see it, running the same authenticators.  Must not run in the event loop.
+    """
+
+    request = Request(request, authenticators=[a() for a in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    request.user
+
+    return request
+
+
+def thread_sensitive():
+    return getattr(settings, 'PROMO_ASYNC_THREAD_SENSITIVE', False)
+
+
+def call(handler, request, pk):
+    """
+    Authenticate and run a sync handler, turning the errors into responses like the viewsets do.
+    """
+
+    if thread_sensitive():
+        return _call(handler, request, pk)
+
+    try:
+        return _call(handler, request, pk)
+    finally:
+        for connection in connections.all():
+            if connection.connection is not None and connection.errors_occurred and not connection.is_usable():
+                connection.close()
+
+
+def _call(handler, request, pk):
+    try:
+        return handler(authenticate(request), pk)
+    except Http404:
+        return render({'detail': 'Not found.'}, status.HTTP_404_NOT_FOUND)
+    except ValidationError as exc:
+        return render(exc.detail, status.HTTP_400_BAD_REQUEST)
+    except Throttled as exc:
+        headers = {'Retry-After': '%d' % exc.wait} if exc.wait is not None else None
+        return render({'detail': exc.detail}, exc.status_code, headers)
+    except APIException as exc:
+        return render({'detail': exc.detail}, exc.status_code)
+
+
+def _lookup(pk):
+    try:
+        return get_by_pk(int(pk))
+    except ValueError:
+        return get_by_code(pk)
+
+
+def _retrieve(request, pk):
+    check(request, 'probe')
+
+    promoCode = _lookup(pk)
+    if promoCode is None:
+        missed(request)
+        raise Http404
+
+    return render(PromoCodeSerializer(promoCode).data)
+
+
+async def retrieve(request, pk):
+    """
+    Anybody can retrieve a promo code, by id or by code.
+    """
+
+    if request.method != 'GET':
+        return method_not_allowed(request.method)
+
+    try:
+        promoCode = peek_by_pk(int(pk))
+    except ValueError:
+        promoCode = peek_by_code(pk)
+
+    if promoCode is None:
+        # Only the lookups which may reach the database are throttled.
+        return await sync_to_async(call, thread_sensitive=thread_sensitive())(_retrieve, request, pk)
+
+    return render(PromoCodeSerializer(promoCode).data)
+
+
+def _redeem(request, pk):
+    check(request, 'redeem')
+    data, status_code = redeem_promocode(request, pk)
+
+    return render(data, status_code)
+
+
+async def redeem(request, pk):
+    if request.method != 'PUT':
+        return method_not_allowed(request.method)
+
+    return await sync_to_async(call, thread_sensitive=thread_sensitive())(_redeem, request, pk)
+
+
+def _redeemed(request, pk):
+    response = list_redeemed(request, pk)
+    headers = {'Link': response['Link']} if response.has_header('Link') else None
+
+    return render(response.data, headers=headers)
+
+
+async def redeemed(request, pk):
+    if request.method != 'GET':
+        return method_not_allowed(request.method)
+
+    return await sync_to_async(call, thread_sensitive=thread_sensitive())(_redeemed, request, pk)
+
+
+# The viewsets do their own CSRF checks through SessionAuthentication, and csrf_exempt would hide the coroutines.
+for view in (retrieve, redeem, redeemed):
+    view.csrf_exempt = True
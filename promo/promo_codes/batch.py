@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from collections import Counter, defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from promo_codes import changes, redeemable
+from promo_codes.generate import LOOKUP_CHUNK
+from promo_codes.models import PromoCode, ClaimedPromoCode, PromoCodeUsage
+from promo_codes.rollups import record_claims
+
+
+def _resolve(items, promoCodes, user_ids):
+    """
+    Match every item with its Promo Code and user, returning (promoCode, user_id, error) per item.
+    """
+
+    by_pk = {p.id: p for p in promoCodes}
+    by_code = {p.code_l: p for p in promoCodes}
+    current = now()
+
+    resolved = []
+    for item in items:
+        if 'promoCode' in item:
+            promoCode = by_pk.get(item['promoCode'])
+        else:
+            promoCode = by_code.get(item['code'].lower())
+
+        if promoCode is None:
+            resolved.append((None, None, "Promo Code not found."))
+        elif item['user'] not in user_ids:
+            resolved.append((None, None, "User not found."))
+        elif promoCode.expires and promoCode.expires < current:
+            resolved.append((None, None, "Promo Code has expired."))
+        elif promoCode.bound and promoCode.user_id != item['user']:
+            resolved.append((None, None, "Promo Code bound to another user."))
+        else:
+            resolved.append((promoCode, item['user'], None))
+
+    return resolved
+
+
+def _fetch_ids(claims):
+    """
+    Set the ids of claims bulk_create inserted without returning them (MySQL), for the change feed and the results.
+    The rows of this transaction are the only ones not committed, and redeemed is taken per claim, so they are found
+    by Promo Code, user and redeem time, duplicates of those in insert order.
+    """
+
+    ids = defaultdict(list)
+    promoCode_ids = sorted({c.promoCode_id for c in claims})
+    redeemed = (min(c.redeemed for c in claims), max(c.redeemed for c in claims))
+    for i in range(0, len(promoCode_ids), LOOKUP_CHUNK):
+        rows = ClaimedPromoCode.objects.filter(promoCode__in=promoCode_ids[i:i + LOOKUP_CHUNK],
+                                               redeemed__range=redeemed).order_by('id') \
+            .values_list('id', 'promoCode', 'user', 'redeemed')
+        for pk, promoCode_id, user_id, at in rows:
+            ids[(promoCode_id, user_id, at)].append(pk)
+
+    for claim in claims:
+        claim.id = ids[(claim.promoCode_id, claim.user_id, claim.redeemed)].pop(0)
+
+
+def redeem_batch(items):
+    """
+    Redeem many Promo Codes at once.  Each item is a validated ClaimedPromoCodeBatchSerializer dict, with the user set.
+
+    The Promo Codes, users, usage counters and quotas are each loaded with one query, the checks of
+    ClaimedPromoCodeSerializer.validate() run in memory and the accepted claims are written with bulk_create.
+    Returns (claims, errors) lists aligned with items, one of the two being None for each item.
+    """
+
+    pks = {i['promoCode'] for i in items if 'promoCode' in i}
+    codes = {i['code'].lower() for i in items if 'promoCode' not in i}
+    promoCodes = list(PromoCode.objects.filter(Q(pk__in=pks) | Q(code_l__in=codes)))
+
+    user_ids = set(get_user_model().objects.filter(pk__in={i['user'] for i in items}).values_list('pk', flat=True))
+
+    resolved = _resolve(items, promoCodes, user_ids)
+    pairs = {(p.id, u) for p, u, error in resolved if error is None}
+
+    claims = [None] * len(items)
+    errors = [error for p, u, error in resolved]
+
+    with transaction.atomic():
+        # Make sure every counter row exists, so they can all be locked and updated below.
+        PromoCodeUsage.objects.bulk_create([PromoCodeUsage(promoCode_id=p, user_id=u) for p, u in pairs],
+                                           ignore_conflicts=True)
+
+        usage = PromoCodeUsage.objects.select_for_update().filter(promoCode__in={p for p, u in pairs},
+                                                                  user__in={u for p, u in pairs})
+        usage = {(c.promoCode_id, c.user_id): c for c in usage if (c.promoCode_id, c.user_id) in pairs}
+
+        # The global quotas are checked against the locked rows, leased Promo Codes included.
+        quotas = PromoCode.objects.select_for_update().filter(pk__in={p for p, u in pairs}, quota__gt=0)
+        quotas = {q['id']: q for q in quotas.values('id', 'quota', 'reserved')}
+
+        totals = Counter()
+        for index, (promoCode, user_id, error) in enumerate(resolved):
+            if error is not None:
+                continue
+
+            counter = usage[(promoCode.id, user_id)]
+            quota = quotas.get(promoCode.id)
+            if (promoCode.repeat > 0 and counter.used >= promoCode.repeat) or \
+                    (quota is not None and quota['reserved'] >= quota['quota']):
+                errors[index] = "Promo Code has been used to its limit."
+                continue
+
+            counter.used += 1
+            if quota is not None:
+                quota['reserved'] += 1
+            totals[promoCode.id] += 1
+
+            data = items[index]
+            claims[index] = ClaimedPromoCode(promoCode=promoCode, user_id=user_id,
+                                             **{k: v for k, v in data.items() if k not in ('code', 'promoCode', 'user')})
+
+        accepted = ClaimedPromoCode.objects.bulk_create([c for c in claims if c is not None], batch_size=500)
+        if accepted and accepted[0].id is None:
+            _fetch_ids(accepted)
+        record_claims(accepted)
+        changes.record(changes.CLAIM_CREATED, accepted)
+        PromoCodeUsage.objects.bulk_update(usage.values(), ['used'], batch_size=500)
+        for user_id in {c.user_id for c in accepted}:
+            redeemable.changed(user_id)
+
+        by_pk = {p.id: p for p in promoCodes}
+        for pk, count in totals.items():
+            by_pk[pk].used = F('used') + count
+            by_pk[pk].reserved = F('reserved') + count
+        PromoCode.objects.bulk_update([by_pk[pk] for pk in totals], ['used', 'reserved'], batch_size=500)
+
+    return claims, errors
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from promo_codes import bloom
+from promo_codes.generate import generate_codes
+from promo_codes.models import PromoCode, ClaimedPromoCode, PromoCodeUsage
+from promo_codes.rollups import backfill
+
+# In process benchmarks of the API on a seeded dataset, see the run_benchmarks command.  Everything seeded is marked
+# with PREFIX so it can be told apart, and the random choices are seeded so two runs send the same requests.
+
+PREFIX = 'BENCH'
+USERS = 100
+SIZES = {'10k': 10 ** 4, '1m': 10 ** 6, '10m': 10 ** 7}
+
+# Operations sent from concurrent threads, to measure the contention on the rows they share.
+CONCURRENT = ('redeem_high_contention',)
+
+
+def summary(latencies, elapsed, queries=None):
+    latencies = sorted(latencies)
+    result = {
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+    }
+    if queries is not None:
+        result['queries_per_request'] = round(float(queries) / len(latencies), 2)
+
+    return result
+
+
+def code(i):
+    return '%s%09d' % (PREFIX, i)
+
+
+def seed(size, chunk_size=1000, progress=None):
+    """
+    Make sure the dataset holds size benchmark Promo Codes, every other one claimed once, with consistent usage
+    counters and rollups.  Every 10th code is bound to one of the benchmark users, every 5th one is a percent one.
+    """
+
+    User = get_user_model()
+    User.objects.bulk_create([User(username='%s-user-%d' % (PREFIX, i)) for i in range(USERS)],
+                             ignore_conflicts=True)
+    users = list(User.objects.filter(username__startswith='%s-user-' % PREFIX).order_by('id')
+                 .values_list('id', flat=True))
+
+    # Resume after the highest code(i) seeded, the other benchmark codes (BENCH-<run>-<i>) don't count.
+    last = PromoCode.objects.filter(code_l__range=(code(0).lower(), code(10 ** 9 - 1).lower())) \
+        .order_by('-code_l').values_list('code_l', flat=True).first()
+    start = 0 if last is None else int(last[len(PREFIX):]) + 1
+    for first in range(start, size, chunk_size):
+        numbers = range(first, min(first + chunk_size, size))
+        with transaction.atomic():
+            PromoCode.objects.bulk_create([
+                PromoCode(code=code(i), code_l=code(i).lower(), type='percent' if i % 5 == 4 else 'value',
+                          value=Decimal(i % 50) / 100 if i % 5 == 4 else i % 50,
+                          bound=i % 10 == 0, user_id=users[i % USERS] if i % 10 == 0 else None,
+                          used=1 - i % 2, reserved=1 - i % 2)
+                for i in numbers])
+
+            ids = dict(PromoCode.objects.filter(code_l__in=[code(i).lower() for i in numbers if i % 2 == 0])
+                       .values_list('code_l', 'id'))
+            claims = [(ids[code(i).lower()], users[i % USERS]) for i in numbers if i % 2 == 0]
+            ClaimedPromoCode.objects.bulk_create([ClaimedPromoCode(promoCode_id=p, user_id=u) for p, u in claims])
+            PromoCodeUsage.objects.bulk_create([PromoCodeUsage(promoCode_id=p, user_id=u, used=1) for p, u in claims])
+            bloom.changed()
+
+        if progress:
+            progress(numbers[-1] + 1)
+
+    if start < size:
+        backfill()
+
+    return users
+
+
+def generation(count, chunk_size=10000):
+    """
+    Time generate_codes creating count codes with their search index and change events, the goal being a million
+    in under a minute.
+    """
+
+    queries = [0]
+
+    def counted(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    with connection.execute_wrapper(counted):
+        for _ in generate_codes(count, prefix='%s-GEN-' % PREFIX, length=8, chunk_size=chunk_size, type='value'):
+            pass
+    elapsed = time.perf_counter() - start
+
+    return {
+        'codes': count,
+        'seconds': round(elapsed, 3),
+        'codes_per_second': round(count / elapsed, 1),
+        'queries_per_1000_codes': round(queries[0] * 1000.0 / count, 2),
+        'seconds_per_million': round(elapsed * 10 ** 6 / count, 1),
+        'million_per_minute': elapsed * 10 ** 6 / count <= 60,
+    }
+
+
+class Benchmark(object):
+
+    def __init__(self, size, requests=1000, seed_value=0, concurrency=8):
+        self.size = size
+        self.requests = requests
+        self.concurrency = concurrency
+        self.random = random.Random(seed_value)
+        self.clients = {}
+        self.run_id = int(time.time())
+
+        User = get_user_model()
+        self.admin = User.objects.filter(username='%s-admin' % PREFIX).first() or \
+            User.objects.create_superuser('%s-admin' % PREFIX, None, None)
+        self.users = list(User.objects.filter(username__startswith='%s-user-' % PREFIX).order_by('id'))
+
+    def pick(self, count):
+        """
+        Random unbound codes without claims (the odd ones), as (code, id) pairs.
+        """
+
+        numbers = [self.random.randrange(1, self.size, 2) for i in range(count)]
+        ids = {}
+        for i in range(0, count, 900):
+            chunk = [code(n).lower() for n in numbers[i:i + 900]]
+            ids.update(PromoCode.objects.filter(code_l__in=chunk).values_list('code_l', 'id'))
+
+        return [(code(n), ids[code(n).lower()]) for n in numbers]
+
+    def client(self, user, clients=None):
+        """
+        One client per user: re-authenticating a shared one adds session queries to every request.
+        """
+
+        clients = self.clients if clients is None else clients
+        if user not in clients:
+            clients[user] = APIClient()
+            if user is not None:
+                clients[user].force_authenticate(user)
+
+        return clients[user]
+
+    def measure(self, requests):
+        """
+        Send the (user, method, path, data) requests one after the other.
+        """
+
+        latencies = []
+        queries = [0]
+
+        # Counts through a wrapper: the debug query log is capped at 9000 entries.
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            start = time.perf_counter()
+            for user, method, path, data in requests:
+                client = self.client(user)
+                begin = time.perf_counter()
+                response = getattr(client, method)(path, data, format='json')
+                latencies.append(time.perf_counter() - begin)
+                if response.status_code >= 400:
+                    raise AssertionError("%s %s answered %s" % (method, path, response.status_code))
+            elapsed = time.perf_counter() - start
+
+        return summary(latencies, elapsed, queries[0])
+
+    def measure_concurrent(self, requests):
+        """
+        Send the (user, method, path, data) requests from concurrency threads started together, each with its own
+        clients and database connection, so they contend for the rows like concurrent workers.
+        """
+
+        latencies = []
+        queries = [0]
+        errors = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(self.concurrency + 1)
+
+        def worker(share):
+            clients = {}
+            own = []
+            count = [0]
+
+            def counted(execute, sql, params, many, context):
+                count[0] += 1
+                return execute(sql, params, many, context)
+
+            try:
+                with connection.execute_wrapper(counted):
+                    barrier.wait()
+                    for user, method, path, data in share:
+                        begin = time.perf_counter()
+                        response = getattr(self.client(user, clients), method)(path, data, format='json')
+                        own.append(time.perf_counter() - begin)
+                        if response.status_code >= 400:
+                            errors.append("%s %s answered %s" % (method, path, response.status_code))
+                            break
+            finally:
+                connection.close()
+                with lock:
+                    latencies.extend(own)
+                    queries[0] += count[0]
+
+        threads = [threading.Thread(target=worker, args=(requests[i::self.concurrency],))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            raise AssertionError(errors[0])
+
+        return summary(latencies, elapsed, queries[0])
+
+    def operations(self):
+        n = self.requests
+        admin = self.admin
+        hot = self.pick(1)[0][1]
+
+        return {
+            'create': [(admin, 'post', '/promocode', {'code': '%s-%d-%d' % (PREFIX, self.run_id, i), 'type': 'value'})
+                       for i in range(n)],
+            'retrieve_pk': [(None, 'get', '/promocode/%d' % pk, None) for c, pk in self.pick(n)],
+            'retrieve_code': [(None, 'get', '/promocode/%s' % c, None) for c, pk in self.pick(n)],
+            'redeem_low_contention': [(self.random.choice(self.users), 'put', '/promocode/%d/redeem' % pk, None)
+                                      for c, pk in self.pick(n)],
+            'redeem_high_contention': [(self.random.choice(self.users), 'put', '/promocode/%d/redeem' % hot, None)
+                                       for i in range(n)],
+            'redeemed_list': [(admin, 'get', '/promocode/%d/redeemed' % hot, None) for i in range(n)],
+            'filtered_list': [(admin, 'get', '/promocode?min_value=10&max_value=12', None) for i in range(n)],
+            'best_code': [(self.random.choice(self.users), 'get',
+                           '/promocode/best?total_price=%d' % self.random.randrange(1, 100), None) for i in range(n)],
+        }
+
+    def run(self, only=None):
+        results = {}
+        # Every request comes from the same client, which the throttling would refuse long before the end.
+        with override_settings(PROMO_THROTTLE_RATES={}):
+            for name, requests in self.operations().items():
+                if only and name not in only:
+                    continue
+                if name in CONCURRENT and self.concurrency > 1:
+                    results[name] = self.measure_concurrent(requests)
+                else:
+                    results[name] = self.measure(requests)
+
+        return results
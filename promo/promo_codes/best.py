@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from promo_codes.models import PromoCode, PromoCodeUsage, PROMO_TYPES
+from promo_codes.quotes import check, discount
+
+# The best Promo Code a user can redeem on an amount.  The discount of a Promo Code only grows with its value, within
+# its type, so the best one of a type is the first redeemable one in the value order.  Per type, the unbound Promo
+# Codes are scanned down the (type, value) index and the ones of the user down the (user, type, value) one, a chunk at
+# a time, and the winners are compared on the amount.
+
+
+def _available(queryset):
+    """
+    Leave out the expired Promo Codes and the ones whose quota is used up, in the database.
+    """
+
+    return queryset.filter(Q(expires__isnull=True) | Q(expires__gt=now())) \
+        .filter(Q(quota=0) | Q(reserved__lt=F('quota')) | Q(lease_size__gt=0))
+
+
+def _usage(user, promoCodes):
+    """
+    How many times the user redeemed each of the Promo Codes with a repeat limit, with one query.
+    """
+
+    limited = [p.id for p in promoCodes if p.repeat > 0]
+    if not limited or not user.is_authenticated:
+        return {}
+
+    return dict(PromoCodeUsage.objects.filter(user=user.id, promoCode__in=limited).values_list('promoCode', 'used'))
+
+
+def _first_redeemable(user, queryset, chunk_size):
+    """
+    The Promo Code with the highest value of the queryset the user can redeem, None if there is none.
+    """
+
+    queryset = _available(queryset).order_by('-value', '-id')
+
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(Q(value__lt=last.value) | Q(value=last.value, id__lt=last.id))
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return None
+
+        used = _usage(user, chunk)
+        current = now()
+        for promoCode in chunk:
+            if check(promoCode, user, used.get(promoCode.id, 0), current) is None:
+                return promoCode
+        last = chunk[-1]
+
+
+def best_code(user, amount, chunk_size=100):
+    """
+    The Promo Code giving the user the biggest discount on amount, None if they can't redeem any.  On a tie the one
+    with the higher value wins, then the newer one.
+    """
+
+    querysets = []
+    for type, name in PROMO_TYPES:
+        # bound=False can't use an index (it's NOT bound in SQL), the bound Promo Codes are skipped by the scan.
+        querysets.append(PromoCode.objects.filter(bound=False, type=type))
+        if user.is_authenticated:
+            querysets.append(PromoCode.objects.filter(user=user.id, type=type))
+
+    candidates = [p for p in (_first_redeemable(user, qs, chunk_size) for qs in querysets) if p is not None]
+    if not candidates:
+        return None
+
+    return max(candidates, key=lambda p: (discount(p, amount), p.value, p.id))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from promo_codes.models import PromoCode
+
+# Every process keeps a Bloom filter of the code_l values, so a lookup of a code which doesn't exist can be answered
+# without the database.  A Bloom filter has no false negatives as long as every code is in it: codes saved in this
+# process are added at once, and every change bumps a version in the shared cache (before and after the commit), on
+# which the other processes add the codes updated since their last look before answering a miss.  Deleted codes stay
+# in the filter, they only cost a query, until it's rebuilt every PROMO_BLOOM_REBUILD_INTERVAL seconds.
+
+VERSION_KEY = 'promocode:bloom:version'
+
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+
+def _shared():
+    return caches[getattr(settings, 'PROMO_CODE_CACHE', 'default')]
+
+
+class BloomFilter(object):
+    """
+    Bits sized for capacity values at the fp_rate false positive rate, with double hashing of a blake2b digest.
+    """
+
+    def __init__(self, capacity, fp_rate):
+        capacity = max(int(capacity), 1)
+        self.size = max(int(-capacity * math.log(fp_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def fp_rate(self):
+        """
+        Expected false positive rate with what was added so far.
+        """
+
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+def _version():
+    version = _shared().get(VERSION_KEY)
+    if version is None:
+        # Never set, or evicted: the syncs start over from this one.
+        _shared().add(VERSION_KEY, 0, None)
+        version = _shared().get(VERSION_KEY)
+
+    return version
+
+
+def _bump():
+    try:
+        _shared().incr(VERSION_KEY)
+    except ValueError:
+        _shared().add(VERSION_KEY, 1, None)
+
+
+def changed():
+    """
+    Tell the other processes Promo Codes were saved, for the writes which send no post_save (bulk_create).
+    """
+
+    _bump()
+    transaction.on_commit(_bump)
+
+
+class CodeFilter(object):
+    """
+    The Bloom filter of the codes of this process, and what keeps it in step with the table.
+    """
+
+    def __init__(self):
+        self.bloom = None
+        self.version = None
+        self.mark = None
+        self.built = None
+        self.building = False
+        self.lock = threading.Lock()
+        self.stats = {'rejected': 0, 'passed': 0, 'false_positives': 0, 'syncs': 0}
+
+    def enabled(self):
+        enabled = getattr(settings, 'PROMO_BLOOM_FILTER', None)
+        if enabled is None:
+            # The other processes only hear of the codes saved here through the shared cache, with a process-local
+            # one they would answer false misses until their next rebuild.
+            return not isinstance(_shared(), PROCESS_LOCAL_CACHES)
+
+        return enabled
+
+    def build(self, chunk_size=10000):
+        """
+        Scan every code_l, by id a chunk at a time, into a new filter and swap it in.
+        """
+
+        version = _version()
+        started = now()
+        codes = PromoCode.objects.using(DEFAULT_DB_ALIAS).order_by('id').values_list('id', 'code_l')
+
+        bloom = BloomFilter(max(codes.count(), 1000) * 1.25, getattr(settings, 'PROMO_BLOOM_FP_RATE', 0.01))
+        last = 0
+        while True:
+            rows = list(codes.filter(id__gt=last)[:chunk_size])
+            if not rows:
+                break
+            for id, code_l in rows:
+                bloom.add(code_l)
+            last = rows[-1][0]
+
+        with self.lock:
+            self.bloom, self.version, self.mark, self.built = bloom, version, started, time.monotonic()
+
+    def _build_in_background(self):
+        try:
+            self.build()
+        finally:
+            self.building = False
+            connections[DEFAULT_DB_ALIAS].close()
+
+    def _refresh(self):
+        """
+        Start a build when there is no filter or it's due, in the background so no request waits for the scan.
+        """
+
+        due = self.built is None or \
+            time.monotonic() - self.built > getattr(settings, 'PROMO_BLOOM_REBUILD_INTERVAL', 3600)
+        if due and not self.building:
+            with self.lock:
+                if self.building:
+                    return
+                self.building = True
+            threading.Thread(target=self._build_in_background, name='bloom-build', daemon=True).start()
+
+    def sync(self):
+        """
+        Add the codes updated since the last build or sync.  The margin covers the transactions which committed after
+        the time of their rows.
+        """
+
+        version = _version()
+        started = now()
+        since = self.mark - timedelta(seconds=getattr(settings, 'PROMO_BLOOM_SYNC_MARGIN', 60))
+        for code_l in PromoCode.objects.using(DEFAULT_DB_ALIAS).filter(updated__gte=since) \
+                .values_list('code_l', flat=True).iterator():
+            self.bloom.add(code_l)
+
+        self.version, self.mark = version, started
+        self.stats['syncs'] += 1
+
+    def add(self, code_l):
+        if self.bloom is not None:
+            self.bloom.add(code_l)
+
+    def might_contain(self, code_l):
+        """
+        False when the code certainly doesn't exist, True when it may.
+        """
+
+        if not self.enabled():
+            return True
+
+        self._refresh()
+        if self.bloom is None:
+            return True
+
+        if code_l not in self.bloom and _shared().get(VERSION_KEY) != self.version:
+            with self.lock:
+                self.sync()
+
+        if code_l in self.bloom:
+            self.stats['passed'] += 1
+            return True
+
+        self.stats['rejected'] += 1
+        return False
+
+    def false_positive(self):
+        self.stats['false_positives'] += 1
+
+    def report(self):
+        bloom = self.bloom
+        report = dict(self.stats, enabled=self.enabled(), ready=bloom is not None)
+        if bloom is not None:
+            report.update({
+                'codes': bloom.count,
+                'bits': bloom.size,
+                'hashes': bloom.hashes,
+                'memory_bytes': len(bloom.bits),
+                'expected_fp_rate': bloom.fp_rate(),
+                'observed_fp_rate': float(self.stats['false_positives']) / self.stats['passed']
+                if self.stats['passed'] else 0.0,
+            })
+
+        return report
+
+
+code_filter = CodeFilter()
+
+
+@receiver(post_save, sender=PromoCode)
+def add_code(sender, instance, **kwargs):
+    code_filter.add(instance.code_l)
+    changed()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from promo_codes import bloom, metrics
+from promo_codes.models import PromoCode
+
+
+class LocalLRU(object):
+    """
+    Bounded in-process LRU, every entry carries its own deadline.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, deadline = entry
+            if deadline <= time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local = LocalLRU(getattr(settings, 'PROMO_CODE_LOCAL_CACHE_SIZE', 10000))
+
+stats = {
+    'local_hits': 0,
+    'shared_hits': 0,
+    'misses': 0,
+}
+
+
+def shared():
+    return caches[getattr(settings, 'PROMO_CODE_CACHE', 'default')]
+
+
+def _key(field, value):
+    # Codes can hold spaces and non ascii characters, which memcached doesn't accept in keys.
+    return 'promocode:%s:%s' % (field, hashlib.md5(str(value).encode('utf-8')).hexdigest())
+
+
+def _timeout(promoCode, timeout):
+    """
+    Never keep an entry past the expiry of the Promo Code.
+    """
+
+    if promoCode.expires is not None:
+        timeout = min(timeout, (promoCode.expires - now()).total_seconds())
+
+    return timeout
+
+
+def _store(promoCode):
+    local_timeout = _timeout(promoCode, getattr(settings, 'PROMO_CODE_LOCAL_CACHE_TIMEOUT', 5))
+    shared_timeout = _timeout(promoCode, getattr(settings, 'PROMO_CODE_CACHE_TIMEOUT', 300))
+    if shared_timeout <= 0:
+        return
+
+    keys = (_key('pk', promoCode.pk), _key('code_l', promoCode.code_l))
+    shared().set_many({k: promoCode for k in keys}, int(shared_timeout) or 1)
+    for k in keys:
+        local.set(k, promoCode, local_timeout)
+
+
+def _peek(key):
+    promoCode = local.get(key)
+    if promoCode is not None:
+        stats['local_hits'] += 1
+        metrics.cache_hit()
+        return copy.copy(promoCode)
+
+    return None
+
+
+def _lookup(field, value):
+    key = _key(field, value)
+
+    promoCode = _peek(key)
+    if promoCode is not None:
+        return promoCode
+
+    promoCode = shared().get(key)
+    if promoCode is not None:
+        stats['shared_hits'] += 1
+        metrics.cache_hit()
+        local.set(key, promoCode, _timeout(promoCode, getattr(settings, 'PROMO_CODE_LOCAL_CACHE_TIMEOUT', 5)))
+        return copy.copy(promoCode)
+
+    stats['misses'] += 1
+    metrics.cache_miss()
+    # Always filled from the primary, a lagging replica could bring back a row the invalidation just dropped.
+    promoCode = PromoCode.objects.using(DEFAULT_DB_ALIAS).filter(**{field: value}).first()
+    if promoCode is not None:
+        _store(promoCode)
+
+    return promoCode
+
+
+def get_by_pk(pk):
+    """
+    Return the Promo Code with this id, or None.
+    """
+
+    return _lookup('pk', int(pk))
+
+
+def get_by_code(code):
+    """
+    Return the Promo Code with this code (case insensitive), or None.  The codes the Bloom filter doesn't know are
+    answered without a lookup.
+    """
+
+    code_l = code.lower()
+    if not bloom.code_filter.might_contain(code_l):
+        return None
+
+    promoCode = _lookup('code_l', code_l)
+    if promoCode is None:
+        bloom.code_filter.false_positive()
+
+    return promoCode
+
+
+def get_many(pks=(), codes=()):
+    """
+    Return the Promo Codes with these ids and codes (case insensitive), as a dict by id and a dict by code_l.  Both
+    tiers are read with one call each, and whatever they miss is loaded with one query.
+    """
+
+    keys = {_key('pk', int(pk)): ('pk', int(pk)) for pk in pks}
+    for code in codes:
+        if bloom.code_filter.might_contain(code.lower()):
+            keys[_key('code_l', code.lower())] = ('code_l', code.lower())
+
+    found = {}
+    for key in keys:
+        promoCode = _peek(key)
+        if promoCode is not None:
+            found[key] = promoCode
+
+    missing = [key for key in keys if key not in found]
+    for key, promoCode in shared().get_many(missing).items():
+        stats['shared_hits'] += 1
+        metrics.cache_hit()
+        local.set(key, promoCode, _timeout(promoCode, getattr(settings, 'PROMO_CODE_LOCAL_CACHE_TIMEOUT', 5)))
+        found[key] = copy.copy(promoCode)
+
+    missing = [key for key in missing if key not in found]
+    if missing:
+        for key in missing:
+            stats['misses'] += 1
+            metrics.cache_miss()
+
+        pks = [keys[key][1] for key in missing if keys[key][0] == 'pk']
+        codes_l = [keys[key][1] for key in missing if keys[key][0] == 'code_l']
+        for promoCode in PromoCode.objects.using(DEFAULT_DB_ALIAS).filter(Q(pk__in=pks) | Q(code_l__in=codes_l)):
+            _store(promoCode)
+            found[_key('pk', promoCode.pk)] = found[_key('code_l', promoCode.code_l)] = promoCode
+
+    by_pk = {}
+    by_code = {}
+    for key, (field, value) in keys.items():
+        if key in found:
+            (by_pk if field == 'pk' else by_code)[value] = found[key]
+        elif field == 'code_l':
+            bloom.code_filter.false_positive()
+
+    return by_pk, by_code
+
+
+def peek_by_pk(pk):
+    """
+    Like get_by_pk, but only looks in the in-process tier, so it never does I/O and can run in the event loop.
+    """
+
+    return _peek(_key('pk', int(pk)))
+
+
+def peek_by_code(code):
+    """
+    Like get_by_code, but only looks in the in-process tier.
+    """
+
+    return _peek(_key('code_l', code.lower()))
+
+
+def invalidate(pk, *codes_l):
+    keys = [_key('pk', pk)] + [_key('code_l', c) for c in codes_l if c]
+    for k in keys:
+        local.delete(k)
+    shared().delete_many(keys)
+
+
+def cache_stats():
+    lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+    hits = stats['local_hits'] + stats['shared_hits']
+
+    return dict(stats, hit_ratio=float(hits) / lookups if lookups else 0.0, bloom=bloom.code_filter.report())
+
+
+@receiver(pre_save, sender=PromoCode)
+def remember_code(sender, instance, **kwargs):
+    """
+    The code can be changed by an update, so keep the old one around to drop its entry.
+    """
+
+    if instance.pk is not None:
+        instance._cached_code_l = PromoCode.objects.filter(pk=instance.pk).values_list('code_l', flat=True).first()
+
+
+@receiver(post_save, sender=PromoCode)
+@receiver(post_delete, sender=PromoCode)
+def invalidate_promocode(sender, instance, **kwargs):
+    pk = instance.pk
+    codes_l = (instance.code_l, getattr(instance, '_cached_code_l', None))
+    invalidate(pk, *codes_l)
+
+    # A concurrent read could cache the old row again before the transaction commits.
+    transaction.on_commit(lambda: invalidate(pk, *codes_l))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from promo_codes.models import ChangeEvent, ChangeFeed, PromoCode
+
+# The change feed: every insert and delete of a claim and every create, update, delete or archive of a Promo Code
+# appends a ChangeEvent in the transaction making the change, so an event is there if and only if its change
+# committed.
+#
+# Ids are taken at insert, so a transaction still open can commit an event with a lower id than one already served,
+# and the feed can't be read by id.  Events are served by position instead, which publish() gives to the committed
+# events without one, holding the lock of the ChangeFeed row: an event committing late gets a position after the ones
+# already given, whatever its id.  Consumers read the events after the position of the last one they saw, a range scan
+# of its unique index, and mustn't expect the positions to be contiguous.
+
+CLAIM_CREATED = 'claim.created'
+CLAIM_DELETED = 'claim.deleted'
+PROMOCODE_CREATED = 'promocode.created'
+PROMOCODE_UPDATED = 'promocode.updated'
+PROMOCODE_DELETED = 'promocode.deleted'
+PROMOCODE_ARCHIVED = 'promocode.archived'
+
+# Set while the archive deletes the rows it moved, which are archived and not deleted.
+_archiving = ContextVar('archiving', default=False)
+
+
+def _data(row):
+    # The foreign keys as their ids, under the names the API uses.
+    return {f.name: f.value_from_object(row) for f in row._meta.concrete_fields}
+
+
+def record(kind, rows):
+    """
+    Append an event of kind for each row, model instances read before a delete.  Must be called inside the
+    transaction writing the rows.
+    """
+
+    ChangeEvent.objects.bulk_create([ChangeEvent(kind=kind, object_id=row.pk, data=_data(row)) for row in rows],
+                                    batch_size=1000)
+
+
+@contextmanager
+def archiving():
+    """
+    The rows deleted inside are archived: the delete receivers leave the rollups and the change feed alone.
+    """
+
+    token = _archiving.set(True)
+    try:
+        yield
+    finally:
+        _archiving.reset(token)
+
+
+def is_archiving():
+    return _archiving.get()
+
+
+@receiver(pre_delete, sender=PromoCode)
+def record_promocode_deleted(sender, instance, **kwargs):
+    """
+    Sent for each deleted Promo Code, whatever deletes it, inside the transaction of the delete and after its claims.
+    """
+
+    if not is_archiving():
+        record(PROMOCODE_DELETED, [instance])
+
+
+def _lock_feed():
+    feed = ChangeFeed.objects.select_for_update().filter(pk=1).first()
+    if feed is None:
+        try:
+            with transaction.atomic():
+                ChangeFeed.objects.create(pk=1)
+        except IntegrityError:
+            # Created concurrently.
+            pass
+        feed = ChangeFeed.objects.select_for_update().get(pk=1)
+
+    return feed
+
+
+def publish(limit=10000):
+    """
+    Give positions to the committed events without one, up to about limit of them in id order.  The positions only
+    have to be unique and after the ones already given, so they are the ids shifted past the last one, set with one
+    UPDATE.  Returns how many events were published.
+    """
+
+    with transaction.atomic():
+        feed = _lock_feed()
+
+        # Read after the lock, so the events published by the previous holder are seen with their positions.
+        ids = list(ChangeEvent.objects.filter(position__isnull=True).order_by('id')
+                   .values_list('id', flat=True)[:limit])
+        if not ids:
+            return 0
+
+        offset = feed.position - ids[0] + 1
+        published = ChangeEvent.objects.filter(position__isnull=True, id__gte=ids[0], id__lte=ids[-1]) \
+            .update(position=F('id') + offset)
+        feed.position = ids[-1] + offset
+        feed.save(update_fields=['position'])
+
+    return published
+
+
+def published():
+    """
+    The events the feed can serve, the ones with a position.
+    """
+
+    return ChangeEvent.objects.filter(position__isnull=False)
+
+
+def purge(days=None):
+    """
+    Drop the events older than days, returns how many.
+    """
+
+    if days is None:
+        days = getattr(settings, 'PROMO_CHANGE_RETENTION_DAYS', 7)
+
+    return ChangeEvent.objects.filter(created__lt=now() - timedelta(days=days)).delete()[0]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+EXPORT_FIELDS = ('id', 'redeemed', 'promoCode', 'user', 'company', 'typeOfPayment', 'total_price', 'item', 'service')
+
+
+class Echo(object):
+    """
+    File-like object handing back what csv.writer writes, so rows can be streamed.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_rows(queryset, chunk_size=None):
+    """
+    Walk the queryset by (redeemed, id) a chunk at a time.  Every chunk is its own indexed range query, so memory stays
+    flat even where the database driver buffers whole result sets (MySQL).
+    """
+
+    chunk_size = chunk_size or getattr(settings, 'PROMO_EXPORT_CHUNK_SIZE', 2000)
+    queryset = queryset.order_by('redeemed', 'id').values_list(*EXPORT_FIELDS)
+    after = Q()
+
+    while True:
+        rows = list(queryset.filter(after)[:chunk_size])
+        if not rows:
+            return
+
+        yield rows
+        id, redeemed = rows[-1][:2]
+        after = Q(redeemed__gt=redeemed) | Q(redeemed=redeemed, id__gt=id)
+
+
+def export_csv(queryset, chunk_size=None):
+    writer = csv.writer(Echo())
+    encoder = DjangoJSONEncoder()
+
+    yield writer.writerow(EXPORT_FIELDS)
+    for rows in iter_rows(queryset, chunk_size):
+        yield ''.join(writer.writerow([encoder.default(v) if hasattr(v, 'isoformat') else v for v in row])
+                      for row in rows)
+
+
+def export_ndjson(queryset, chunk_size=None):
+    for rows in iter_rows(queryset, chunk_size):
+        yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row)), cls=DjangoJSONEncoder) + '\n' for row in rows)
+
+
+EXPORTS = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
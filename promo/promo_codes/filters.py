@@ -2,6 +2,9 @@
 
 from django_filters import FilterSet, NumberFilter
 from django.apps import apps
+from rest_framework.filters import BaseFilterBackend
+
+from promo_codes.search import prefix_search, substring_search
 
 
 class PromoCodeFilter(FilterSet):
@@ -10,9 +13,29 @@ class PromoCodeFilter(FilterSet):
     on the discount value, then it is more helpful to do this.
     """
 
-    min_value = NumberFilter(name='value', lookup_expr='gte')
-    max_value = NumberFilter(name='value', lookup_expr='lte')
+    min_value = NumberFilter(field_name='value', lookup_expr='gte')
+    max_value = NumberFilter(field_name='value', lookup_expr='lte')
 
     class Meta:
         model = apps.get_model('promo_codes.PromoCode')
         fields = ['user', 'bound', 'type', 'min_value', 'max_value']
+
+
+class PromoCodeSearchFilter(BaseFilterBackend):
+    """
+    Search codes with ?search=, by prefix on the code_l index or with ?search_mode=substring through the trigram index,
+    instead of SearchFilter's icontains on both code columns which always scans the table.
+    """
+
+    search_param = 'search'
+    mode_param = 'search_mode'
+
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '').strip()
+        if not term:
+            return queryset
+
+        if request.query_params.get(self.mode_param) == 'substring':
+            return substring_search(queryset, term)
+
+        return prefix_search(queryset, term)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.db import IntegrityError, transaction
+
+from promo_codes import bloom, changes
+from promo_codes.models import PromoCode
+from promo_codes.search import index_codes
+
+DEFAULT_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+
+# How many code_l values are checked for collisions per query, kept under SQLite's variable limit.
+LOOKUP_CHUNK = 900
+
+# How many times in a row a chunk is drawn again after an IntegrityError before giving up.
+MAX_RETRIES = 5
+
+
+def _random_codes(count, length, alphabet):
+    """
+    Draw count random strings of the given length.  Bytes above the largest multiple of len(alphabet) are dropped so
+    every character stays equally likely.
+    """
+
+    size = len(alphabet)
+    limit = 256 - 256 % size
+    chars = []
+    needed = count * length
+
+    while len(chars) < needed:
+        chars.extend(alphabet[b % size] for b in os.urandom(needed - len(chars) + 64) if b < limit)
+
+    joined = ''.join(chars[:needed])
+
+    return [joined[i:i + length] for i in range(0, needed, length)]
+
+
+def _existing(codes_l):
+    """
+    Return which of the lower case codes are taken already.
+    """
+
+    existing = set()
+    for i in range(0, len(codes_l), LOOKUP_CHUNK):
+        existing.update(PromoCode.objects.filter(code_l__in=codes_l[i:i + LOOKUP_CHUNK])
+                        .values_list('code_l', flat=True))
+
+    return existing
+
+
+def generate_codes(count, prefix='', length=8, alphabet=DEFAULT_ALPHABET, chunk_size=10000, **attributes):
+    """
+    Create count new Promo Codes sharing the given attributes (type, value, expires, repeat, ...).
+
+    Codes are generated in memory a chunk at a time, deduplicated against the existing code_l values and inserted with
+    bulk_create.  This is a generator yielding how many codes were created so far after every chunk.  A chunk still
+    failing with an IntegrityError after MAX_RETRIES draws raises it.
+    """
+
+    if len(prefix) + length > PromoCode._meta.get_field('code').max_length:
+        raise ValueError("Prefix and length exceed the maximum code length.")
+
+    if len(set(alphabet.lower())) ** length < count * 10:
+        raise ValueError("Alphabet and length are too small for the requested number of codes.")
+
+    if (prefix + alphabet).isdigit():
+        raise ValueError("Prefix and alphabet can only make codes of digits.")
+
+    created = 0
+    retries = 0
+    while created < count:
+        size = min(chunk_size, count - created)
+
+        candidates = {}
+        while len(candidates) < size:
+            for code in _random_codes(size - len(candidates), length, alphabet):
+                code = prefix + code
+                # The lookups take a code of digits only for an id, it could never be found by code.
+                if not code.isdigit():
+                    candidates.setdefault(code.lower(), code)
+
+        for code_l in _existing(list(candidates)):
+            del candidates[code_l]
+
+        try:
+            with transaction.atomic():
+                PromoCode.objects.bulk_create(
+                    [PromoCode(code=code, code_l=code_l, **attributes) for code_l, code in candidates.items()],
+                    batch_size=1000)
+
+                # bulk_create sends no post_save, and doesn't return the ids on MySQL.
+                codes_l = list(candidates)
+                promoCodes = []
+                for i in range(0, len(codes_l), LOOKUP_CHUNK):
+                    promoCodes.extend(PromoCode.objects.filter(code_l__in=codes_l[i:i + LOOKUP_CHUNK]))
+                promoCodes.sort(key=lambda p: p.id)
+                index_codes(promoCodes, new=True)
+                changes.record(changes.PROMOCODE_CREATED, promoCodes)
+                bloom.changed()
+        except IntegrityError:
+            # Most likely a code inserted concurrently between the check and the insert, draw this chunk again.
+            retries += 1
+            if retries > MAX_RETRIES:
+                raise
+            continue
+
+        retries = 0
+        created += len(candidates)
+        yield created
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import Http404
+from django.utils.timezone import now
+from rest_framework import status
+
+from promo_codes.cache import shared
+from promo_codes.models import IdempotencyKey
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+# Seconds a request running with a key keeps the others with it out, in case it dies without letting go.
+IN_FLIGHT_TIMEOUT = 60
+
+
+class _KeyTaken(Exception):
+    """
+    Another request stored a response for the key first.
+    """
+
+
+def _key(user_id, key):
+    return 'idempotency:%s:%s' % (user_id, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def _in_flight_key(user_id, key):
+    return _key(user_id, key) + ':in-flight'
+
+
+def _timeout():
+    return getattr(settings, 'PROMO_IDEMPOTENCY_TTL', 24 * 60 * 60)
+
+
+def _stored(user_id, key):
+    """
+    The (promoCode_id, data, status) stored for the key, from the cache or else the database.
+    """
+
+    stored = shared().get(_key(user_id, key))
+    if stored is not None:
+        return stored
+
+    row = IdempotencyKey.objects.filter(user=user_id, key=key).values_list('promoCode', 'response', 'status').first()
+    if row is not None:
+        shared().set(_key(user_id, key), row, _timeout())
+
+    return row
+
+
+def _replay(stored, promoCode_id):
+    stored_promoCode_id, data, status_code = stored
+    if stored_promoCode_id != promoCode_id:
+        return {'detail': "Idempotency-Key already used for another Promo Code."}, \
+            status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    return data, status_code
+
+
+def _conflict():
+    return {'detail': "A request with this Idempotency-Key is in progress."}, status.HTTP_409_CONFLICT
+
+
+def idempotent(request, pk, handler):
+    """
+    Run handler(request, pk) at most once per Idempotency-Key header of the user.  The response is stored in the same
+    transaction as whatever the handler writes, and replayed on retries without running the handler again.  A retry
+    coming while the key is still in flight gets a 409, the client retries it later to get the stored response.
+    """
+
+    key = request.META.get(HEADER)
+    if not key or not request.user.is_authenticated:
+        return handler(request, pk)
+
+    if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+        return {'detail': "Idempotency-Key is too long."}, status.HTTP_400_BAD_REQUEST
+
+    try:
+        promoCode_id = int(pk)
+    except ValueError:
+        raise Http404
+
+    user_id = request.user.id
+    stored = _stored(user_id, key)
+    if stored is not None:
+        return _replay(stored, promoCode_id)
+
+    in_flight = _in_flight_key(user_id, key)
+    if not shared().add(in_flight, True, IN_FLIGHT_TIMEOUT):
+        return _conflict()
+
+    try:
+        with transaction.atomic():
+            data, status_code = handler(request, pk)
+            try:
+                IdempotencyKey.objects.create(key=key, user_id=user_id, promoCode_id=promoCode_id,
+                                              status=status_code, response=data)
+            except IntegrityError:
+                # Out of the atomic block, which rolls back the writes of the handler too.
+                raise _KeyTaken
+    except _KeyTaken:
+        # A concurrent request with the same key won, and its claim is the one kept.  Not committed yet when the
+        # cache didn't tell the requests apart (a process local one), the client has to come back for it.
+        stored = IdempotencyKey.objects.filter(user=user_id, key=key).values_list('promoCode', 'response', 'status')
+        stored = stored.first()
+        return _conflict() if stored is None else _replay(stored, promoCode_id)
+    finally:
+        shared().delete(in_flight)
+
+    transaction.on_commit(lambda: shared().set(_key(user_id, key), (promoCode_id, data, status_code), _timeout()))
+
+    return data, status_code
+
+
+def purge(days):
+    """
+    Forget the keys older than days, returns how many.
+    """
+
+    return IdempotencyKey.objects.filter(created__lt=now() - timedelta(days=days)).delete()[0]
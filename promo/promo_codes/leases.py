@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils.timezone import now
+
+from promo_codes.models import PromoCode, PromoCodeLease, ClaimedPromoCode
+
+
+def lease_ttl():
+    return getattr(settings, 'PROMO_CODE_LEASE_TTL', 30)
+
+
+def uses_lease(promoCode):
+    """
+    Leasing only makes sense for Promo Codes with a global quota.
+    """
+
+    return promoCode.lease_size > 0 and promoCode.quota > 0
+
+
+class Lease(object):
+
+    def __init__(self, row):
+        self.id = row.id
+        self.promoCode_id = row.promoCode_id
+        self.remaining = row.size
+        self.consumed = 0
+        self.deadline = time.monotonic() + lease_ttl()
+
+
+class LeaseHolder(object):
+    """
+    The quota blocks this worker leased, handed out from memory so the hot Promo Code row isn't touched per redeem.
+
+    Leasing and returning are their own transactions, so take() must not be called inside an atomic block: a rollback
+    would give the slots back to the database while this worker still hands them out.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.leases = {}
+        self.worker = ('%s:%d' % (socket.gethostname(), os.getpid()))[:64]
+
+    def _acquire(self, promoCode):
+        with transaction.atomic():
+            row = PromoCode.objects.select_for_update().filter(pk=promoCode.id) \
+                .values('quota', 'reserved', 'lease_size').first()
+            if row is None:
+                return None
+
+            size = min(row['lease_size'], row['quota'] - row['reserved'])
+            if size <= 0:
+                return None
+
+            PromoCode.objects.filter(pk=promoCode.id).update(reserved=F('reserved') + size)
+            lease = PromoCodeLease.objects.create(promoCode_id=promoCode.id, size=size, worker=self.worker,
+                                                  expires=now() + timedelta(seconds=lease_ttl()))
+
+        return Lease(lease)
+
+    def _return(self, lease):
+        """
+        Give the unused slots back and account the consumed ones as used.
+        """
+
+        with transaction.atomic():
+            # Locked first, in the order of reclaim_leases.
+            list(PromoCode.objects.select_for_update().filter(pk=lease.promoCode_id).values_list('id'))
+            # Once reclaimed the slots were forfeited and the counters recounted, there is nothing to give back.
+            if PromoCodeLease.objects.filter(pk=lease.id).delete()[0] == 1:
+                PromoCode.objects.filter(pk=lease.promoCode_id).update(reserved=F('reserved') - lease.remaining,
+                                                                       used=F('used') + lease.consumed)
+
+        self.leases.pop(lease.promoCode_id, None)
+
+    def _return_expired(self):
+        current = time.monotonic()
+        for lease in [l for l in self.leases.values() if l.deadline <= current]:
+            self._return(lease)
+
+    def take(self, promoCode):
+        """
+        Take one slot of the quota of the Promo Code, returns False if it has been used to its limit.
+        """
+
+        with self.lock:
+            self._return_expired()
+
+            lease = self.leases.get(promoCode.id)
+            if lease is not None and lease.remaining == 0:
+                self._return(lease)
+                lease = None
+
+            if lease is None:
+                lease = self._acquire(promoCode)
+                if lease is None:
+                    return False
+                self.leases[promoCode.id] = lease
+
+            lease.remaining -= 1
+            lease.consumed += 1
+
+            return True
+
+    def give_back(self, promoCode):
+        """
+        Undo a take() whose claim didn't make it to the database.
+        """
+
+        with self.lock:
+            lease = self.leases.get(promoCode.id)
+            if lease is not None:
+                lease.remaining += 1
+                lease.consumed -= 1
+
+    def release_all(self):
+        with self.lock:
+            for lease in list(self.leases.values()):
+                self._return(lease)
+
+
+holder = LeaseHolder()
+
+
+@atexit.register
+def _release_on_exit():
+    try:
+        holder.release_all()
+    except Exception:
+        # The database may be gone already, the leases will be reclaimed.
+        pass
+
+
+def reclaim_leases(grace=60):
+    """
+    Drop the leases a dead worker never gave back.  What they held is forfeited rather than returned, since the
+    consumed part is unknown, and the counters of the Promo Code are recounted: reserved as its claims plus the sizes
+    of the leases still live, and used from the claims once no lease is left.  The slots the live leases consumed
+    are counted twice until they are returned, which errs on refusing.  Returns how many were dropped.
+    """
+
+    cutoff = now() - timedelta(seconds=grace)
+    reclaimed = 0
+
+    for promoCode_id in set(PromoCodeLease.objects.filter(expires__lt=cutoff).values_list('promoCode', flat=True)):
+        with transaction.atomic():
+            # Locked against the leases taken and returned meanwhile.
+            if not list(PromoCode.objects.select_for_update().filter(pk=promoCode_id).values_list('id')):
+                continue
+
+            reclaimed += PromoCodeLease.objects.filter(promoCode=promoCode_id, expires__lt=cutoff).delete()[0]
+
+            claims = ClaimedPromoCode.objects.filter(promoCode=promoCode_id).aggregate(count=Count('id'))['count']
+            live = PromoCodeLease.objects.filter(promoCode=promoCode_id).aggregate(size=Sum('size'))['size']
+            counters = {'reserved': claims + (live or 0)}
+            if live is None:
+                counters['used'] = claims
+            PromoCode.objects.filter(pk=promoCode_id).update(**counters)
+
+    return reclaimed
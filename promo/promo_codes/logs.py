@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+
+# Logging helpers for settings.LOGGING, they only use the standard library so the settings can load them before the
+# apps are ready.  Request threads only filter and queue the records, BackgroundFileHandler writes them from a thread.
+
+stats = {
+    'dropped': 0,
+    'lost': 0,
+    'sampled_out': 0,
+}
+
+_STOP = object()
+
+
+class BackgroundFileHandler(logging.handlers.QueueHandler):
+    """
+    Put the records in a bounded queue, a thread of each process formats and appends them to the file in batches.
+    When the queue is full the records are dropped, counted, and the writer notes how many were lost in the file, as
+    it does for the batches it failed to write.
+    """
+
+    def __init__(self, filename, maxsize=10000, batch_size=500, encoding='utf-8'):
+        super(BackgroundFileHandler, self).__init__(queue.Queue(maxsize))
+        self.filename = os.path.abspath(filename)
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.encoding = encoding
+        self.dropped = 0
+        self.lost = 0
+        self._pid = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            # Started lazily, so every forked worker gets its own queue and thread.
+            if self._pid is not None:
+                self.queue = queue.Queue(self.maxsize)
+            # Opened here rather than by the writer, so an error shows up through handleError.
+            stream = open(self.filename, 'a', encoding=self.encoding)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._write, args=(stream,), name='log-writer', daemon=True)
+            self._thread.start()
+
+    def prepare(self, record):
+        """
+        Only resolve what can't wait (the arguments and the traceback), the formatting is left to the writer.  On a copy,
+        the other handlers get the record as it was logged.
+        """
+
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            stats['dropped'] += 1
+
+    def _batch(self):
+        records = [self.queue.get()]
+        while len(records) < self.batch_size:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return records
+
+    def _write(self, stream):
+        reported = 0
+        reported_lost = 0
+        with stream:
+            while True:
+                records = self._batch()
+                lines = []
+                for record in records:
+                    if record is _STOP:
+                        continue
+                    try:
+                        lines.append(self.format(record) + '\n')
+                    except Exception:
+                        self.handleError(record)
+
+                dropped, lost = self.dropped, self.lost
+                if dropped != reported:
+                    lines.append("%d log records dropped, the queue was full\n" % (dropped - reported))
+                if lost != reported_lost:
+                    lines.append("%d log records lost, their write failed\n" % (lost - reported_lost))
+
+                try:
+                    stream.write(''.join(lines))
+                    stream.flush()
+                    reported, reported_lost = dropped, lost
+                except Exception:
+                    # The batch is lost (a full disk, a record the encoding can't write...), not the writer.
+                    lost = sum(1 for record in records if record is not _STOP)
+                    self.lost += lost
+                    stats['lost'] += lost
+
+                if _STOP in records:
+                    return
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+        super(BackgroundFileHandler, self).close()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a share of the records of the loggers in rates (and their children), e.g. {'django.db.backends': 0.01}.
+    Warnings and above are always kept.
+    """
+
+    def __init__(self, rates=None, level=logging.WARNING):
+        super(SamplingFilter, self).__init__()
+        self.rates = rates or {}
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+        self._rates = {}
+
+    def rate(self, name):
+        rate = self._rates.get(name)
+        if rate is None:
+            rate = 1.0
+            for prefix in sorted(self.rates, key=len, reverse=True):
+                if name == prefix or name.startswith(prefix + '.'):
+                    rate = self.rates[prefix]
+                    break
+            self._rates[name] = rate
+
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+
+        rate = self.rate(record.name)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+
+        stats['sampled_out'] += 1
+        return False
+
+
+# Attributes every LogRecord has, the other ones come from extra= and are added to the JSON.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: time, level, logger, message, module, process, thread, the traceback if any and the
+    extra= fields.
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+
+        return json.dumps(data, default=str)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from promo_codes.archive import archive_expired
+
+
+class Command(BaseCommand):
+    help = "Move the Promo Codes expired for more than some days, and their claims, to the archive tables.  Meant " \
+           "to be scheduled, e.g. daily from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Archive the codes expired for more than this many days, "
+                                                     "PROMO_ARCHIVE_AFTER_DAYS by default")
+        parser.add_argument('--batch-size', type=int, default=500, help="About how many rows each transaction moves")
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help="Seconds to wait between batches, to let replication keep up")
+
+    def handle(self, *args, **options):
+        codes = claims = 0
+        for batch_codes, batch_claims in archive_expired(options['days'], options['batch_size']):
+            codes += batch_codes
+            claims += batch_claims
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write("%d codes and %d claims archived" % (codes, claims))
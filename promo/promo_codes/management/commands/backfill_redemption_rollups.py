@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from promo_codes.rollups import backfill
+
+
+class Command(BaseCommand):
+    help = "Rebuild the redemption rollups from the claimed Promo Codes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only rebuild from this day on, YYYY-MM-DD")
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if since is None:
+                raise CommandError("Invalid day: %s" % options['since'])
+
+        self.stdout.write("%d rollups written" % backfill(since))
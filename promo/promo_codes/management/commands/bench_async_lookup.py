@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings, setup_test_environment
+
+from promo_codes.benchmarks import summary
+from promo_codes.models import PromoCode
+
+
+class Command(BaseCommand):
+    help = "Compare the async code lookup with the WSGI viewset one, in process, on codes already in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help="How many lookups per path")
+        parser.add_argument('--concurrency', type=int, default=50, help="Lookups in flight at once")
+
+    def run_sync(self, paths, concurrency, statuses):
+        local = threading.local()
+        latencies = []
+
+        def get(path):
+            if not hasattr(local, 'client'):
+                local.client = Client()
+            start = time.perf_counter()
+            response = local.client.get(path)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] += 1
+            connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(get, paths))
+
+        return summary(latencies, time.perf_counter() - start)
+
+    def run_async(self, paths, concurrency, statuses):
+        latencies = []
+
+        async def main():
+            client = AsyncClient()
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def get(path):
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.get(path)
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status_code] += 1
+
+            await asyncio.gather(*(get(path) for path in paths))
+
+        start = time.perf_counter()
+        asyncio.run(main())
+
+        return summary(latencies, time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        codes = list(PromoCode.objects.values_list('code_l', flat=True)[:2000])
+        if len(codes) < 2:
+            raise CommandError("No Promo Codes to look up, generate some first.")
+
+        # Lets the test clients through ALLOWED_HOSTS.
+        setup_test_environment()
+
+        # Each side has its own codes, the second one would get the caches warmed by the first one otherwise.
+        sides = {name: [quote(c) for c in codes[i::2]] for i, name in enumerate(('wsgi', 'asgi'))}
+        lookups = {name: [side[i % len(side)] for i in range(options['requests'])] for name, side in sides.items()}
+        statuses = {'wsgi': Counter(), 'asgi': Counter()}
+        # Every lookup comes from the same client, which the throttling would refuse long before the end.
+        with override_settings(PROMO_THROTTLE_RATES={}):
+            results = {
+                'wsgi': self.run_sync(['/promocode/%s' % c for c in lookups['wsgi']], options['concurrency'],
+                                      statuses['wsgi']),
+                'asgi': self.run_async(['/async/promocode/%s' % c for c in lookups['asgi']], options['concurrency'],
+                                       statuses['asgi']),
+            }
+
+        for name, counts in statuses.items():
+            failed = sum(count for code, count in counts.items() if code != 200)
+            results[name]['failed'] = failed
+            if failed:
+                self.stderr.write("%d of the %s lookups didn't answer 200: %s" % (
+                    failed, name, ', '.join('%d: %d' % item for item in sorted(counts.items()))))
+
+        self.stdout.write(json.dumps(results, indent=2))
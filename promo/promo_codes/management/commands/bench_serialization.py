@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from promo_codes.benchmarks import summary
+from promo_codes.models import PromoCode, ClaimedPromoCode
+from promo_codes.serializers import PromoCodeSerializer, ClaimedPromoCodeSerializer
+from promo_codes.values import ValuesSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare the model serializers with the values() fast path on pages of rows already in the database, " \
+           "from the query to the rendered JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help="Rows per page")
+        parser.add_argument('--pages', type=int, default=50, help="How many pages to render each way")
+
+    def measure(self, render, pages):
+        latencies = []
+        start = time.perf_counter()
+        for i in range(pages):
+            begin = time.perf_counter()
+            body = render()
+            latencies.append(time.perf_counter() - begin)
+
+        return summary(latencies, time.perf_counter() - start), body
+
+    def handle(self, *args, **options):
+        renderer = JSONRenderer()
+        results = {}
+
+        for name, serializer_class, queryset in (
+                ('list', PromoCodeSerializer, PromoCode.objects.order_by('-created', '-id')),
+                ('redeemed', ClaimedPromoCodeSerializer, ClaimedPromoCode.objects.order_by('-redeemed', '-id'))):
+            queryset = queryset[:options['rows']]
+            if not queryset.exists():
+                raise CommandError("No rows to render, seed the database first (see run_benchmarks).")
+
+            fast = ValuesSerializer(serializer_class)
+            serializer, serializer_body = self.measure(
+                lambda: renderer.render(serializer_class(list(queryset.all()), many=True).data), options['pages'])
+            values, values_body = self.measure(
+                lambda: renderer.render(fast.serialize(list(fast.values(queryset)))), options['pages'])
+            if serializer_body != values_body:
+                raise CommandError("The %s bodies differ." % name)
+
+            results[name] = {
+                'serializer': serializer,
+                'values': values,
+                'speedup': round(serializer['p50_ms'] / values['p50_ms'], 2),
+            }
+
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from promo_codes.generate import DEFAULT_ALPHABET, generate_codes
+from promo_codes.serializers import PromoCodeGenerateSerializer
+
+
+class Command(BaseCommand):
+    help = "Generate many random Promo Codes sharing the same attributes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help="How many codes to create")
+        parser.add_argument('--prefix', default='', help="Prefix of every code")
+        parser.add_argument('--length', type=int, default=8, help="Number of random characters after the prefix")
+        parser.add_argument('--alphabet', default=DEFAULT_ALPHABET, help="Characters the codes are drawn from")
+        parser.add_argument('--type', default='value', help="percent or value")
+        parser.add_argument('--value', default='0', help="Discount value")
+        parser.add_argument('--expires', help="Expiration time, ISO 8601")
+        parser.add_argument('--repeat', type=int, default=1, help="How many times each code can be used, 0 == infinitely")
+        parser.add_argument('--chunk-size', type=int, default=10000, help="How many codes are inserted at once")
+
+    def handle(self, *args, **options):
+        data = {key: options[key] for key in ('count', 'prefix', 'length', 'alphabet', 'type', 'value', 'repeat')}
+        if options['expires']:
+            data['expires'] = options['expires']
+
+        serializer = PromoCodeGenerateSerializer(data=data)
+        if not serializer.is_valid():
+            raise CommandError(serializer.errors)
+
+        count = serializer.validated_data['count']
+        for created in generate_codes(chunk_size=options['chunk_size'], **serializer.validated_data):
+            self.stdout.write("%d/%d codes created" % (created, count))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from promo_codes import partitions
+
+
+class Command(BaseCommand):
+    help = "Create the monthly partitions of the claims ahead of time and drop or detach the old ones (MySQL only).  " \
+           "Meant to be scheduled, e.g. daily from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int,
+                            help="Keep partitions this many months ahead, PROMO_CLAIM_PARTITIONS_AHEAD by default")
+        parser.add_argument('--keep-months', type=int,
+                            help="Drop the partitions older than this many months, none are dropped by default")
+        parser.add_argument('--detach', action='store_true',
+                            help="Swap the old partitions into tables of their own instead of dropping their claims")
+
+    def handle(self, *args, **options):
+        if not partitions.supported():
+            raise CommandError("The claims are only partitioned on MySQL.")
+
+        ahead = options['ahead']
+        if ahead is None:
+            ahead = getattr(settings, 'PROMO_CLAIM_PARTITIONS_AHEAD', 3)
+
+        try:
+            for name in partitions.create_partitions(ahead):
+                self.stdout.write("Created partition %s" % name)
+
+            if options['keep_months'] is not None:
+                before = partitions.add_months(partitions.month_of(now()), -options['keep_months'])
+                for name in partitions.drop_partitions(before, detach=options['detach']):
+                    self.stdout.write("%s partition %s" % ("Detached" if options['detach'] else "Dropped", name))
+        except ValueError as e:
+            raise CommandError(str(e))
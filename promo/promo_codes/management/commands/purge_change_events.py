@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from promo_codes.changes import purge
+
+
+class Command(BaseCommand):
+    help = "Drop the change feed events older than some days."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Keep the events of the last days, PROMO_CHANGE_RETENTION_DAYS by default")
+
+    def handle(self, *args, **options):
+        self.stdout.write("%d events purged" % purge(options['days']))
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from promo_codes.idempotency import purge
+
+
+class Command(BaseCommand):
+    help = "Forget the redeem Idempotency-Keys older than some days."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=1, help="Keep the keys of the last days")
+
+    def handle(self, *args, **options):
+        self.stdout.write("%d keys purged" % purge(options['days']))
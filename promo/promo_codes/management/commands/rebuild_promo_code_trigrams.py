@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from promo_codes.models import PromoCode
+from promo_codes.search import index_codes
+
+
+class Command(BaseCommand):
+    help = "Rebuild the trigram index behind the substring Promo Code search."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="How many codes are indexed at once")
+
+    def handle(self, *args, **options):
+        last = 0
+        indexed = 0
+        while True:
+            promoCodes = list(PromoCode.objects.filter(id__gt=last).order_by('id').only('code_l')[:options['chunk_size']])
+            if not promoCodes:
+                break
+
+            index_codes(promoCodes)
+            indexed += len(promoCodes)
+            last = promoCodes[-1].id
+
+        self.stdout.write("%d codes indexed" % indexed)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from promo_codes.leases import reclaim_leases
+
+
+class Command(BaseCommand):
+    help = "Drop the Promo Code quota leases that dead workers never gave back."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=60, help="Seconds past their expiry before leases are dropped")
+
+    def handle(self, *args, **options):
+        self.stdout.write("%d leases reclaimed" % reclaim_leases(options['grace']))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment
+from django.utils.timezone import now
+
+from promo_codes.benchmarks import Benchmark, SIZES, generation, seed
+
+
+class Command(BaseCommand):
+    help = "Seed a benchmark dataset and measure the API in process.  It writes to the database, so point it to a " \
+           "dedicated SQLite or MySQL one."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', default='10k', choices=sorted(SIZES), help="How many Promo Codes to seed")
+        parser.add_argument('--requests', type=int, default=1000, help="Requests per operation")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the random requests")
+        parser.add_argument('--only', nargs='*', help="Operations to run, all by default")
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help="Threads sending the high contention redeems at once")
+        parser.add_argument('--generate', type=int, default=0,
+                            help="Also time the generation of this many codes, the goal is 1000000 in under a minute")
+        parser.add_argument('--output', help="Write the JSON results to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        size = SIZES[options['size']]
+
+        seed(size, progress=lambda n: self.stderr.write("%d codes seeded" % n) if n % 100000 == 0 else None)
+
+        # Lets the test client through ALLOWED_HOSTS.
+        setup_test_environment()
+
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        try:
+            results = Benchmark(size, options['requests'], options['seed'], options['concurrency']).run(options['only'])
+        except AssertionError as e:
+            raise CommandError(str(e))
+
+        if options['generate']:
+            results['generate'] = generation(options['generate'])
+
+        output = json.dumps({
+            'meta': {
+                'size': size,
+                'requests': options['requests'],
+                'seed': options['seed'],
+                'concurrency': options['concurrency'],
+                'generate': options['generate'],
+                'vendor': connection.vendor,
+                'commit': commit,
+                'date': now().isoformat(),
+            },
+            'results': results,
+        }, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
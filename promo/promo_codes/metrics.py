@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from array import array
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Per view counters in Prometheus text format.  Every view gets one preallocated array per process the first time it
+# is hit, recording a request only adds to it.  Workers write their counters to PROMO_METRICS_DIR every
+# PROMO_METRICS_FLUSH_INTERVAL seconds (and on exit), /metrics adds up the files of all of them.  Like for the
+# prometheus_client multiprocess mode, the directory should be emptied when the application is restarted.
+
+BUCKETS = tuple(getattr(settings, 'PROMO_METRICS_BUCKETS',
+                        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)))
+
+# Layout of the counters of a view: requests, then by status class (1xx to 5xx), latency, database and cache
+# counters, then the latency histogram (not cumulative, the last bucket is +Inf).
+REQUESTS = 0
+STATUS = 1
+LATENCY = 6
+QUERIES = 7
+DB_TIME = 8
+CACHE_HITS = 9
+CACHE_MISSES = 10
+HISTOGRAM = 11
+SIZE = HISTOGRAM + len(BUCKETS) + 1
+
+UNMATCHED = 'unmatched'
+
+_views = {}
+_lock = threading.Lock()
+_next_flush = [0.0]
+
+
+class _Request(object):
+    """
+    What a request did so far: queries, db time, cache hits and misses.
+    """
+
+    def __init__(self):
+        self.view = UNMATCHED
+        self.counters = array('d', [0.0] * 4)
+
+
+# Per request rather than per thread, ASGI serves concurrent requests on the same threads.
+_request = ContextVar('promo_metrics_request', default=None)
+
+
+def _slot(view):
+    counters = _views.get(view)
+    if counters is None:
+        with _lock:
+            counters = _views.setdefault(view, array('d', [0.0] * SIZE))
+
+    return counters
+
+
+def begin():
+    """
+    Start recording a request, returns the token to give to finish().
+    """
+
+    return _request.set(_Request())
+
+
+def set_view(view):
+    request = _request.get()
+    if request is not None:
+        request.view = view
+
+
+def finish(token, duration, status):
+    request = _request.get()
+    _request.reset(token)
+    pending = request.counters
+    counters = _slot(request.view)
+
+    with _lock:
+        counters[REQUESTS] += 1
+        counters[STATUS + min(max(status // 100, 1), 5) - 1] += 1
+        counters[LATENCY] += duration
+        counters[QUERIES] += pending[0]
+        counters[DB_TIME] += pending[1]
+        counters[CACHE_HITS] += pending[2]
+        counters[CACHE_MISSES] += pending[3]
+        counters[HISTOGRAM + bisect.bisect_left(BUCKETS, duration)] += 1
+
+    if time.monotonic() >= _next_flush[0] and getattr(settings, 'PROMO_METRICS_DIR', None):
+        flush()
+
+
+def cache_hit():
+    request = _request.get()
+    if request is not None:
+        request.counters[2] += 1
+
+
+def cache_miss():
+    request = _request.get()
+    if request is not None:
+        request.counters[3] += 1
+
+
+def _time_query(execute, sql, params, many, context):
+    request = _request.get()
+    if request is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request.counters[0] += 1
+        request.counters[1] += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+def _path(directory):
+    return os.path.join(directory, 'metrics-%d.json' % os.getpid())
+
+
+def flush():
+    """
+    Write the counters of this process to PROMO_METRICS_DIR.
+    """
+
+    directory = getattr(settings, 'PROMO_METRICS_DIR', None)
+    if not directory:
+        return
+
+    _next_flush[0] = time.monotonic() + getattr(settings, 'PROMO_METRICS_FLUSH_INTERVAL', 5)
+    with _lock:
+        views = {view: list(counters) for view, counters in _views.items()}
+
+    path = _path(directory)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(views, f)
+    os.replace(path + '.tmp', path)
+
+
+atexit.register(flush)
+
+
+def collect():
+    """
+    Return the counters of every view, summed over this process and the ones which wrote to PROMO_METRICS_DIR.
+    """
+
+    with _lock:
+        totals = {view: list(counters) for view, counters in _views.items()}
+
+    directory = getattr(settings, 'PROMO_METRICS_DIR', None)
+    if directory and os.path.isdir(directory):
+        own = os.path.basename(_path(directory))
+        for name in os.listdir(directory):
+            if not name.endswith('.json') or name == own:
+                continue
+
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    views = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for view, counters in views.items():
+                # Written with other buckets, by a previous deploy.
+                if len(counters) != SIZE:
+                    continue
+                total = totals.setdefault(view, [0.0] * SIZE)
+                for i, value in enumerate(counters):
+                    total[i] += value
+
+    return totals
+
+
+def _number(value):
+    return '%d' % value if value == int(value) else repr(value)
+
+
+def render(totals):
+    """
+    Format the collected counters in the Prometheus text exposition format.
+    """
+
+    views = sorted(totals)
+    lines = []
+
+    def family(name, kind, description, samples):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            lines.append('%s{%s} %s' % (name, labels, _number(value)))
+
+    family('promo_requests_total', 'counter', 'Requests by view and status class.', [
+        ('view="%s",code="%dxx"' % (view, i + 1), totals[view][STATUS + i])
+        for view in views for i in range(5) if totals[view][STATUS + i]])
+
+    lines.append('# HELP promo_request_duration_seconds Request latency by view.')
+    lines.append('# TYPE promo_request_duration_seconds histogram')
+    for view in views:
+        counters = totals[view]
+        cumulative = 0
+        for i, bound in enumerate(BUCKETS + (None,)):
+            cumulative += counters[HISTOGRAM + i]
+            lines.append('promo_request_duration_seconds_bucket{view="%s",le="%s"} %s' % (
+                view, '+Inf' if bound is None else bound, _number(cumulative)))
+        lines.append('promo_request_duration_seconds_sum{view="%s"} %s' % (view, _number(counters[LATENCY])))
+        lines.append('promo_request_duration_seconds_count{view="%s"} %s' % (view, _number(counters[REQUESTS])))
+
+    family('promo_db_queries_total', 'counter', 'Database queries by view.',
+           [('view="%s"' % view, totals[view][QUERIES]) for view in views])
+    family('promo_db_duration_seconds_total', 'counter', 'Time spent in database queries by view.',
+           [('view="%s"' % view, totals[view][DB_TIME]) for view in views])
+    family('promo_cache_hits_total', 'counter', 'Promo Code cache hits by view.',
+           [('view="%s"' % view, totals[view][CACHE_HITS]) for view in views])
+    family('promo_cache_misses_total', 'counter', 'Promo Code cache misses by view.',
+           [('view="%s"' % view, totals[view][CACHE_MISSES]) for view in views])
+    family('promo_cache_hit_ratio', 'gauge', 'Share of the Promo Code cache lookups which hit, by view.', [
+        ('view="%s"' % view, totals[view][CACHE_HITS] / (totals[view][CACHE_HITS] + totals[view][CACHE_MISSES]))
+        for view in views if totals[view][CACHE_HITS] + totals[view][CACHE_MISSES]])
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+    """
+    Record every request under the name of its url (promocode-redeem, promocode-detail, ...), keep it first in
+    MIDDLEWARE so the time spent in the other middlewares is counted.  Sync and async capable: a sync only middleware
+    would put every ASGI request on the one thread of the thread sensitive executor.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # As MiddlewareMixin does, so the handler awaits the instance, and process_view isn't sent to a thread.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            self.process_view = self._process_view_async
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._call_async(request)
+
+        token = begin()
+        start = time.perf_counter()
+        response = self.get_response(request)
+        finish(token, time.perf_counter() - start, response.status_code)
+
+        return response
+
+    async def _call_async(self, request):
+        token = begin()
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        finish(token, time.perf_counter() - start, response.status_code)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        set_view(request.resolver_match.url_name or request.resolver_match.view_name)
+
+    async def _process_view_async(self, request, view_func, view_args, view_kwargs):
+        set_view(request.resolver_match.url_name or request.resolver_match.view_name)
@@ -0,0 +1,50 @@
+# Generated by Django 3.1 on 2026-10-18 07:05
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def backfill_usage(apps, schema_editor):
+    PromoCode = apps.get_model('promo_codes', 'PromoCode')
+    ClaimedPromoCode = apps.get_model('promo_codes', 'ClaimedPromoCode')
+    PromoCodeUsage = apps.get_model('promo_codes', 'PromoCodeUsage')
+
+    counts = ClaimedPromoCode.objects.values('promoCode', 'user').annotate(used=Count('id')).order_by()
+    PromoCodeUsage.objects.bulk_create(
+        [PromoCodeUsage(promoCode_id=c['promoCode'], user_id=c['user'], used=c['used']) for c in counts.iterator()],
+        batch_size=1000)
+
+    totals = ClaimedPromoCode.objects.values('promoCode').annotate(used=Count('id')).order_by()
+    for t in totals.iterator():
+        PromoCode.objects.filter(pk=t['promoCode']).update(used=t['used'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('promo_codes', '0008_auto_20200814_0652'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promocode',
+            name='used',
+            field=models.IntegerField(default=0, help_text='How many times this Promo Code has been claimed in total', verbose_name='Used'),
+        ),
+        migrations.CreateModel(
+            name='PromoCodeUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('used', models.IntegerField(default=0, help_text='How many times the user claimed this Promo Code', verbose_name='Used')),
+                ('promoCode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='promo_codes.promocode')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('promoCode', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.1 on 2026-10-18 07:11
+
+from django.db import migrations, models
+from django.db.models import F
+import django.db.models.deletion
+
+
+def backfill_reserved(apps, schema_editor):
+    PromoCode = apps.get_model('promo_codes', 'PromoCode')
+    PromoCode.objects.update(reserved=F('used'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('promo_codes', '0009_usage_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promocode',
+            name='lease_size',
+            field=models.IntegerField(default=0, help_text='How many slots of the quota each worker leases at once, 0 == no leasing', verbose_name='Lease Size'),
+        ),
+        migrations.AddField(
+            model_name='promocode',
+            name='quota',
+            field=models.IntegerField(default=0, help_text='How many times this Promo Code can be used by everyone together, 0 == infinitely', verbose_name='Quota'),
+        ),
+        migrations.AddField(
+            model_name='promocode',
+            name='reserved',
+            field=models.IntegerField(default=0, help_text='How much of the quota is claimed or leased', verbose_name='Reserved'),
+        ),
+        migrations.CreateModel(
+            name='PromoCodeLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='Creation Time', verbose_name='Creation Time')),
+                ('expires', models.DateTimeField(help_text='When the worker has to give it back', verbose_name='Expire Time')),
+                ('size', models.IntegerField(help_text='How many slots were leased', verbose_name='Size')),
+                ('worker', models.CharField(help_text='Host and process holding the lease', max_length=64, verbose_name='Worker')),
+                ('promoCode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='promo_codes.promocode')),
+            ],
+        ),
+        migrations.RunPython(backfill_reserved, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1 on 2026-10-18 07:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('promo_codes', '0010_quota_leases'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RedemptionRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(help_text='Redeem Day', verbose_name='Day')),
+                ('typeOfPayment', models.CharField(help_text='Cash or Visa', max_length=16, verbose_name='Type of payment')),
+                ('company', models.CharField(help_text='Name of the business Company', max_length=64, verbose_name='Company')),
+                ('service', models.CharField(help_text='Name of the service', max_length=64, verbose_name='Service')),
+                ('count', models.IntegerField(default=0, help_text='How many claims', verbose_name='Count')),
+                ('total_price', models.DecimalField(decimal_places=2, default=0, help_text='Sum of what the users paid', max_digits=16, verbose_name='Total Price')),
+                ('promoCode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='promo_codes.promocode')),
+            ],
+            options={
+                'unique_together': {('day', 'promoCode', 'company', 'typeOfPayment', 'service')},
+            },
+        ),
+    ]
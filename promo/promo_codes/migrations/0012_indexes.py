@@ -0,0 +1,45 @@
+# Generated by Django 3.1 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('promo_codes', '0011_redemption_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='claimedpromocode',
+            index=models.Index(fields=['promoCode', 'user', 'redeemed'], name='claim_code_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimedpromocode',
+            index=models.Index(fields=['promoCode', 'redeemed'], name='claim_code_redeemed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimedpromocode',
+            index=models.Index(fields=['user', 'redeemed'], name='claim_user_redeemed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimedpromocode',
+            index=models.Index(fields=['redeemed', 'id'], name='claim_redeemed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='promocode',
+            index=models.Index(fields=['bound', 'user'], name='promo_bound_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='promocode',
+            index=models.Index(fields=['created', 'id'], name='promo_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='promocode',
+            index=models.Index(fields=['expires'], name='promo_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='promocode',
+            index=models.Index(fields=['value'], name='promo_value_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1 on 2026-10-18 07:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('promo_codes', '0012_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromoCodeTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(help_text='Three characters of the code', max_length=3, verbose_name='Trigram')),
+                ('promoCode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='promo_codes.promocode')),
+            ],
+            options={
+                'unique_together': {('trigram', 'promoCode')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.1 on 2026-10-18 07:25
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('promo_codes', '0013_code_trigrams'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='Creation Time', verbose_name='Creation Time')),
+                ('key', models.CharField(help_text='Idempotency-Key header of the request', max_length=64, verbose_name='Key')),
+                ('status', models.IntegerField(help_text='Status of the response', verbose_name='Status')),
+                ('response', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='Data of the response', verbose_name='Response')),
+                ('promoCode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='promo_codes.promocode')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='idempotencykey',
+            index=models.Index(fields=['created'], name='idempotency_created_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='idempotencykey',
+            unique_together={('user', 'key')},
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 3.1 on 2026-10-18 07:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('promo_codes', '0014_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='redemptionrollup',
+            name='promoCode',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='promo_codes.promocode'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedPromoCode',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('archived', models.DateTimeField(auto_now_add=True, help_text='Archive Time', verbose_name='Archive Time')),
+                ('created', models.DateTimeField(help_text='Creation Time', verbose_name='Creation Time')),
+                ('updated', models.DateTimeField(help_text='Update Time', verbose_name='Update Time')),
+                ('code', models.CharField(help_text='The unique promo code', max_length=64, verbose_name='Promo Code')),
+                ('code_l', models.CharField(db_index=True, help_text='Lower Case Promo Code', max_length=64, verbose_name='Lower Case Promo Code')),
+                ('type', models.CharField(choices=[('percent', 'percent'), ('value', 'value')], help_text='Percentage or a value.', max_length=16, verbose_name='Type')),
+                ('expires', models.DateTimeField(blank=True, help_text='When it expired', null=True, verbose_name='Expire Time')),
+                ('value', models.DecimalField(decimal_places=2, default=0.0, help_text='Promo Code Value', max_digits=10, verbose_name='Promo Code Value')),
+                ('bound', models.BooleanField(default=False, help_text='Is this Promo Code bound to a specific user?', verbose_name='Bound to user')),
+                ('repeat', models.IntegerField(default=0, help_text='How many times this Promo Code could be used', verbose_name='Repeat')),
+                ('used', models.IntegerField(default=0, help_text='How many times this Promo Code was claimed in total', verbose_name='Used')),
+                ('quota', models.IntegerField(default=0, help_text='How many times this Promo Code could be used by everyone', verbose_name='Quota')),
+                ('user', models.ForeignKey(blank=True, help_text='Which User is it bounded to?', null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedClaimedPromoCode',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('redeemed', models.DateTimeField(help_text='Redeem Time', verbose_name='Redeem')),
+                ('typeOfPayment', models.CharField(choices=[('cash', 'cash'), ('visa', 'visa'), ('ewallet', 'ewallet')], default='Cash', help_text='Cash or Visa', max_length=16, verbose_name='Type of payment')),
+                ('company', models.CharField(default='', help_text='Name of the business Company', max_length=64, verbose_name='Company')),
+                ('item', models.CharField(default='', help_text='What type of item', max_length=64, verbose_name='Item')),
+                ('service', models.CharField(default='', help_text='Name of the service', max_length=64, verbose_name='Service')),
+                ('total_price', models.DecimalField(decimal_places=2, default=0.0, help_text='How much did the user pay', max_digits=10, verbose_name='Total Price')),
+                ('promoCode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='promo_codes.archivedpromocode')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedclaimedpromocode',
+            index=models.Index(fields=['promoCode', 'user', 'redeemed'], name='archived_claim_code_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedclaimedpromocode',
+            index=models.Index(fields=['promoCode', 'redeemed'], name='archived_claim_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedclaimedpromocode',
+            index=models.Index(fields=['user', 'redeemed'], name='archived_claim_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedclaimedpromocode',
+            index=models.Index(fields=['redeemed', 'id'], name='archived_claim_redeemed_idx'),
+        ),
+    ]
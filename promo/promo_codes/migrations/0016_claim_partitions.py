@@ -0,0 +1,41 @@
+# Generated by Django 3.1 on 2026-10-18 07:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from promo_codes import partitions
+
+
+def partition(apps, schema_editor):
+    if partitions.supported(schema_editor.connection):
+        with schema_editor.connection.cursor() as cursor:
+            partitions.partition_table(cursor, getattr(settings, 'PROMO_CLAIM_PARTITIONS_AHEAD', 3))
+
+
+def unpartition(apps, schema_editor):
+    if partitions.supported(schema_editor.connection):
+        with schema_editor.connection.cursor() as cursor:
+            partitions.unpartition_table(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('promo_codes', '0015_archive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='claimedpromocode',
+            name='promoCode',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='promo_codes.promocode'),
+        ),
+        migrations.AlterField(
+            model_name='claimedpromocode',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(partition, unpartition),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('promo_codes', '0016_claim_partitions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='promocode',
+            index=models.Index(fields=['updated'], name='promo_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1 on 2026-10-18 08:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('promo_codes', '0017_promocode_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='promocode',
+            index=models.Index(fields=['type', 'value'], name='promo_best_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='promocode',
+            index=models.Index(fields=['user', 'type', 'value'], name='promo_user_best_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.1 on 2026-10-18 08:16
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('promo_codes', '0018_promocode_best_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='Creation Time', verbose_name='Creation Time')),
+                ('kind', models.CharField(choices=[('claim.created', 'claim.created'), ('claim.deleted', 'claim.deleted'), ('promocode.created', 'promocode.created'), ('promocode.updated', 'promocode.updated'), ('promocode.deleted', 'promocode.deleted'), ('promocode.archived', 'promocode.archived')], help_text='What changed', max_length=32, verbose_name='Kind')),
+                ('object_id', models.IntegerField(help_text='Id of the Promo Code or claim', verbose_name='Object Id')),
+                ('data', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='The fields of the object', verbose_name='Data')),
+                ('position', models.BigIntegerField(blank=True, help_text='Position in the change feed', null=True, unique=True, verbose_name='Position')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChangeFeed',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.BigIntegerField(default=0, help_text='Last position given', verbose_name='Position')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='changeevent',
+            index=models.Index(fields=['created'], name='change_created_idx'),
+        ),
+    ]
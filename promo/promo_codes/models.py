@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
 PROMO_TYPES = (
@@ -21,6 +22,15 @@ COMPANIES = (
     ('AUC', 'AUC')
 )
 
+CHANGE_KINDS = (
+    ('claim.created', 'claim.created'),
+    ('claim.deleted', 'claim.deleted'),
+    ('promocode.created', 'promocode.created'),
+    ('promocode.updated', 'promocode.updated'),
+    ('promocode.deleted', 'promocode.deleted'),
+    ('promocode.archived', 'promocode.archived'),
+)
+
 try:
     # In case they specified something else in their settings file, which is quite common.
     user = settings.AUTH_USER_MODEL
@@ -72,6 +82,25 @@ class PromoCode(models.Model):
                                      "How many times this Promo Code can be used, 0 == infinitely, otherwise it's a number, such as 1 or many."),
                                  verbose_name=_("Repeat"))
 
+    # Denormalized total of the corresponding ClaimedPromoCodes, kept in step by promo_codes.usage.
+    used = models.IntegerField(default=0,
+                               help_text=_("How many times this Promo Code has been claimed in total"),
+                               verbose_name=_("Used"))
+
+    quota = models.IntegerField(default=0,
+                                help_text=_("How many times this Promo Code can be used by everyone together, 0 == infinitely"),
+                                verbose_name=_("Quota"))
+
+    # Slots taken out of the quota, either claimed or held by a PromoCodeLease.
+    reserved = models.IntegerField(default=0,
+                                   help_text=_("How much of the quota is claimed or leased"),
+                                   verbose_name=_("Reserved"))
+
+    lease_size = models.IntegerField(default=0,
+                                     help_text=_(
+                                         "How many slots of the quota each worker leases at once, 0 == no leasing"),
+                                     verbose_name=_("Lease Size"))
+
     # single-use per user
     # repeat = 1, bound = True, binding = user_id
     # single-use globally
@@ -87,6 +116,22 @@ class PromoCode(models.Model):
     # specific number of times globally
     # repeat => X, bound = False
 
+    class Meta:
+        indexes = [
+            # Promo Codes a user sees, see PromoCodeViewSet.get_queryset.
+            models.Index(fields=['bound', 'user'], name='promo_bound_user_idx'),
+            # Listing order of PromoCodePagination.
+            models.Index(fields=['created', 'id'], name='promo_created_idx'),
+            models.Index(fields=['expires'], name='promo_expires_idx'),
+            # min_value/max_value of PromoCodeFilter.
+            models.Index(fields=['value'], name='promo_value_idx'),
+            # Value order of the Promo Codes of a type, and of those of a user, see promo_codes.best.
+            models.Index(fields=['type', 'value'], name='promo_best_idx'),
+            models.Index(fields=['user', 'type', 'value'], name='promo_user_best_idx'),
+            # Codes saved since the last sync of the Bloom filter, see promo_codes.bloom.
+            models.Index(fields=['updated'], name='promo_updated_idx'),
+        ]
+
     def __str__(self):
         return "Promo Code: " + self.code
 
@@ -119,8 +164,259 @@ class ClaimedPromoCode(models.Model):
                                       help_text=_("How much did the user pay"),
                                       verbose_name=_("Total Price"))
 
+    # No constraints in the database: MySQL doesn't allow foreign keys on the partitioned table, see
+    # promo_codes.partitions.  The deletes still cascade through Django.
+    promoCode = models.ForeignKey('PromoCode', on_delete=models.CASCADE, db_constraint=False)
+    user = models.ForeignKey(user, on_delete=models.CASCADE, db_constraint=False)
+
+    class Meta:
+        # All of them end with the listing order of ClaimedPromoCodePagination, see get_redeemed_queryset.
+        indexes = [
+            models.Index(fields=['promoCode', 'user', 'redeemed'], name='claim_code_user_idx'),
+            models.Index(fields=['promoCode', 'redeemed'], name='claim_code_redeemed_idx'),
+            models.Index(fields=['user', 'redeemed'], name='claim_user_redeemed_idx'),
+            models.Index(fields=['redeemed', 'id'], name='claim_redeemed_idx'),
+        ]
+
+    def __str__(self):
+        return "Promo Code Redeem Number: " + str(self.id)
+
+
+class PromoCodeUsage(models.Model):
+    """
+    Per user redemption counter of a Promo Code, so the repeat check doesn't have to count the ClaimedPromoCodes.
+    """
+
+    used = models.IntegerField(default=0,
+                               help_text=_("How many times the user claimed this Promo Code"),
+                               verbose_name=_("Used"))
+
     promoCode = models.ForeignKey('PromoCode', on_delete=models.CASCADE)
     user = models.ForeignKey(user, on_delete=models.CASCADE)
 
+    class Meta:
+        unique_together = ('promoCode', 'user')
+
     def __str__(self):
-        return "Promo Code Redeem Number: " + str(self.id)
+        return "Promo Code Usage: " + str(self.promoCode_id) + " by " + str(self.user_id)
+
+
+class PromoCodeLease(models.Model):
+    """
+    A block of the quota of a Promo Code held in memory by one app worker, see promo_codes.leases.
+    """
+
+    created = models.DateTimeField(auto_now_add=True, help_text=_("Creation Time"), verbose_name=_("Creation Time"))
+
+    expires = models.DateTimeField(help_text=_("When the worker has to give it back"), verbose_name=_("Expire Time"))
+
+    size = models.IntegerField(help_text=_("How many slots were leased"), verbose_name=_("Size"))
+
+    worker = models.CharField(max_length=64, help_text=_("Host and process holding the lease"),
+                              verbose_name=_("Worker"))
+
+    promoCode = models.ForeignKey('PromoCode', on_delete=models.CASCADE)
+
+    def __str__(self):
+        return "Promo Code Lease: " + str(self.id)
+
+
+class RedemptionRollup(models.Model):
+    """
+    Claims of a Promo Code per day, company, type of payment and service, kept up to date by promo_codes.rollups so the
+    stats don't have to scan the ClaimedPromoCodes.
+    """
+
+    day = models.DateField(help_text=_("Redeem Day"), verbose_name=_("Day"))
+
+    typeOfPayment = models.CharField(max_length=16, help_text=_("Cash or Visa"), verbose_name=_("Type of payment"))
+
+    company = models.CharField(max_length=64, help_text=_("Name of the business Company"), verbose_name=_("Company"))
+
+    service = models.CharField(max_length=64, help_text=_("Name of the service"), verbose_name=_("Service"))
+
+    count = models.IntegerField(default=0, help_text=_("How many claims"), verbose_name=_("Count"))
+
+    total_price = models.DecimalField(default=0, max_digits=16, decimal_places=2,
+                                      help_text=_("Sum of what the users paid"),
+                                      verbose_name=_("Total Price"))
+
+    # Rollups outlive their Promo Code when it's archived, see promo_codes.archive.
+    promoCode = models.ForeignKey('PromoCode', on_delete=models.DO_NOTHING, db_constraint=False)
+
+    class Meta:
+        unique_together = ('day', 'promoCode', 'company', 'typeOfPayment', 'service')
+
+    def __str__(self):
+        return "Redemption Rollup: " + str(self.day) + " " + str(self.promoCode_id)
+
+
+class PromoCodeTrigram(models.Model):
+    """
+    Three character slices of the lower case codes, the index behind the substring code search of promo_codes.search.
+    """
+
+    trigram = models.CharField(max_length=3, help_text=_("Three characters of the code"), verbose_name=_("Trigram"))
+
+    promoCode = models.ForeignKey('PromoCode', on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('trigram', 'promoCode')
+
+    def __str__(self):
+        return "Promo Code Trigram: " + self.trigram
+
+
+class IdempotencyKey(models.Model):
+    """
+    The response a redeem gave for an Idempotency-Key, stored with the claim so a retry replays it, see
+    promo_codes.idempotency.
+    """
+
+    created = models.DateTimeField(auto_now_add=True, help_text=_("Creation Time"), verbose_name=_("Creation Time"))
+
+    key = models.CharField(max_length=64, help_text=_("Idempotency-Key header of the request"),
+                           verbose_name=_("Key"))
+
+    status = models.IntegerField(help_text=_("Status of the response"), verbose_name=_("Status"))
+
+    response = models.JSONField(encoder=DjangoJSONEncoder, help_text=_("Data of the response"),
+                                verbose_name=_("Response"))
+
+    promoCode = models.ForeignKey('PromoCode', on_delete=models.CASCADE)
+    user = models.ForeignKey(user, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('user', 'key')
+        indexes = [
+            models.Index(fields=['created'], name='idempotency_created_idx'),
+        ]
+
+    def __str__(self):
+        return "Idempotency Key: " + self.key
+
+
+class ChangeEvent(models.Model):
+    """
+    A change of a Promo Code or a claim, appended in the transaction making it, see promo_codes.changes.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+
+    created = models.DateTimeField(auto_now_add=True, help_text=_("Creation Time"), verbose_name=_("Creation Time"))
+
+    kind = models.CharField(max_length=32, choices=CHANGE_KINDS, help_text=_("What changed"), verbose_name=_("Kind"))
+
+    object_id = models.IntegerField(help_text=_("Id of the Promo Code or claim"), verbose_name=_("Object Id"))
+
+    # Given once committed, in commit order, by promo_codes.changes.publish.
+    position = models.BigIntegerField(blank=True, null=True, unique=True, help_text=_("Position in the change feed"),
+                                      verbose_name=_("Position"))
+
+    data = models.JSONField(encoder=DjangoJSONEncoder, help_text=_("The fields of the object"),
+                            verbose_name=_("Data"))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created'], name='change_created_idx'),
+        ]
+
+    def __str__(self):
+        return "Change Event: %s %s" % (self.kind, self.object_id)
+
+
+class ChangeFeed(models.Model):
+    """
+    The last position given to a ChangeEvent.  Its single row is locked while positions are given, see
+    promo_codes.changes.
+    """
+
+    position = models.BigIntegerField(default=0, help_text=_("Last position given"), verbose_name=_("Position"))
+
+    def __str__(self):
+        return "Change Feed: %d" % self.position
+
+
+class ArchivedPromoCode(models.Model):
+    """
+    A PromoCode moved out of the hot table some days after it expired, by promo_codes.archive.  It keeps its id.
+    """
+
+    id = models.IntegerField(primary_key=True, verbose_name=_("ID"))
+
+    archived = models.DateTimeField(auto_now_add=True, help_text=_("Archive Time"), verbose_name=_("Archive Time"))
+
+    created = models.DateTimeField(help_text=_("Creation Time"), verbose_name=_("Creation Time"))
+
+    updated = models.DateTimeField(help_text=_("Update Time"), verbose_name=_("Update Time"))
+
+    code = models.CharField(max_length=64, help_text=_("The unique promo code"), verbose_name=_("Promo Code"))
+
+    # Not unique: the code can be reused by a new Promo Code once this one is archived.
+    code_l = models.CharField(max_length=64, db_index=True, help_text=_("Lower Case Promo Code"),
+                              verbose_name=_("Lower Case Promo Code"))
+
+    type = models.CharField(max_length=16, choices=PROMO_TYPES, help_text=_("Percentage or a value."),
+                            verbose_name=_("Type"))
+
+    expires = models.DateTimeField(blank=True, null=True, help_text=_("When it expired"),
+                                   verbose_name=_("Expire Time"))
+
+    value = models.DecimalField(default=0.0, max_digits=10, decimal_places=2, help_text=_("Promo Code Value"),
+                                verbose_name=_("Promo Code Value"))
+
+    bound = models.BooleanField(default=False, help_text=_("Is this Promo Code bound to a specific user?"),
+                                verbose_name=_("Bound to user"))
+
+    user = models.ForeignKey(user, blank=True, null=True, on_delete=models.CASCADE,
+                             help_text=_("Which User is it bounded to?"), verbose_name=_("User"))
+
+    repeat = models.IntegerField(default=0, help_text=_("How many times this Promo Code could be used"),
+                                 verbose_name=_("Repeat"))
+
+    used = models.IntegerField(default=0, help_text=_("How many times this Promo Code was claimed in total"),
+                               verbose_name=_("Used"))
+
+    quota = models.IntegerField(default=0, help_text=_("How many times this Promo Code could be used by everyone"),
+                                verbose_name=_("Quota"))
+
+    def __str__(self):
+        return "Archived Promo Code: " + self.code
+
+
+class ArchivedClaimedPromoCode(models.Model):
+    """
+    A ClaimedPromoCode of an ArchivedPromoCode, it keeps its id.
+    """
+
+    id = models.IntegerField(primary_key=True, verbose_name=_("ID"))
+
+    redeemed = models.DateTimeField(help_text=_("Redeem Time"), verbose_name=_("Redeem"))
+
+    typeOfPayment = models.CharField(default="Cash", max_length=16, choices=TRANSACTION_TYPES,
+                                     help_text=_("Cash or Visa"), verbose_name=_("Type of payment"))
+
+    company = models.CharField(default="", max_length=64, help_text=_("Name of the business Company"),
+                               verbose_name=_("Company"))
+
+    item = models.CharField(default="", max_length=64, help_text=_("What type of item"), verbose_name=_("Item"))
+
+    service = models.CharField(default="", max_length=64, help_text=_("Name of the service"),
+                               verbose_name=_("Service"))
+
+    total_price = models.DecimalField(default=0.0, max_digits=10, decimal_places=2,
+                                      help_text=_("How much did the user pay"), verbose_name=_("Total Price"))
+
+    promoCode = models.ForeignKey('ArchivedPromoCode', on_delete=models.CASCADE)
+    user = models.ForeignKey(user, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['promoCode', 'user', 'redeemed'], name='archived_claim_code_user_idx'),
+            models.Index(fields=['promoCode', 'redeemed'], name='archived_claim_code_idx'),
+            models.Index(fields=['user', 'redeemed'], name='archived_claim_user_idx'),
+            models.Index(fields=['redeemed', 'id'], name='archived_claim_redeemed_idx'),
+        ]
+
+    def __str__(self):
+        return "Archived Claimed Promo Code: " + str(self.id)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on a unique ordering, e.g. ('-created', '-id').  A page is a range scan starting right after
+    the last row of the previous page, so deep pages cost the same as the first and nothing is counted.
+
+    The body stays the plain list of results, the cursor of the next page is sent in a Link header.
+    """
+
+    ordering = ('-id',)
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        page_size = getattr(settings, 'PROMO_PAGE_SIZE', 100)
+
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            pass
+
+        return max(1, min(page_size, getattr(settings, 'PROMO_MAX_PAGE_SIZE', 1000)))
+
+    @staticmethod
+    def value(row, name):
+        # Rows are model instances, or dicts when the queryset is a values() one.
+        return row[name] if isinstance(row, dict) else getattr(row, name)
+
+    def encode_cursor(self, row):
+        values = [str(self.value(row, f.lstrip('-'))) for f in self.ordering]
+
+        return urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, queryset, cursor):
+        try:
+            values = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            if len(values) != len(self.ordering):
+                raise ValueError
+            fields = [queryset.model._meta.get_field(f.lstrip('-')) for f in self.ordering]
+
+            return [f.to_python(v) for f, v in zip(fields, values)]
+        except (TypeError, ValueError, ValidationError, UnicodeError):
+            raise NotFound("Invalid cursor")
+
+    def after(self, values):
+        """
+        Build the keyset condition: (a, b) after (x, y) is a > x or (a == x and b > y), reversed for descending fields.
+        """
+
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = '%s__lt' % name if field.startswith('-') else '%s__gt' % name
+            condition |= Q(**dict(equal, **{lookup: value}))
+            equal[name] = value
+
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_querysets([queryset], request, view=view)
+
+    def paginate_querysets(self, querysets, request, view=None):
+        """
+        One page of the rows of all the querysets together, e.g. of a table and its archive: every queryset gives its
+        own next page_size + 1 rows, and the page is the first ones of them all.
+        """
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+
+        results = []
+        for queryset in querysets:
+            queryset = queryset.order_by(*self.ordering)
+            if cursor:
+                queryset = queryset.filter(self.after(self.decode_cursor(queryset, cursor)))
+            results.extend(queryset[:page_size + 1])
+
+        if len(querysets) > 1:
+            for field in reversed(self.ordering):
+                results.sort(key=lambda row: self.value(row, field.lstrip('-')), reverse=field.startswith('-'))
+
+        self.next_cursor = self.encode_cursor(results[page_size - 1]) if len(results) > page_size else None
+
+        return results[:page_size]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        headers = {}
+        if self.next_cursor is not None:
+            headers['Link'] = '<%s>; rel="next"' % self.get_next_link()
+
+        return Response(data, headers=headers)
+
+
+class PromoCodePagination(KeysetPagination):
+    ordering = ('-created', '-id')
+
+
+class ClaimedPromoCodePagination(KeysetPagination):
+    ordering = ('-redeemed', '-id')
+
+
+class ChangeFeedPagination(KeysetPagination):
+    """
+    The change feed, in position order from ?after=, the position of the last event the consumer saw, ?limit= events
+    at a time.
+    The Link header always carries the next cursor, the same one on an empty page: a consumer polls it until new
+    events show up.
+    """
+
+    ordering = ('position',)
+    cursor_query_param = 'after'
+    page_size_query_param = 'limit'
+
+    def encode_cursor(self, row):
+        return str(self.value(row, 'position'))
+
+    def decode_cursor(self, queryset, cursor):
+        try:
+            return [int(cursor)]
+        except ValueError:
+            raise NotFound("Invalid cursor")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+
+        queryset = queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self.after(self.decode_cursor(queryset, cursor)))
+        results = list(queryset[:page_size])
+
+        self.next_cursor = self.encode_cursor(results[-1]) if results else cursor or '0'
+
+        return results
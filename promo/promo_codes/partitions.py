@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils.timezone import now
+
+# Monthly range partitioning of the claims on redeemed, MySQL only: the other databases keep one table.  The months are
+# UTC ones, like the stored times.  Every partition is named after its month (p202008) and holds the claims redeemed
+# before the first day of the next one, the last partition (pmax) takes everything after the newest month.
+#
+# MySQL wants the partitioning column in every unique key, so the primary key is (id, redeemed), and partitioned
+# tables can't have foreign keys, so ClaimedPromoCode has none in the database.
+
+TABLE = 'promo_codes_claimedpromocode'
+MAX_PARTITION = 'pmax'
+
+
+def supported(using=None):
+    return (using or connection).vendor == 'mysql'
+
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def month_of(value):
+    return date(value.year, value.month, 1)
+
+
+def partition_name(month):
+    return 'p%04d%02d' % (month.year, month.month)
+
+
+def partition_month(name):
+    """
+    The month of a partition from its name, None for pmax.
+    """
+
+    if name == MAX_PARTITION:
+        return None
+
+    return date(int(name[1:5]), int(name[5:7]), 1)
+
+
+def partition_definitions(first, last):
+    """
+    The partitions of the months from first to last, and pmax.
+    """
+
+    definitions = []
+    month = first
+    while month <= last:
+        definitions.append("PARTITION %s VALUES LESS THAN ('%s')" % (partition_name(month), add_months(month, 1)))
+        month = add_months(month, 1)
+    definitions.append("PARTITION %s VALUES LESS THAN (MAXVALUE)" % MAX_PARTITION)
+
+    return ', '.join(definitions)
+
+
+def partition_table(cursor, ahead):
+    """
+    Partition the table, from the month of its oldest claim to ahead months from now.  MySQL copies the whole table,
+    on a big one run the same statements through an online schema change tool instead.
+    """
+
+    cursor.execute('SELECT MIN(redeemed) FROM %s' % TABLE)
+    oldest = cursor.fetchone()[0]
+    current = month_of(now())
+    first = month_of(oldest) if oldest is not None else current
+
+    cursor.execute('ALTER TABLE %s DROP PRIMARY KEY, ADD PRIMARY KEY (id, redeemed)' % TABLE)
+    cursor.execute('ALTER TABLE %s PARTITION BY RANGE COLUMNS(redeemed) (%s)' % (
+        TABLE, partition_definitions(first, add_months(current, ahead))))
+
+
+def unpartition_table(cursor):
+    cursor.execute('ALTER TABLE %s REMOVE PARTITIONING' % TABLE)
+    cursor.execute('ALTER TABLE %s DROP PRIMARY KEY, ADD PRIMARY KEY (id)' % TABLE)
+
+
+def partitions(cursor):
+    """
+    The names of the partitions of the table, oldest first.
+    """
+
+    cursor.execute('SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+                   'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL '
+                   'ORDER BY PARTITION_ORDINAL_POSITION', [TABLE])
+
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_partitions(ahead):
+    """
+    Split pmax so there are partitions up to ahead months from now.  Cheap as long as pmax is empty, so run it before
+    the months come.  Returns the names of the new partitions.
+    """
+
+    with connection.cursor() as cursor:
+        months = [m for m in map(partition_month, partitions(cursor)) if m is not None]
+        if not months:
+            raise ValueError("%s has no monthly partitions, it wasn't partitioned by migration 0016." % TABLE)
+        first = add_months(months[-1], 1)
+        last = add_months(month_of(now()), ahead)
+        if first > last:
+            return []
+
+        cursor.execute('ALTER TABLE %s REORGANIZE PARTITION %s INTO (%s)' % (
+            TABLE, MAX_PARTITION, partition_definitions(first, last)))
+
+    names = []
+    while first <= last:
+        names.append(partition_name(first))
+        first = add_months(first, 1)
+
+    return names
+
+
+def drop_partitions(before, detach=False):
+    """
+    Drop the partitions of the months before the before one, which drops their claims at once.  With detach their
+    claims are first swapped into a table of their own, e.g. promo_codes_claimedpromocode_p202008, to be archived
+    or dropped later.  Returns the names of the dropped partitions.
+
+    The claims dropped must be older than PROMO_ARCHIVE_AFTER_DAYS, a month still in the window is refused.  Older
+    ones are history, as in the archive: the usage counters and the rollups keep counting them, and the change feed
+    gets no claim.deleted for them.
+    """
+
+    newest = (now() - timedelta(days=getattr(settings, 'PROMO_ARCHIVE_AFTER_DAYS', 90))).date()
+    if month_of(before) > newest:
+        raise ValueError("Only the claims redeemed before %s can be dropped, keep more months." % newest)
+
+    with connection.cursor() as cursor:
+        names = [name for name in partitions(cursor)
+                 if partition_month(name) is not None and partition_month(name) < month_of(before)]
+
+        for name in names:
+            if detach:
+                detached = '%s_%s' % (TABLE, name)
+                cursor.execute('CREATE TABLE %s LIKE %s' % (detached, TABLE))
+                cursor.execute('ALTER TABLE %s REMOVE PARTITIONING' % detached)
+                cursor.execute('ALTER TABLE %s EXCHANGE PARTITION %s WITH TABLE %s' % (TABLE, name, detached))
+            cursor.execute('ALTER TABLE %s DROP PARTITION %s' % (TABLE, name))
+
+    return names
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.utils.timezone import now
+
+from promo_codes.cache import get_many
+from promo_codes.leases import uses_lease
+from promo_codes.models import PromoCodeUsage
+
+# Discount quotes, what a Promo Code would take off an amount, without redeeming it.  A percent Promo Code takes value
+# times the amount (value is 1.0 at most, see PromoCodeSerializer.validate), a value one takes its value, never more
+# than the amount.  Amounts are rounded half up to the cent.
+
+CENT = Decimal('0.01')
+ONE = Decimal(1)
+
+NOT_FOUND = "Promo Code not found."
+THROTTLED = "Not looked up, too many Promo Codes weren't found lately."
+
+
+def discount(promoCode, amount):
+    if promoCode.type == 'percent':
+        discount = amount * min(promoCode.value, ONE)
+    else:
+        discount = min(promoCode.value, amount)
+
+    return discount.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def check(promoCode, user, used, current=None):
+    """
+    Why the user can't redeem the Promo Code they used used times, None when they can.  The checks of
+    ClaimedPromoCodeSerializer.validate.
+    """
+
+    if promoCode.expires and promoCode.expires < (current or now()):
+        return "Promo Code has expired."
+
+    if promoCode.bound and promoCode.user_id != user.id:
+        return "Promo Code bound to another user."
+
+    if promoCode.repeat > 0 and used >= promoCode.repeat:
+        return "Promo Code has been used to its limit."
+
+    if promoCode.quota > 0 and not uses_lease(promoCode) and promoCode.reserved >= promoCode.quota:
+        return "Promo Code has been used to its limit."
+
+    return None
+
+
+def _amount(value):
+    return '{:f}'.format(value)
+
+
+def quoted(promoCode, amount):
+    """
+    The result of a Promo Code the user can redeem on amount.
+    """
+
+    off = discount(promoCode, amount)
+
+    return {
+        'status': 'quoted',
+        'promoCode': promoCode.id,
+        'code': promoCode.code,
+        'type': promoCode.type,
+        'amount': _amount(amount),
+        'discount': _amount(off),
+        'total': _amount(amount - off),
+    }
+
+
+def quote(items, user):
+    """
+    Quote every item, a validated QuoteItemSerializer dict, for the user.  The Promo Codes come from the lookup cache
+    and the usage of the user from one query.  Returns one result per item, and how many Promo Codes weren't found.
+    """
+
+    by_pk, by_code = get_many(pks={i['promoCode'] for i in items if 'promoCode' in i},
+                              codes={i['code'] for i in items if 'code' in i})
+    promoCodes = [by_pk.get(i['promoCode']) if 'promoCode' in i else by_code.get(i['code'].lower()) for i in items]
+
+    used = {}
+    limited = {p.id for p in promoCodes if p is not None and p.repeat > 0}
+    if limited and user.is_authenticated:
+        used = dict(PromoCodeUsage.objects.filter(user=user.id, promoCode__in=limited)
+                    .values_list('promoCode', 'used'))
+
+    current = now()
+    results = []
+    misses = 0
+    for item, promoCode in zip(items, promoCodes):
+        if promoCode is None:
+            misses += 1
+            results.append({'status': 'rejected', 'errors': {'non_field_errors': [NOT_FOUND]}})
+            continue
+
+        error = check(promoCode, user, used.get(promoCode.id, 0), current)
+        if error is not None:
+            results.append({'status': 'rejected', 'promoCode': promoCode.id,
+                            'errors': {'non_field_errors': [error]}})
+            continue
+
+        results.append(quoted(promoCode, item['amount']))
+
+    return results, misses
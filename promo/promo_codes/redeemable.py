@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+
+from promo_codes.cache import shared
+from promo_codes.models import PromoCode, PromoCodeUsage
+
+# The Promo Codes a user can still redeem, with the rules of ClaimedPromoCodeSerializer.validate in one query.  The
+# pages are cached per user under a version which every redeem or un-redeem of that user bumps.
+
+
+def redeemable_queryset(user):
+    """
+    The Promo Codes the user can redeem now, annotated with remaining, how many more times (None for unlimited).
+    Codes taking their quota from leases are kept, whatever the workers still hold isn't in the table.
+    """
+
+    used = PromoCodeUsage.objects.filter(promoCode=OuterRef('pk'), user=user.id).values('used')[:1]
+
+    return PromoCode.objects \
+        .filter(Q(bound=False) | Q(user=user.id)) \
+        .filter(Q(expires__isnull=True) | Q(expires__gt=now())) \
+        .filter(Q(quota=0) | Q(reserved__lt=F('quota')) | Q(lease_size__gt=0)) \
+        .annotate(used_by_user=Coalesce(Subquery(used), Value(0))) \
+        .filter(Q(repeat=0) | Q(used_by_user__lt=F('repeat'))) \
+        .annotate(remaining=Case(When(repeat=0, then=None), default=F('repeat') - F('used_by_user'),
+                                 output_field=IntegerField()))
+
+
+def _version_key(user_id):
+    return 'redeemable:version:%s' % user_id
+
+
+def version(user_id):
+    version = shared().get(_version_key(user_id))
+    if version is None:
+        # Never reuse the versions of entries which may still be cached.
+        shared().add(_version_key(user_id), int(time.time() * 1000), None)
+        version = shared().get(_version_key(user_id))
+
+    return version
+
+
+def _bump(user_id):
+    try:
+        shared().incr(_version_key(user_id))
+    except ValueError:
+        pass
+
+
+def changed(user_id):
+    """
+    Drop the cached pages of the user, whose claims changed.  Again on commit, a page may be cached in between.
+    """
+
+    _bump(user_id)
+    transaction.on_commit(lambda: _bump(user_id))
+
+
+def page_key(request):
+    query = hashlib.md5(request.META.get('QUERY_STRING', '').encode('utf-8')).hexdigest()
+
+    return 'redeemable:%s:%s:%s' % (request.user.id, version(request.user.id), query)
+
+
+def page_timeout(rows):
+    """
+    Never keep a page past the expiry of one of its Promo Codes.
+    """
+
+    timeout = getattr(settings, 'PROMO_REDEEMABLE_CACHE_TIMEOUT', 60)
+    for row in rows:
+        if row['expires'] is not None:
+            timeout = min(timeout, (row['expires'] - now()).total_seconds())
+
+    return int(timeout)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# The GET requests of the views in PROMO_REPLICA_VIEWS read from one of the PROMO_READ_REPLICAS, everything else, the
+# redeem validation included, reads and writes the primary (default).  A client which wrote is sent a cookie pinning
+# it to the primary for PROMO_PRIMARY_STICKINESS seconds, so it reads its own writes despite the replication lag.
+# API clients which don't keep cookies don't get that: they send the HEADER (any value) on the reads which must see
+# their writes instead.
+
+REPLICA_VIEWS = (
+    'promocode-list', 'promocode-detail', 'promocode-redeemed',
+    'redeemed-list', 'redeemed-detail', 'redeemed-export', 'redeemed-stats',
+    'async-promocode-detail', 'async-promocode-redeemed',
+)
+
+COOKIE = 'promo_primary'
+HEADER = 'HTTP_X_PROMO_PRIMARY'
+
+
+class _State(object):
+    """
+    Whether the request may read from a replica, and whether it wrote.
+    """
+
+    def __init__(self, replica=False):
+        self.replica = replica
+        self.wrote = False
+
+
+# The state of the request being served.  A context variable rather than a thread local: under ASGI the requests
+# share threads, and asgiref carries the context into the sync code of an async view.  The state is one object
+# mutated in place, so what the router sees in the sync code is seen by the middleware too.
+_state = ContextVar('promo_replica_state', default=None)
+
+
+def stream(iterable):
+    """
+    Keep the routing of the request while the body of a streaming response is iterated, the middleware is done by
+    then.
+    """
+
+    state = _state.get()
+    replica = state is not None and state.replica
+
+    def streamed():
+        _state.set(_State(replica=replica))
+        try:
+            yield from iterable
+        finally:
+            _state.set(None)
+
+    return streamed()
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'PROMO_READ_REPLICAS', ())
+        state = _state.get()
+
+        # A transaction on the primary reads what it wrote, e.g. the rows it locked.
+        if state is None or not state.replica or not replicas or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.replica = False
+            state.wrote = True
+
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary.
+        return True
+
+
+class ReplicaMiddleware(object):
+    """
+    Let the reads of the request go to the replicas, unless it isn't one of PROMO_REPLICA_VIEWS or the client is pinned.
+    Keep it before the session middleware, to see the writes of the session too.  Sync and async capable, like
+    MetricsMiddleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            self.process_view = self._process_view_async
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._call_async(request)
+
+        state = _State()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+
+        return self._pin(state, response)
+
+    async def _call_async(self, request):
+        state = _State()
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+
+        return self._pin(state, response)
+
+    def _pin(self, state, response):
+        if state.wrote:
+            response.set_cookie(COOKIE, '1', max_age=getattr(settings, 'PROMO_PRIMARY_STICKINESS', 5),
+                                httponly=True, samesite='Lax')
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _state.get().replica = request.method in ('GET', 'HEAD') and COOKIE not in request.COOKIES and \
+            HEADER not in request.META and \
+            request.resolver_match.url_name in getattr(settings, 'PROMO_REPLICA_VIEWS', REPLICA_VIEWS)
+
+    async def _process_view_async(self, request, view_func, view_args, view_kwargs):
+        ReplicaMiddleware.process_view(self, request, view_func, view_args, view_kwargs)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+from datetime import datetime, time
+from decimal import Decimal
+from itertools import chain
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils.timezone import localdate, make_aware
+
+from promo_codes import changes
+from promo_codes.models import ClaimedPromoCode, ArchivedClaimedPromoCode, RedemptionRollup
+
+GROUP_FIELDS = ('day', 'promoCode', 'company', 'typeOfPayment', 'service')
+
+
+def record_claims(claims, sign=1):
+    """
+    Add the claims to their rollups, or take them out with sign=-1 when they are un-redeemed.  Must be called inside
+    the transaction writing or deleting the claims.
+    """
+
+    groups = defaultdict(lambda: [0, Decimal('0')])
+    for claim in claims:
+        group = groups[(localdate(claim.redeemed), claim.promoCode_id, claim.company, claim.typeOfPayment,
+                        claim.service)]
+        group[0] += 1
+        group[1] += Decimal(str(claim.total_price))
+
+    for (day, promoCode_id, company, typeOfPayment, service), (count, total_price) in groups.items():
+        qs = RedemptionRollup.objects.filter(day=day, promoCode=promoCode_id, company=company,
+                                             typeOfPayment=typeOfPayment, service=service)
+        changes = {'count': F('count') + sign * count, 'total_price': F('total_price') + sign * total_price}
+        if qs.update(**changes):
+            continue
+
+        try:
+            with transaction.atomic():
+                RedemptionRollup.objects.create(day=day, promoCode_id=promoCode_id, company=company,
+                                                typeOfPayment=typeOfPayment, service=service,
+                                                count=sign * count, total_price=sign * total_price)
+        except IntegrityError:
+            # Inserted concurrently.
+            qs.update(**changes)
+
+
+def backfill(since=None):
+    """
+    Rebuild the rollups from the claims, all of them or from the since day on.  Returns how many rollups were written.
+    """
+
+    rollups = RedemptionRollup.objects.all()
+    if since is not None:
+        rollups = rollups.filter(day__gte=since)
+
+    # A Promo Code is archived with all its claims, so the groups of the two tables never overlap.
+    groups = []
+    for claims in (ClaimedPromoCode.objects.all(), ArchivedClaimedPromoCode.objects.all()):
+        if since is not None:
+            # A range on redeemed rather than on its date, so MySQL can skip the older partitions.
+            claims = claims.filter(redeemed__gte=make_aware(datetime.combine(since, time.min)))
+        groups.append(claims.annotate(day=TruncDate('redeemed')).values(*GROUP_FIELDS)
+                      .annotate(count=Count('id'), total_price=Sum('total_price')).order_by())
+
+    with transaction.atomic():
+        rollups.delete()
+        created = RedemptionRollup.objects.bulk_create(
+            (RedemptionRollup(day=g['day'], promoCode_id=g['promoCode'], company=g['company'],
+                              typeOfPayment=g['typeOfPayment'], service=g['service'], count=g['count'],
+                              total_price=g['total_price'] or 0) for g in chain(*(q.iterator() for q in groups))),
+            batch_size=1000)
+
+    return len(created)
+
+
+def stats(group_by, **filters):
+    """
+    Sum the rollups matching the filters, grouped by some of GROUP_FIELDS.
+    """
+
+    qs = RedemptionRollup.objects.filter(**filters)
+    if not group_by:
+        total = qs.aggregate(count=Sum('count'), total_price=Sum('total_price'))
+        return [{'count': total['count'] or 0, 'total_price': total['total_price'] or 0}]
+
+    return list(qs.values(*group_by).annotate(count=Sum('count'), total_price=Sum('total_price'))
+                .order_by(*group_by))
+
+
+@receiver(pre_delete, sender=ClaimedPromoCode)
+def forget_claim(sender, instance, **kwargs):
+    """
+    Sent for each deleted claim, whatever deletes it: un-redeemed, or gone on delete cascade with its Promo Code or
+    one of their users.  Takes it out of its rollup and into the change feed, inside the transaction of the delete.
+    """
+
+    if not changes.is_archiving():
+        record_claims([instance], sign=-1)
+        changes.record(changes.CLAIM_DELETED, [instance])
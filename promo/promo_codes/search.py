@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from promo_codes.models import PromoCode, PromoCodeTrigram
+
+# Upper bound of the code_l range a prefix covers.
+PREFIX_END = '\uffff'
+
+
+def substring_enabled():
+    return getattr(settings, 'PROMO_CODE_SUBSTRING_SEARCH', True)
+
+
+def trigrams(code_l):
+    return {code_l[i:i + 3] for i in range(len(code_l) - 2)}
+
+
+def index_codes(promoCodes, new=False):
+    """
+    (Re)build the trigrams of the Promo Codes, which must have an id.  New ones have none to delete first.
+    """
+
+    if not substring_enabled():
+        return
+
+    # A code has a dozen or more trigrams, so they are inserted as plain rows: building a model instance for each
+    # made bulk_create the most of the time of generate_codes.
+    meta = PromoCodeTrigram._meta
+    sql = 'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % tuple(map(connection.ops.quote_name, (
+        meta.db_table, meta.get_field('trigram').column, meta.get_field('promoCode').column)))
+    rows = [(t, p.id) for p in promoCodes for t in trigrams(p.code_l)]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if not new:
+            PromoCodeTrigram.objects.filter(promoCode__in=[p.id for p in promoCodes]).delete()
+        for i in range(0, len(rows), 1000):
+            cursor.executemany(sql, rows[i:i + 1000])
+
+
+def prefix_search(queryset, term):
+    """
+    Codes starting with term, as a range on the code_l unique index, which works whatever the collation.
+    """
+
+    term = term.lower()
+
+    return queryset.filter(code_l__gte=term, code_l__lt=term + PREFIX_END)
+
+
+def substring_search(queryset, term):
+    """
+    Codes containing term.  The candidates having all its trigrams come from the trigram index in a subquery, so the
+    visibility filters, the substring check and the pagination of the caller all apply to them.  Terms shorter than a
+    trigram fall back to the prefix search.
+
+    A term of common trigrams matches the postings of most codes, so the candidates are cut to the newest
+    PROMO_SEARCH_MAX_CANDIDATES, the first pages of the -id pagination: the older matches of such a term aren't found,
+    refine it to reach them.
+    """
+
+    term = term.lower()
+    grams = trigrams(term)
+    if not grams or not substring_enabled():
+        return prefix_search(queryset, term)
+
+    candidates = PromoCodeTrigram.objects.filter(trigram__in=grams).values('promoCode') \
+        .annotate(matched=Count('trigram')).filter(matched=len(grams)).order_by('-promoCode').values('promoCode')
+    candidates = candidates[:getattr(settings, 'PROMO_SEARCH_MAX_CANDIDATES', 10000)]
+    if not connection.features.allow_sliced_subqueries_with_in:
+        # MySQL has no LIMIT in an IN subquery.
+        candidates = list(candidates.values_list('promoCode', flat=True))
+
+    return queryset.filter(pk__in=candidates, code_l__contains=term)
+
+
+@receiver(post_save, sender=PromoCode)
+def index_promocode(sender, instance, created, update_fields=None, **kwargs):
+    # The code before the save is kept by cache.remember_code, its trigrams only change with it.
+    if not created and (update_fields is not None and 'code_l' not in update_fields
+                        or getattr(instance, '_cached_code_l', None) == instance.code_l):
+        return
+
+    index_codes([instance], new=created)
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 
 from django.apps import apps
+from django.db import transaction
 from django.utils.timezone import now
 from rest_framework import serializers
 
-from promo_codes.models import PromoCode, ClaimedPromoCode
+from promo_codes import changes
+from promo_codes.cache import get_by_pk
+from promo_codes.generate import DEFAULT_ALPHABET
+from promo_codes.leases import holder, uses_lease
+from promo_codes.models import PromoCode, ClaimedPromoCode, PROMO_TYPES, TRANSACTION_TYPES
+from promo_codes.rollups import GROUP_FIELDS, record_claims
+from promo_codes.usage import claim_usage, get_usage
 
 
 class PromoCodeSerializer(serializers.ModelSerializer):
@@ -54,15 +61,74 @@ class PromoCodeSerializer(serializers.ModelSerializer):
 
         return value
 
+    def validate_quota(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Quota field can be 0 for infinite, otherwise must be greater than 0.")
+
+        return value
+
+    def validate_lease_size(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Lease size field can be 0 for no leasing, otherwise must be greater than 0.")
+
+        return value
+
     def create(self, validated_data):
-        return PromoCode.objects.create(**validated_data)
+        with transaction.atomic():
+            promoCode = PromoCode.objects.create(**validated_data)
+            changes.record(changes.PROMOCODE_CREATED, [promoCode])
+
+        return promoCode
+
+    def update(self, instance, validated_data):
+        """
+        Save the edited fields only, a full save would write back the used and reserved counters read before the
+        redeems and leases meanwhile.
+        """
+
+        with transaction.atomic():
+            for attr, value in validated_data.items():
+                setattr(instance, attr, value)
+            instance.save(update_fields=list(validated_data) + ['updated'])
+            instance.refresh_from_db(fields=['used', 'reserved'])
+            changes.record(changes.PROMOCODE_UPDATED, [instance])
+
+        return instance
 
     class Meta:
         model = apps.get_model('promo_codes.PromoCode')
         fields = ('created', 'updated', 'code',
                   'code_l', 'type', 'expires',
                   'bound', 'user', 'repeat',
-                  'value', 'id')
+                  'value', 'id', 'quota', 'lease_size')
+
+
+class RedeemablePromoCodeSerializer(PromoCodeSerializer):
+    """
+    A Promo Code the user can redeem, with how many more times (null for unlimited).
+    """
+
+    remaining = serializers.IntegerField(read_only=True, allow_null=True)
+
+    class Meta(PromoCodeSerializer.Meta):
+        fields = PromoCodeSerializer.Meta.fields + ('remaining',)
+
+
+class CachedPromoCodeField(serializers.PrimaryKeyRelatedField):
+    """
+    Resolve the Promo Code through the lookup cache instead of querying it.
+    """
+
+    def to_internal_value(self, data):
+        try:
+            promoCode = get_by_pk(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+        if promoCode is None:
+            self.fail('does_not_exist', pk_value=data)
+
+        return promoCode
 
 
 class ClaimedPromoCodeSerializer(serializers.ModelSerializer):
@@ -70,6 +136,8 @@ class ClaimedPromoCodeSerializer(serializers.ModelSerializer):
     RW ClaimedCoupon serializer.
     """
 
+    promoCode = CachedPromoCodeField(queryset=PromoCode.objects.all())
+
     def validate(self, data):
         """
         Verify the Promo Code can be redeemed.
@@ -83,11 +151,11 @@ class ClaimedPromoCodeSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Promo Code has expired.")
 
         # Is the Promo Code bound to someone else?
-        if promoCode.bound and promoCode.user.id != user.id:
+        if promoCode.bound and promoCode.user_id != user.id:
             raise serializers.ValidationError("Promo Code bound to another user.")
 
         # Is the Promo Code redeemed already beyond what's allowed?
-        redeemed = ClaimedPromoCode.objects.filter(promoCode=promoCode.id, user=user.id).count()
+        redeemed = get_usage(promoCode, user)
         if promoCode.repeat > 0:
             if redeemed >= promoCode.repeat:
                 # Already too many times (note: we don't update the claimed coupons, so this is a fine test).
@@ -95,9 +163,198 @@ class ClaimedPromoCodeSerializer(serializers.ModelSerializer):
                 # you somehow get beyond that... ;)
                 raise serializers.ValidationError("Promo Code has been used to its limit.")
 
+        # Is the global quota used up?  Leased Promo Codes are checked from memory when claiming.
+        if promoCode.quota > 0 and not uses_lease(promoCode) and promoCode.reserved >= promoCode.quota:
+            raise serializers.ValidationError("Promo Code has been used to its limit.")
+
         return data
 
+    def create(self, validated_data):
+        """
+        Take the usage slot and insert the claim in one transaction, the checks in validate() are only pre-checks.
+        """
+
+        promoCode = validated_data['promoCode']
+
+        # A lease can only be taken outside of any transaction, see LeaseHolder.
+        leased = uses_lease(promoCode) and not transaction.get_connection().in_atomic_block
+        if leased and not holder.take(promoCode):
+            raise serializers.ValidationError({'non_field_errors': ["Promo Code has been used to its limit."]})
+
+        try:
+            with transaction.atomic():
+                if not claim_usage(promoCode, validated_data['user'], leased=leased):
+                    raise serializers.ValidationError({'non_field_errors': ["Promo Code has been used to its limit."]})
+
+                claim = ClaimedPromoCode.objects.create(**validated_data)
+                record_claims([claim])
+                changes.record(changes.CLAIM_CREATED, [claim])
+
+                return claim
+        except Exception:
+            if leased:
+                holder.give_back(promoCode)
+            raise
+
     class Meta:
         model = apps.get_model('promo_codes.ClaimedPromoCode')
         fields = ('redeemed', 'promoCode', 'user', 'id', 'company', 'typeOfPayment',
                   'total_price', 'item', 'service')
+
+
+class ClaimedPromoCodeBatchSerializer(serializers.Serializer):
+    """
+    One item of a batch redeem.  Only the shape is validated here, the Promo Code checks are done by redeem_batch().
+    """
+
+    code = serializers.CharField(max_length=64, required=False)
+    promoCode = serializers.IntegerField(required=False)
+    user = serializers.IntegerField(required=False)
+    company = serializers.CharField(max_length=64, required=False)
+    item = serializers.CharField(max_length=64, required=False)
+    service = serializers.CharField(max_length=64, required=False)
+    typeOfPayment = serializers.ChoiceField(choices=TRANSACTION_TYPES, required=False)
+    total_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+
+    def validate(self, data):
+        """
+        Verify the Promo Code is given, either by its code or its id.
+        """
+
+        if 'code' not in data and 'promoCode' not in data:
+            raise serializers.ValidationError("Either code or promoCode must be specified.")
+
+        return data
+
+
+class QuoteItemSerializer(serializers.Serializer):
+    """
+    One item of a quote, a Promo Code by its code or its id and the amount to discount.
+    """
+
+    code = serializers.CharField(max_length=64, required=False)
+    promoCode = serializers.IntegerField(required=False)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+
+    def validate(self, data):
+        """
+        Verify the Promo Code is given, either by its code or its id.
+        """
+
+        if 'code' not in data and 'promoCode' not in data:
+            raise serializers.ValidationError("Either code or promoCode must be specified.")
+
+        return data
+
+
+class BestPromoCodeSerializer(serializers.Serializer):
+    """
+    Amount of a best Promo Code query.
+    """
+
+    total_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+
+
+class PromoCodeGenerateSerializer(serializers.Serializer):
+    """
+    Parameters of a bulk Promo Code generation, the shared attributes follow the PromoCodeSerializer rules.
+    """
+
+    count = serializers.IntegerField(min_value=1)
+    prefix = serializers.CharField(max_length=32, required=False, default='', allow_blank=True)
+    length = serializers.IntegerField(min_value=4, max_value=64, required=False, default=8)
+    alphabet = serializers.CharField(min_length=2, required=False, default=DEFAULT_ALPHABET)
+    type = serializers.ChoiceField(choices=PROMO_TYPES)
+    value = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, default=0)
+    expires = serializers.DateTimeField(required=False)
+    repeat = serializers.IntegerField(min_value=0, required=False, default=1)
+
+    def validate(self, data):
+        """
+        Verify the codes can fit in the code field, and that the shared attributes are valid.
+        """
+
+        if len(data['prefix']) + data['length'] > PromoCode._meta.get_field('code').max_length:
+            raise serializers.ValidationError("Prefix and length exceed the maximum code length.")
+
+        if len(set(data['alphabet'].lower())) ** data['length'] < data['count'] * 10:
+            raise serializers.ValidationError("Alphabet and length are too small for the requested number of codes.")
+
+        if (data['prefix'] + data['alphabet']).isdigit():
+            raise serializers.ValidationError("Prefix and alphabet can only make codes of digits.")
+
+        if 'expires' in data and data['expires'] < now():
+            raise serializers.ValidationError("Expiration date set incorrect")
+
+        if data['type'] == 'percent' and data['value'] > 1.0:
+            raise serializers.ValidationError("Percentage discount specified greater than 100%.")
+
+        return data
+
+
+class RedeemedWindowSerializer(serializers.Serializer):
+    """
+    Redeem time range of a redeemed listing, it lets MySQL only read the partitions of those months.
+    """
+
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+
+class ClaimedPromoCodeExportSerializer(serializers.Serializer):
+    """
+    Filters of a claims export.
+    """
+
+    output = serializers.ChoiceField(choices=('csv', 'ndjson'), required=False, default='csv')
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    company = serializers.CharField(max_length=64, required=False)
+    service = serializers.CharField(max_length=64, required=False)
+    promoCode = serializers.IntegerField(required=False)
+
+
+class RedemptionStatsSerializer(serializers.Serializer):
+    """
+    Query of the redemption stats, group_by is a comma separated list of day, promoCode, company, typeOfPayment and
+    service.
+    """
+
+    group_by = serializers.CharField(required=False, default='', allow_blank=True)
+    since = serializers.DateField(required=False)
+    until = serializers.DateField(required=False)
+    promoCode = serializers.IntegerField(required=False)
+    company = serializers.CharField(max_length=64, required=False)
+    typeOfPayment = serializers.CharField(max_length=16, required=False)
+    service = serializers.CharField(max_length=64, required=False)
+
+    def validate_group_by(self, value):
+        group_by = [field for field in value.split(',') if field]
+        for field in group_by:
+            if field not in GROUP_FIELDS:
+                raise serializers.ValidationError("Can't group by %s." % field)
+
+        return group_by
+
+
+class RedemptionRollupSerializer(serializers.Serializer):
+    """
+    One row of the redemption stats, only the grouped fields are present.
+    """
+
+    day = serializers.DateField(required=False)
+    promoCode = serializers.IntegerField(required=False)
+    company = serializers.CharField(required=False)
+    typeOfPayment = serializers.CharField(required=False)
+    service = serializers.CharField(required=False)
+    count = serializers.IntegerField()
+    total_price = serializers.DecimalField(max_digits=16, decimal_places=2)
+
+
+class ChangeEventSerializer(serializers.ModelSerializer):
+    # Declared, this DRF maps models.JSONField to a ModelField.
+    data = serializers.JSONField(read_only=True)
+
+    class Meta:
+        model = apps.get_model('promo_codes.ChangeEvent')
+        fields = ('position', 'id', 'created', 'kind', 'object_id', 'data')
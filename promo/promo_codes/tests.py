@@ -1,14 +1,51 @@
 # -*- coding: utf-8 -*-
 
 # Create your tests here.
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from io import StringIO
+from types import SimpleNamespace
+
+from asgiref.sync import SyncToAsync, async_to_sync, sync_to_async
 from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+from django.utils.timezone import localdate, now
 from rest_framework import status
-from datetime import datetime, timedelta
+from rest_framework.renderers import JSONRenderer
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from time import sleep
-from rest_framework.test import APITestCase
-
-
-class BasicTest(APITestCase):
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from promo_codes.archive import archive_expired
+from promo_codes.benchmarks import Benchmark, code, generation, seed
+from promo_codes.best import best_code
+from promo_codes.leases import holder, reclaim_leases
+from promo_codes.models import PromoCode, ClaimedPromoCode, PromoCodeUsage, PromoCodeLease, RedemptionRollup, \
+    PromoCodeTrigram, IdempotencyKey, ArchivedPromoCode, ArchivedClaimedPromoCode, ChangeEvent
+from promo_codes import bloom, cache, changes, idempotency, logs, metrics, partitions, quotes, replicas, throttling
+from promo_codes.generate import generate_codes
+from promo_codes.rollups import backfill, stats
+from promo_codes.search import prefix_search, substring_search
+from promo_codes.serializers import ClaimedPromoCodeSerializer, PromoCodeSerializer
+from promo_codes.usage import claim_usage
+from promo_codes.values import ValuesSerializer
+from promo_codes.views import get_redeemed_queryset
+
+
+class BasicTestMixin(object):
     """
     Generic testing stuff.
     """
@@ -25,6 +62,19 @@ class BasicTest(APITestCase):
         for key in expected:
             self.assertEqual(data[key], expected[key])
 
+    def tearDown(self):
+        # Ids are reused between tests, so don't let a cached Promo Code leak into the next one.
+        cache.local.clear()
+        cache.shared().clear()
+
+
+# The Bloom filter is built in the background, see promocodeBloomTests.
+@override_settings(PROMO_BLOOM_FILTER=False)
+class BasicTest(BasicTestMixin, APITestCase):
+    """
+    Generic testing stuff, each test runs inside a transaction that is rolled back.
+    """
+
 
 class promocodeCreateTests(BasicTest):
 
@@ -380,6 +430,22 @@ class promocodeRedeemTests(BasicTest):
             self.assertEqual(response.status_code, status.HTTP_201_CREATED)
             self.logout()
 
+    def test_update_keeps_counters(self):
+        """
+        Verify an edit doesn't write back the counters it read, the redeems made meanwhile stay counted.
+        """
+
+        promoCode = PromoCode.objects.create(code='Counted', code_l='counted', type='value', value=5, quota=10)
+        stale = PromoCode.objects.get(pk=promoCode.id)
+        PromoCode.objects.filter(pk=promoCode.id).update(used=3, reserved=4)
+
+        serializer = PromoCodeSerializer(stale, data={'code': 'Counted', 'type': 'value', 'value': 7, 'quota': 10})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save()
+
+        promoCode.refresh_from_db()
+        self.assertEqual((Decimal('7'), 3, 4), (promoCode.value, promoCode.used, promoCode.reserved))
+
     def test_can_redeem_beyond_repeat_singleuse_after_promocode_updated(self):
         """
         Verify if the promocode is updated, you can claim it more if they increase the count. :)
@@ -515,3 +581,1970 @@ class promocodeRedeemedTests(BasicTest):
             self.assertEqual(1, len(response.data))
             self.assertEqual(self.user2.id, response.data[0]['user'])
             self.logout()
+
+
+class promocodeUsageTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+    def test_redeem_bumps_usage_counters(self):
+        """
+        Verify redeeming keeps the per user and the per code counters in step with the claims.
+        """
+
+        promocode = {
+            'code': 'Wezaaaa',
+            'type': 'percent',
+            'repeat': 2,
+        }
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode', promocode, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            promocode_id = response.data['id']
+
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.logout()
+
+            self.login(username='user')
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.logout()
+
+            self.assertEqual(2, PromoCode.objects.get(pk=promocode_id).used)
+            self.assertEqual(1, PromoCodeUsage.objects.get(promoCode=promocode_id, user=self.user.id).used)
+
+    def test_unredeem_releases_usage(self):
+        """
+        Verify un-redeeming gives the slot back so it can be claimed again.
+        """
+
+        promocode = {
+            'code': 'Wezaaaa',
+            'type': 'percent',
+            'repeat': 1,
+        }
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode', promocode, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            promocode_id = response.data['id']
+
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            redeemed_id = response.data['id']
+
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            response = self.client.delete('/redeemed/%s' % redeemed_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(0, PromoCode.objects.get(pk=promocode_id).used)
+
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.logout()
+
+    def test_claim_usage_stops_at_limit(self):
+        """
+        Verify the conditional update refuses a claim once the counter reached repeat, whatever validate() saw.
+        """
+
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent', repeat=1)
+
+        self.assertTrue(claim_usage(promoCode, self.user))
+        self.assertFalse(claim_usage(promoCode, self.user))
+        self.assertEqual(1, PromoCodeUsage.objects.get(promoCode=promoCode, user=self.user).used)
+
+
+class promocodeRedeemBatchTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+    def test_can_redeem_batch(self):
+        """
+        Verify a batch redeems what it can and reports each rejected item, respecting repeat within the batch.
+        """
+
+        single = PromoCode.objects.create(code='Single', code_l='single', type='value', value=10, repeat=1)
+        PromoCode.objects.create(code='Bound', code_l='bound', type='percent', bound=True, user=self.user)
+
+        items = [
+            {'code': 'SINGLE', 'user': self.user.id, 'company': 'SWVL', 'total_price': '12.50'},
+            {'promoCode': single.id, 'user': self.user.id},
+            {'promoCode': single.id, 'company': 'UBER'},
+            {'code': 'bound', 'user': self.admin.id},
+            {'code': 'nope'},
+            {'company': 'AUC'},
+        ]
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode/redeem-batch', items, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.logout()
+
+        self.assertEqual(['redeemed', 'rejected', 'redeemed', 'rejected', 'rejected', 'rejected'],
+                         [r['status'] for r in response.data])
+        self.assertEqual('12.50', response.data[0]['claim']['total_price'])
+        self.assertEqual(self.admin.id, response.data[2]['claim']['user'])
+        self.assertEqual(2, ClaimedPromoCode.objects.filter(promoCode=single).count())
+        self.assertEqual(2, PromoCode.objects.get(pk=single.id).used)
+        self.assertEqual(1, PromoCodeUsage.objects.get(promoCode=single, user=self.user).used)
+
+    def test_cant_redeem_batch_not_superuser(self):
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='user')
+            response = self.client.post('/promocode/redeem-batch', [], format='json')
+            self.assertNotEqual(response.status_code, status.HTTP_200_OK)
+            self.logout()
+
+
+class promocodeGenerateTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+
+    def test_can_generate_promocodes(self):
+        """
+        Verify generation streams its progress and creates unique codes with the shared attributes.
+        """
+
+        PromoCode.objects.create(code='SALE-AB', code_l='sale-ab', type='value')
+
+        options = {
+            'count': 250,
+            'prefix': 'SALE-',
+            'length': 4,
+            'alphabet': 'AB',
+            'type': 'value',
+            'value': '5.00',
+            'repeat': 1,
+        }
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode/generate', options, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            options['length'] = 16
+            response = self.client.post('/promocode/generate', options, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+            self.logout()
+
+        self.assertEqual({'created': 250, 'count': 250}, json.loads(lines[-1]))
+        generated = PromoCode.objects.filter(code__startswith='SALE-').exclude(code_l='sale-ab')
+        self.assertEqual(250, generated.count())
+        self.assertEqual(250, generated.filter(value=5, repeat=1, type='value').count())
+
+    def test_generate_skips_existing_codes(self):
+        """
+        Verify codes already taken are dropped, even when the alphabet makes collisions likely.
+        """
+
+        PromoCode.objects.create(code='X-AAAAAAAA', code_l='x-aaaaaaaa', type='value')
+
+        created = list(generate_codes(20, prefix='X-', length=8, alphabet='AB', chunk_size=7, type='value'))
+
+        self.assertEqual(20, created[-1])
+        self.assertEqual(21, PromoCode.objects.filter(code_l__startswith='x-').count())
+
+    def test_generate_no_digit_only_codes(self):
+        """
+        Verify no code is made of digits only, the lookups would take it for an id.
+        """
+
+        list(generate_codes(70, length=3, alphabet='12345678A', type='value'))
+
+        codes = list(PromoCode.objects.values_list('code', flat=True))
+        self.assertEqual(70, len(codes))
+        self.assertFalse([code for code in codes if code.isdigit()])
+
+        with self.assertRaises(ValueError):
+            list(generate_codes(1, prefix='12', alphabet='0123456789', type='value'))
+
+    def test_generate_gives_up(self):
+        """
+        Verify an IntegrityError that drawing again can't fix is raised after the retries instead of looping forever.
+        """
+
+        with self.assertRaises(IntegrityError):
+            list(generate_codes(3, prefix='NULL', length=4, type=None))
+
+        self.assertFalse(PromoCode.objects.filter(code_l__startswith='null').exists())
+
+    def test_generate_command(self):
+        out = StringIO()
+        call_command('generate_promo_codes', '30', '--prefix', 'CMD', '--type', 'percent', '--value', '0.1',
+                     stdout=out)
+
+        self.assertIn('30/30 codes created', out.getvalue())
+        self.assertEqual(30, PromoCode.objects.filter(code__startswith='CMD', type='percent').count())
+
+
+class promocodeCacheTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+    def test_retrieve_by_code_is_cached(self):
+        """
+        Verify a code lookup only queries the database once, then is answered from the cache.
+        """
+
+        PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent')
+        before = dict(cache.stats)
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='user')
+            response = self.client.get('/promocode/WEZAAAA', format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            with self.assertNumQueries(0):
+                self.assertEqual('wezaaaa', cache.get_by_code('Wezaaaa').code_l)
+
+            cache.local.clear()
+            with self.assertNumQueries(0):
+                self.assertEqual('wezaaaa', cache.get_by_code('wezaaaa').code_l)
+            self.logout()
+
+        for key in ('local_hits', 'shared_hits', 'misses'):
+            self.assertEqual(1, cache.stats[key] - before[key])
+
+    def test_update_invalidates_cache(self):
+        """
+        Verify an updated code is served fresh, and its old code isn't found anymore.
+        """
+
+        promocode = {
+            'code': 'Wezaaaa',
+            'type': 'percent',
+            'repeat': 1,
+        }
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode', promocode, format='json')
+            promocode_id = response.data['id']
+
+            response = self.client.get('/promocode/wezaaaa', format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            promocode['code'] = 'Renamed'
+            response = self.client.put('/promocode/%s' % promocode_id, promocode, format='json')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+            response = self.client.get('/promocode/wezaaaa', format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            response = self.client.get('/promocode/%s' % promocode_id, format='json')
+            self.assertEqual('Renamed', response.data['code'])
+
+            response = self.client.delete('/promocode/%s' % promocode_id, format='json')
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.logout()
+
+    def test_expired_codes_are_not_cached(self):
+        promoCode = PromoCode.objects.create(code='Old', code_l='old', type='value',
+                                             expires=now() - timedelta(days=1))
+
+        self.assertEqual(promoCode.id, cache.get_by_code('old').id)
+        self.assertIsNone(cache.shared().get(cache._key('code_l', 'old')))
+
+
+class promocodeQuotaTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        u.objects.create_user('user', 'me@snow.com', self.PW)
+        u.objects.create_user('user1', 'me1@snow.com', self.PW)
+
+    def test_cant_redeem_beyond_quota(self):
+        """
+        Verify the quota is shared by all users, while repeat still counts per user.
+        """
+
+        promocode = {
+            'code': 'Flash',
+            'type': 'percent',
+            'repeat': 1,
+            'quota': 2,
+        }
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode', promocode, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            promocode_id = response.data['id']
+
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.logout()
+
+            self.login(username='user')
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.logout()
+
+            self.login(username='user1')
+            response = self.client.put('/promocode/%s/redeem' % promocode_id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.logout()
+
+
+@override_settings(PROMO_BLOOM_FILTER=False)
+class promocodeLeaseTests(BasicTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        for i in range(3):
+            u.objects.create_user('user%d' % i, 'me%d@snow.com' % i, self.PW)
+
+    def tearDown(self):
+        holder.release_all()
+        super(promocodeLeaseTests, self).tearDown()
+
+    def test_lease_blocks(self):
+        """
+        Verify slots are handed out of leased blocks, and what's left is given back.
+        """
+
+        promoCode = PromoCode.objects.create(code='Flash', code_l='flash', type='value', quota=5, lease_size=3)
+
+        for i in range(3):
+            self.assertTrue(holder.take(promoCode))
+        self.assertEqual(3, PromoCode.objects.get(pk=promoCode.id).reserved)
+        self.assertEqual(1, PromoCodeLease.objects.count())
+
+        self.assertTrue(holder.take(promoCode))
+        self.assertTrue(holder.take(promoCode))
+        self.assertFalse(holder.take(promoCode))
+
+        promoCode = PromoCode.objects.get(pk=promoCode.id)
+        self.assertEqual((5, 5), (promoCode.used, promoCode.reserved))
+        self.assertEqual(0, PromoCodeLease.objects.count())
+
+    def test_cant_redeem_beyond_leased_quota(self):
+        """
+        Verify redeeming a leased Promo Code stops at the quota, and the exhausted lease is accounted as used.
+        """
+
+        promoCode = PromoCode.objects.create(code='Flash', code_l='flash', type='value', quota=2, lease_size=10,
+                                             repeat=1)
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='user0')
+            response = self.client.put('/promocode/%s/redeem' % promoCode.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.logout()
+
+            # The whole quota was leased at once, so the claim didn't touch the Promo Code row.
+            self.assertEqual(2, PromoCodeLease.objects.get().size)
+            self.assertEqual((0, 2), PromoCode.objects.values_list('used', 'reserved').get())
+
+            self.login(username='user1')
+            response = self.client.put('/promocode/%s/redeem' % promoCode.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.logout()
+
+            self.login(username='user2')
+            response = self.client.put('/promocode/%s/redeem' % promoCode.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.logout()
+
+        # The exhausted lease was given back when it couldn't be renewed.
+        self.assertEqual(0, PromoCodeLease.objects.count())
+        self.assertEqual((2, 2), PromoCode.objects.values_list('used', 'reserved').get())
+        self.assertEqual(2, ClaimedPromoCode.objects.count())
+
+    def test_reclaim_gives_back_forfeited_slots(self):
+        """
+        Verify a reclaimed lease doesn't shrink the quota, and its worker returning it late changes nothing.
+        """
+
+        promoCode = PromoCode.objects.create(code='Flash', code_l='flash', type='value', quota=10, lease_size=4)
+        admin = get_user_model().objects.get(username='admin')
+
+        self.assertTrue(holder.take(promoCode))
+        ClaimedPromoCode.objects.create(promoCode=promoCode, user=admin)
+        self.assertEqual(4, PromoCode.objects.get(pk=promoCode.id).reserved)
+
+        PromoCodeLease.objects.update(expires=now() - timedelta(minutes=5))
+        self.assertEqual(1, reclaim_leases())
+        self.assertEqual((1, 1), PromoCode.objects.values_list('used', 'reserved').get())
+
+        # The worker wasn't dead after all.
+        holder.release_all()
+        self.assertEqual((1, 1), PromoCode.objects.values_list('used', 'reserved').get())
+
+    def test_reclaim_keeps_live_leases(self):
+        promoCode = PromoCode.objects.create(code='Flash', code_l='flash', type='value', quota=10, lease_size=4)
+        PromoCodeLease.objects.create(promoCode=promoCode, size=4, worker='dead', expires=now() - timedelta(minutes=5))
+        PromoCodeLease.objects.create(promoCode=promoCode, size=3, worker='alive', expires=now() + timedelta(minutes=5))
+        PromoCode.objects.update(reserved=7)
+
+        self.assertEqual(1, reclaim_leases())
+        self.assertEqual((0, 3), PromoCode.objects.values_list('used', 'reserved').get())
+
+
+class promocodePaginationTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+
+    def walk(self, url):
+        """
+        Follow the next links from url, returning every page.
+        """
+
+        pages = []
+        while url:
+            response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data)
+            url = response.get('Link', '')[1:-len('>; rel="next"')] or None
+
+        return pages
+
+    def test_list_pages_through_ties(self):
+        """
+        Verify the cursor walks every Promo Code once, newest first, even when they share a creation time.
+        """
+
+        for i in range(5):
+            PromoCode.objects.create(code='Code%d' % i, code_l='code%d' % i, type='value')
+        PromoCode.objects.filter(code_l__in=['code1', 'code2', 'code3']).update(created=now())
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            pages = self.walk('/promocode?page_size=2')
+            self.logout()
+
+        self.assertEqual([2, 2, 1], [len(p) for p in pages])
+        ids = [row['id'] for page in pages for row in page]
+        expected = PromoCode.objects.order_by('-created', '-id').values_list('id', flat=True)
+        self.assertEqual(list(expected), ids)
+
+    def test_redeemed_pages(self):
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='value')
+        for i in range(3):
+            ClaimedPromoCode.objects.create(promoCode=promoCode, user=self.admin)
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            pages = self.walk('/promocode/%s/redeemed?page_size=2' % promoCode.id)
+            self.assertEqual([2, 1], [len(p) for p in pages])
+
+            pages = self.walk('/redeemed?page_size=1')
+            self.assertEqual([1, 1, 1], [len(p) for p in pages])
+
+            response = self.client.get('/redeemed?cursor=garbage', format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.logout()
+
+
+class promocodeExportTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+        self.promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='value')
+        for company in ('SWVL', 'UBER', 'SWVL'):
+            ClaimedPromoCode.objects.create(promoCode=self.promoCode, user=self.admin, company=company,
+                                            total_price='10.50')
+        ClaimedPromoCode.objects.create(promoCode=self.promoCode, user=self.user, company='SWVL')
+
+    def test_can_export_csv(self):
+        """
+        Verify the export streams every matching claim, a chunk at a time.
+        """
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_EXPORT_CHUNK_SIZE=1):
+            self.login(username='admin')
+            response = self.client.get('/redeemed/export?company=SWVL')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+            self.logout()
+
+        self.assertEqual('id,redeemed,promoCode,user,company,typeOfPayment,total_price,item,service', lines[0])
+        self.assertEqual(3, len(lines) - 1)
+        self.assertTrue(all(',SWVL,' in line for line in lines[1:]))
+
+    def test_can_export_ndjson_mine(self):
+        """
+        Verify users only export their own claims.
+        """
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='user')
+            response = self.client.get('/redeemed/export?output=ndjson&promoCode=%s' % self.promoCode.id)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+            response = self.client.get('/redeemed/export?output=xml')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.logout()
+
+        self.assertEqual(1, len(rows))
+        self.assertEqual(self.user.id, rows[0]['user'])
+        self.assertEqual('0.00', rows[0]['total_price'])
+
+
+class promocodeStatsTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+
+    def test_stats_follow_redeem_and_unredeem(self):
+        """
+        Verify the rollups are kept up to date by redeem, batch redeem and un-redeem, and match a rebuild.
+        """
+
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='value')
+        items = [
+            {'promoCode': promoCode.id, 'company': 'SWVL', 'total_price': '10.00'},
+            {'promoCode': promoCode.id, 'company': 'SWVL', 'total_price': '5.25'},
+            {'promoCode': promoCode.id, 'company': 'UBER', 'total_price': '1.00'},
+        ]
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.put('/promocode/%s/redeem' % promoCode.id, format='json')
+            redeemed_id = response.data['id']
+            self.client.post('/promocode/redeem-batch', items, format='json')
+
+            response = self.client.get('/redeemed/stats?group_by=company')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([
+                {'company': '', 'count': 1, 'total_price': '0.00'},
+                {'company': 'SWVL', 'count': 2, 'total_price': '15.25'},
+                {'company': 'UBER', 'count': 1, 'total_price': '1.00'},
+            ], response.data)
+
+            self.client.delete('/redeemed/%s' % redeemed_id)
+            response = self.client.get('/redeemed/stats?since=%s' % now().date())
+            self.assertEqual([{'count': 3, 'total_price': '16.25'}], response.data)
+
+            response = self.client.get('/redeemed/stats?group_by=user')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.logout()
+
+        rows = list(RedemptionRollup.objects.filter(count__gt=0).values_list('company', 'count', 'total_price')
+                    .order_by('company'))
+        out = StringIO()
+        call_command('backfill_redemption_rollups', stdout=out)
+        self.assertEqual('2 rollups written', out.getvalue().strip())
+        self.assertEqual(rows, list(RedemptionRollup.objects.values_list('company', 'count', 'total_price')
+                                    .order_by('company')))
+
+    def test_stats_follow_cascaded_deletes(self):
+        """
+        Verify the claims deleted with their Promo Code or their user are taken out of the rollups too.
+        """
+
+        user = get_user_model().objects.create_user('user', 'me@snow.com', self.PW)
+        kept = PromoCode.objects.create(code='Kept', code_l='kept', type='value')
+        dropped = PromoCode.objects.create(code='Dropped', code_l='dropped', type='value')
+        items = [
+            {'promoCode': kept.id, 'user': user.id, 'total_price': '3.00'},
+            {'promoCode': kept.id, 'user': self.admin.id, 'total_price': '4.00'},
+            {'promoCode': dropped.id, 'user': self.admin.id, 'total_price': '5.00'},
+        ]
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            self.client.post('/promocode/redeem-batch', items, format='json')
+            response = self.client.delete('/promocode/%s' % dropped.id)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.logout()
+        user.delete()
+
+        self.assertEqual({'count': 1, 'total_price': Decimal('4.00')},
+                         RedemptionRollup.objects.aggregate(count=Sum('count'), total_price=Sum('total_price')))
+        self.assertEqual(['claim.deleted'] * 2, list(ChangeEvent.objects.filter(kind='claim.deleted')
+                                                     .values_list('kind', flat=True)))
+
+        backfill()
+        self.assertEqual({'count': 1, 'total_price': Decimal('4.00')},
+                         RedemptionRollup.objects.aggregate(count=Sum('count'), total_price=Sum('total_price')))
+
+    def test_stats_follow_code_owner_delete(self):
+        """
+        Verify deleting the owner of a Promo Code takes the claims of other users on it, gone on delete cascade, out
+        of the rollups and into the change feed, claims first.
+        """
+
+        owner = get_user_model().objects.create_user('owner', 'owner@snow.com', self.PW)
+        owned = PromoCode.objects.create(code='Owned', code_l='owned', type='value', user=owner)
+        kept = PromoCode.objects.create(code='Kept', code_l='kept', type='value')
+        items = [
+            {'promoCode': owned.id, 'user': self.admin.id, 'total_price': '3.00'},
+            {'promoCode': kept.id, 'user': self.admin.id, 'total_price': '4.00'},
+        ]
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            self.client.post('/promocode/redeem-batch', items, format='json')
+            self.logout()
+        ChangeEvent.objects.all().delete()
+        owner.delete()
+
+        self.assertEqual({'count': 1, 'total_price': Decimal('4.00')},
+                         RedemptionRollup.objects.aggregate(count=Sum('count'), total_price=Sum('total_price')))
+        self.assertEqual(['claim.deleted', 'promocode.deleted'],
+                         list(ChangeEvent.objects.order_by('id').values_list('kind', flat=True)))
+        self.assertEqual(owned.id, ChangeEvent.objects.get(kind='promocode.deleted').object_id)
+
+class promocodeQueryTests(BasicTest):
+    """
+    Query budgets of the endpoints, and query plans of their hot predicates, so a lost index or an N+1 shows up here
+    rather than in production.
+    """
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+        self.promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='value', value=5)
+        for i in range(3):
+            ClaimedPromoCode.objects.create(promoCode=self.promoCode, user=self.admin)
+
+    def assertIndexed(self, queryset):
+        """
+        Verify the plan of the queryset doesn't scan a whole table.
+        """
+
+        if connection.vendor == 'mysql':
+            plan = queryset.explain(format='json')
+            self.assertNotIn('"access_type": "ALL"', plan)
+        elif connection.vendor == 'sqlite':
+            plan = queryset.explain()
+            for line in plan.splitlines():
+                self.assertIsNone(re.search(r'\bSCAN (TABLE )?\w+$', line), plan)
+
+    def test_query_budgets(self):
+        promocode_id = self.promoCode.id
+        budgets = [
+            ('get', '/promocode', 1),
+            ('get', '/promocode/%s' % promocode_id, 1),
+            # Served from the lookup cache warmed by the previous one.
+            ('get', '/promocode/WEZAAAA', 0),
+            ('get', '/promocode/%s/redeemed' % promocode_id, 2),
+            ('get', '/redeemed', 1),
+            ('get', '/redeemed/stats?group_by=day', 1),
+            # Loading the user, the usage pre-check, then savepoint, usage, promo code, claim, rollup, change event,
+            # release.
+            ('put', '/promocode/%s/redeem' % promocode_id, 9),
+        ]
+
+        ClaimedPromoCode.objects.all().delete()
+        # The claims of setUp weren't in the rollups, their delete took them out.
+        RedemptionRollup.objects.all().delete()
+        PromoCodeUsage.objects.create(promoCode=self.promoCode, user=self.admin)
+        RedemptionRollup.objects.create(day=localdate(), promoCode=self.promoCode, company='', service='',
+                                        typeOfPayment='Cash')
+
+        self.client.force_authenticate(self.admin)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            for method, url, budget in budgets:
+                with self.assertNumQueries(budget):
+                    response = getattr(self.client, method)(url, format='json')
+                    self.assertLess(response.status_code, 300, url)
+        self.client.force_authenticate(None)
+
+    def test_query_plans(self):
+        self.assertIndexed(PromoCode.objects.filter(code_l='wezaaaa'))
+        self.assertIndexed(PromoCode.objects.filter(bound=True, user=self.user.id).order_by('-created', '-id'))
+        self.assertIndexed(PromoCode.objects.filter(value__gte=1, value__lte=10))
+        self.assertIndexed(PromoCode.objects.filter(expires__lt=now()))
+        self.assertIndexed(prefix_search(PromoCode.objects.all(), 'WEZ'))
+        self.assertIndexed(PromoCodeTrigram.objects.filter(trigram__in=['wez', 'eza']))
+        self.assertIndexed(PromoCodeUsage.objects.filter(promoCode=self.promoCode.id, user=self.user.id))
+
+        for user in (self.admin, self.user):
+            self.assertIndexed(get_redeemed_queryset(user, self.promoCode.id).order_by('-redeemed', '-id'))
+        self.assertIndexed(get_redeemed_queryset(self.user).order_by('-redeemed', '-id'))
+        self.assertIndexed(ClaimedPromoCode.objects.filter(redeemed__gte=now()).order_by('redeemed', 'id'))
+
+        self.assertIndexed(RedemptionRollup.objects.filter(day__gte=localdate()))
+
+
+class promocodeSearchTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+
+        for code in ('SummerSale', 'SUMMER10', 'WinterSale', 'Sum'):
+            PromoCode.objects.create(code=code, code_l=code.lower(), type='value')
+
+    def search(self, query):
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.get('/promocode?%s' % query, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.logout()
+
+        return sorted(row['code'] for row in response.data)
+
+    def test_prefix_search(self):
+        self.assertEqual(['SUMMER10', 'Sum', 'SummerSale'], self.search('search=sum'))
+        self.assertEqual(['SUMMER10', 'SummerSale'], self.search('search=SUMMER'))
+        self.assertEqual([], self.search('search=sale'))
+
+    def test_substring_search(self):
+        """
+        Verify the trigram index finds codes by any part, and follows updates of the code.
+        """
+
+        self.assertEqual(['SummerSale', 'WinterSale'], self.search('search=sale&search_mode=substring'))
+
+        promoCode = PromoCode.objects.get(code_l='wintersale')
+        promoCode.code, promoCode.code_l = 'WinterDeal', 'winterdeal'
+        promoCode.save()
+        self.assertEqual(['SummerSale'], self.search('search=rsal&search_mode=substring'))
+
+        list(generate_codes(3, prefix='FLASHSALE', length=4, type='value'))
+        self.assertEqual(3, len(self.search('search=hsal&search_mode=substring')))
+
+    def test_substring_search_pages_every_match(self):
+        """
+        Verify the matches aren't cut before the pagination, every page of them can be walked.
+        """
+
+        for i in range(6):
+            PromoCode.objects.create(code='Deal%d' % i, code_l='deal%d' % i, type='value')
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_PAGE_SIZE=4):
+            self.login(username='admin')
+            response = self.client.get('/promocode?search=eal&search_mode=substring', format='json')
+            self.assertEqual(4, len(response.data))
+            response = self.client.get(response['Link'][1:-len('>; rel="next"')], format='json')
+            self.assertEqual(2, len(response.data))
+            self.logout()
+
+    def test_substring_search_candidates_capped(self):
+        """
+        Verify a term matching more codes than PROMO_SEARCH_MAX_CANDIDATES only checks the newest of them.
+        """
+
+        ids = [PromoCode.objects.create(code='Deal%d' % i, code_l='deal%d' % i, type='value').id for i in range(6)]
+
+        with self.settings(PROMO_SEARCH_MAX_CANDIDATES=4):
+            found = substring_search(PromoCode.objects.all(), 'eal').values_list('id', flat=True)
+            self.assertEqual(ids[2:], sorted(found))
+            self.assertEqual(['WinterSale'], self.search('search=ntersa&search_mode=substring'))
+
+    def test_unchanged_code_isnt_reindexed(self):
+        promoCode = PromoCode.objects.get(code_l='summersale')
+        promoCode.value = 3
+        with self.assertNumQueries(2):
+            # remember_code, then the update, no trigram writes.
+            promoCode.save()
+
+
+# The test transaction is only seen from its own connection, the one of the thread sensitive thread.
+@override_settings(PROMO_ASYNC_THREAD_SENSITIVE=True)
+class promocodeAsyncTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+        self.promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='value', repeat=1)
+
+    async def test_async_retrieve(self):
+        """
+        Verify the async lookup answers like the viewset, from the cache once warm.
+        """
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            response = await self.async_client.get('/async/promocode/WEZAAAA')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(self.promoCode.id, json.loads(response.content)['id'])
+
+            before = cache.stats['local_hits']
+            response = await self.async_client.get('/async/promocode/%s' % self.promoCode.id)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(before + 1, cache.stats['local_hits'])
+
+            response = await self.async_client.get('/async/promocode/nope')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_async_redeem(self):
+        """
+        Verify the async redeem enforces the same rules and shows up in the async redeemed list.
+        """
+
+        await sync_to_async(self.async_client.force_login)(self.user)
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            url = '/async/promocode/%s/redeem' % self.promoCode.id
+            response = await self.async_client.put(url)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = await self.async_client.put(url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+            response = await self.async_client.get('/async/promocode/%s/redeemed' % self.promoCode.id)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([self.user.id], [row['user'] for row in json.loads(response.content)])
+
+
+class promocodeIdempotencyTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+        self.promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='value', repeat=1)
+
+    def test_redeem_retry_is_replayed(self):
+        """
+        Verify a retried redeem gets the first response back instead of burning the single use.
+        """
+
+        other = PromoCode.objects.create(code='Other', code_l='other', type='value')
+
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            url = '/promocode/%s/redeem' % self.promoCode.id
+            first = self.client.put(url, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+            self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+
+            # The first replay reads the table (the cache is only filled on commit), the next ones the cache.
+            with self.assertNumQueries(1):
+                retry = self.client.put(url, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+            with self.assertNumQueries(0):
+                retry = self.client.put(url, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+            self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(first.data['id'], retry.data['id'])
+
+            response = self.client.put(url, format='json', HTTP_IDEMPOTENCY_KEY='order-2')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            response = self.client.put('/promocode/%s/redeem' % other.id, format='json',
+                                       HTTP_IDEMPOTENCY_KEY='order-1')
+            self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.client.force_authenticate(None)
+
+        self.assertEqual(1, ClaimedPromoCode.objects.count())
+        self.assertEqual(2, IdempotencyKey.objects.filter(user=self.user).count())
+
+    def test_in_flight_key_conflicts(self):
+        """
+        Verify a retry coming while the first request with the key still runs gets a 409 and claims nothing.
+        """
+
+        in_flight = idempotency._in_flight_key(self.user.id, 'order-1')
+        cache.shared().add(in_flight, True, 60)
+        self.addCleanup(cache.shared().delete, in_flight)
+
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            response = self.client.put('/promocode/%s/redeem' % self.promoCode.id, format='json',
+                                       HTTP_IDEMPOTENCY_KEY='order-1')
+        self.client.force_authenticate(None)
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(ClaimedPromoCode.objects.exists())
+
+    def test_other_integrity_error_raised(self):
+        """
+        Verify an IntegrityError of the handler isn't taken for the key conflict, and the key is free again after it.
+        """
+
+        def failing(request, pk):
+            raise IntegrityError("Not the key")
+
+        request = RequestFactory().put('/', HTTP_IDEMPOTENCY_KEY='order-1')
+        request.user = self.user
+        with self.assertRaises(IntegrityError):
+            idempotency.idempotent(request, self.promoCode.id, failing)
+
+        self.assertEqual(({'ok': True}, status.HTTP_200_OK),
+                         idempotency.idempotent(request, self.promoCode.id, lambda r, pk: ({'ok': True}, 200)))
+
+
+class promocodeBenchmarkTests(BasicTest):
+
+    def test_seed_and_run(self):
+        """
+        Verify the seeded dataset is consistent and every benchmark operation runs on it.
+        """
+
+        seed(40, chunk_size=16)
+        seed(40, chunk_size=16)
+
+        codes = PromoCode.objects.filter(code_l__startswith='bench')
+        self.assertEqual(40, codes.count())
+        self.assertEqual(20, ClaimedPromoCode.objects.filter(promoCode__in=codes).count())
+        self.assertEqual(20, PromoCodeUsage.objects.filter(promoCode__in=codes).count())
+        self.assertEqual(20, RedemptionRollup.objects.aggregate(count=Sum('count'))['count'])
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            # The threads can't see the data of the test transaction, so the contended redeems run in turn.
+            results = Benchmark(40, requests=3, concurrency=1).run()
+
+        self.assertEqual(8, len(results))
+        self.assertEqual(3, results['redeem_high_contention']['requests'])
+        self.assertEqual(1.0, results['retrieve_pk']['queries_per_request'])
+
+        generated = generation(30, chunk_size=20)
+        self.assertEqual(30, generated['codes'])
+        self.assertIn('million_per_minute', generated)
+        self.assertEqual(30, PromoCodeTrigram.objects.filter(trigram='gen').values('promoCode').distinct().count())
+
+        # The codes made by the create operation don't move the point seeding resumes from.
+        seed(45, chunk_size=16)
+        self.assertEqual(45, PromoCode.objects.filter(code_l__range=(code(0).lower(), code(44).lower())).count())
+
+
+class promocodeMetricsTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+    def test_concurrent_requests_keep_their_counters(self):
+        """
+        Verify two requests interleaved on one thread, as under ASGI, each record their own view and queries.
+        """
+
+        first, second = contextvars.copy_context(), contextvars.copy_context()
+        before = metrics.collect()
+        tokens = [first.run(metrics.begin), second.run(metrics.begin)]
+        first.run(metrics.set_view, 'tests-first')
+        second.run(metrics.set_view, 'tests-second')
+        first.run(lambda: list(PromoCode.objects.all()))
+        second.run(metrics.finish, tokens[1], 0.001, 200)
+        first.run(metrics.finish, tokens[0], 0.001, 200)
+
+        after = metrics.collect()
+        for view, queries in (('tests-first', 1), ('tests-second', 0)):
+            delta = after[view][metrics.QUERIES] - before.get(view, [0.0] * metrics.SIZE)[metrics.QUERIES]
+            self.assertEqual(queries, delta, view)
+
+    def test_async_middleware(self):
+        """
+        Verify the middleware stays a coroutine before an async handler, process_view included, and records the request.
+        """
+
+        async def get_response(request):
+            await middleware.process_view(request, None, (), {})
+            return HttpResponse(status=201)
+
+        middleware = metrics.MetricsMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertTrue(asyncio.iscoroutinefunction(middleware.process_view))
+
+        request = RequestFactory().get('/')
+        request.resolver_match = SimpleNamespace(url_name='tests-async', view_name='tests-async')
+        before = metrics.collect().get('tests-async', [0.0] * metrics.SIZE)
+        self.assertEqual(201, async_to_sync(middleware)(request).status_code)
+
+        after = metrics.collect()['tests-async']
+        self.assertEqual(1, after[metrics.STATUS + 1] - before[metrics.STATUS + 1])
+
+    def test_requests_are_recorded_per_view(self):
+        """
+        Verify requests, queries and cache lookups are counted under the url name of the view.
+        """
+
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent')
+        before = metrics.collect().get('promocode-detail', [0.0] * metrics.SIZE)
+
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            for i in range(2):
+                response = self.client.get('/promocode/%s' % promoCode.id, format='json')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get('/promocode/12345', format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            response = self.client.get('/metrics')
+        self.client.force_authenticate(None)
+
+        after = metrics.collect()['promocode-detail']
+        delta = [a - b for a, b in zip(after, before)]
+        self.assertEqual(3, delta[metrics.REQUESTS])
+        self.assertEqual(2, delta[metrics.STATUS + 1])
+        self.assertEqual(1, delta[metrics.STATUS + 3])
+        self.assertEqual(3, sum(delta[metrics.HISTOGRAM:]))
+        self.assertEqual(2, delta[metrics.QUERIES])
+        self.assertEqual(1, delta[metrics.CACHE_HITS])
+        self.assertEqual(2, delta[metrics.CACHE_MISSES])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('# TYPE promo_request_duration_seconds histogram', body)
+        self.assertIn('promo_requests_total{view="promocode-detail",code="4xx"} ', body)
+        self.assertIn('promo_request_duration_seconds_bucket{view="promocode-detail",le="+Inf"} ', body)
+
+    def test_workers_are_added_up(self):
+        """
+        Verify the counters flushed by the other workers are added to the ones of this process.
+        """
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROMO_METRICS_DIR=directory):
+            metrics.flush()
+            own = metrics.collect()
+            self.assertEqual(['metrics-%d.json' % os.getpid()], os.listdir(directory))
+
+            other = [1.0] * metrics.SIZE
+            with open(os.path.join(directory, 'metrics-1.json'), 'w') as f:
+                json.dump({'promocode-redeem': other, 'old-buckets': [1.0]}, f)
+
+            totals = metrics.collect()
+
+        self.assertNotIn('old-buckets', totals)
+        expected = [a + b for a, b in zip(own.get('promocode-redeem', [0.0] * metrics.SIZE), other)]
+        self.assertEqual(expected, totals['promocode-redeem'])
+
+
+class promocodeValuesTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+    def test_same_bytes_as_serializers(self):
+        """
+        Verify the values() fast path renders exactly like the model serializers, in any timezone.
+        """
+
+        PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent', value='0.125')
+        promoCode = PromoCode.objects.create(code='يا هلا', code_l='يا هلا', type='value', value=12, bound=True,
+                                             user=self.user, repeat=3, expires=now() + timedelta(days=3))
+        ClaimedPromoCode.objects.create(promoCode=promoCode, user=self.user, total_price='99.999', company='Co')
+        ClaimedPromoCode.objects.create(promoCode=promoCode, user=self.admin, typeOfPayment='Visa')
+
+        renderer = JSONRenderer()
+        for zone in ('UTC', 'Africa/Cairo'):
+            with timezone.override(zone):
+                for serializer_class, queryset in ((PromoCodeSerializer, PromoCode.objects.order_by('id')),
+                                                   (ClaimedPromoCodeSerializer, ClaimedPromoCode.objects.order_by('id'))):
+                    fast = ValuesSerializer(serializer_class)
+                    self.assertEqual(renderer.render(serializer_class(queryset, many=True).data),
+                                     renderer.render(fast.serialize(fast.values(queryset))))
+
+    def test_list_and_redeemed(self):
+        """
+        Verify the listings go through the fast path and still paginate.
+        """
+
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent')
+        for i in range(3):
+            ClaimedPromoCode.objects.create(promoCode=promoCode, user=self.user)
+
+        self.client.force_authenticate(self.admin)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            response = self.client.get('/promocode', format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(PromoCodeSerializer(promoCode).data, response.data[0])
+
+            response = self.client.get('/promocode/%s/redeemed?page_size=2' % promoCode.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(2, len(response.data))
+            next_url = re.match('<(.*)>', response['Link']).group(1)
+            response = self.client.get(next_url, format='json')
+            self.assertEqual(1, len(response.data))
+
+            response = self.client.get('/redeemed?user=%s' % self.user.id, format='json')
+            self.assertEqual(3, len(response.data))
+            self.assertEqual(ClaimedPromoCodeSerializer(ClaimedPromoCode.objects.order_by('-id').first()).data,
+                             response.data[0])
+        self.client.force_authenticate(None)
+
+
+class promocodeArchiveTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+    def create_claimed(self, code, expires, claims):
+        promoCode = PromoCode.objects.create(code=code, code_l=code.lower(), type='value', expires=expires)
+        for i in range(claims):
+            ClaimedPromoCode.objects.create(promoCode=promoCode, user=self.user, total_price=10)
+        claim_usage(promoCode, self.user)
+
+        return promoCode
+
+    def test_archive_expired(self):
+        """
+        Verify codes expired long enough move to the archive with their claims, in batches, and the rollups stay.
+        """
+
+        old = [self.create_claimed('Old%d' % i, now() - timedelta(days=100), 2) for i in range(3)]
+        self.create_claimed('Recent', now() - timedelta(days=1), 1)
+        self.create_claimed('Forever', None, 1)
+        backfill()
+        before = stats(['promoCode'])
+
+        out = StringIO()
+        call_command('archive_expired_promo_codes', '--days', '30', '--batch-size', '6', '--pause', '0', stdout=out)
+        self.assertEqual('3 codes and 6 claims archived', out.getvalue().strip())
+
+        self.assertEqual(['forever', 'recent'], sorted(PromoCode.objects.values_list('code_l', flat=True)))
+        self.assertEqual(2, ClaimedPromoCode.objects.count())
+        self.assertEqual(2, PromoCodeUsage.objects.count())
+        self.assertEqual(sorted(p.id for p in old), sorted(ArchivedPromoCode.objects.values_list('id', flat=True)))
+        self.assertEqual(6, ArchivedClaimedPromoCode.objects.filter(promoCode__in=[p.id for p in old]).count())
+        self.assertEqual(before, stats(['promoCode']))
+
+        backfill()
+        self.assertEqual(before, stats(['promoCode']))
+
+    def test_redeemed_reads_through_archive(self):
+        """
+        Verify the redeemed listings show the archived claims with ?archived=true only.
+        """
+
+        old = self.create_claimed('Old', now() - timedelta(days=100), 3)
+        self.create_claimed('Forever', None, 2)
+
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            history = self.client.get('/promocode/%s/redeemed' % old.id, format='json').data
+            list(archive_expired(days=30))
+
+            response = self.client.get('/promocode/%s/redeemed' % old.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get('/promocode/%s/redeemed?archived=true' % old.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(history, response.data)
+
+            response = self.client.get('/redeemed', format='json')
+            self.assertEqual(2, len(response.data))
+
+            # Pages run across both tables.
+            ids = []
+            url = '/redeemed?archived=true&page_size=2'
+            while url:
+                response = self.client.get(url, format='json')
+                ids.extend(claim['id'] for claim in response.data)
+                url = re.match('<(.*)>', response['Link']).group(1) if response.has_header('Link') else None
+        self.client.force_authenticate(None)
+
+        self.assertEqual(sorted(list(ClaimedPromoCode.objects.values_list('id', flat=True)) +
+                                list(ArchivedClaimedPromoCode.objects.values_list('id', flat=True)), reverse=True), ids)
+
+
+class promocodePartitionTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+
+    def test_partition_definitions(self):
+        """
+        Verify the monthly partitions run over the year end and end with pmax.
+        """
+
+        self.assertEqual("PARTITION p202011 VALUES LESS THAN ('2020-12-01'), "
+                         "PARTITION p202012 VALUES LESS THAN ('2021-01-01'), "
+                         "PARTITION p202101 VALUES LESS THAN ('2021-02-01'), "
+                         "PARTITION pmax VALUES LESS THAN (MAXVALUE)",
+                         partitions.partition_definitions(date(2020, 11, 1), date(2021, 1, 1)))
+        self.assertEqual(date(2019, 12, 1), partitions.add_months(date(2020, 2, 1), -2))
+        self.assertEqual(date(2020, 8, 1), partitions.partition_month('p202008'))
+        self.assertIsNone(partitions.partition_month('pmax'))
+
+        with self.assertRaises(CommandError):
+            call_command('manage_claim_partitions')
+
+    def test_drop_keeps_archive_window(self):
+        """
+        Verify the partitions holding claims younger than the archive window aren't dropped.
+        """
+
+        with self.settings(PROMO_ARCHIVE_AFTER_DAYS=90):
+            with self.assertRaises(ValueError):
+                partitions.drop_partitions(partitions.add_months(partitions.month_of(now()), -2))
+
+    def test_redeemed_window(self):
+        """
+        Verify the redeemed listings only return the claims of the since/until window.
+        """
+
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent')
+        for month in (1, 2, 3):
+            claim = ClaimedPromoCode.objects.create(promoCode=promoCode, user=self.user)
+            ClaimedPromoCode.objects.filter(pk=claim.pk).update(
+                redeemed=datetime(2020, month, 15, tzinfo=timezone.utc))
+
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            for url in ('/promocode/%s/redeemed' % promoCode.id, '/redeemed'):
+                response = self.client.get(url + '?since=2020-02-01T00:00:00Z&until=2020-03-01T00:00:00Z')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(['2020-02-15T00:00:00Z'], [claim['redeemed'] for claim in response.data])
+
+                response = self.client.get(url + '?since=2020-02-01T00:00:00Z')
+                self.assertEqual(2, len(response.data))
+
+                response = self.client.get(url + '?since=february')
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(None)
+
+
+@override_settings(PROMO_BLOOM_FILTER=False)
+class promocodeReplicaTests(BasicTestMixin, APITransactionTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # A second SQLite database standing in for a replica which didn't catch up with anything yet.
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults('replica')
+        connections.prepare_test_settings('replica')
+        call_command('migrate', database='replica', verbosity=0)
+        cls.databases = {'default', 'replica'}
+        super(promocodeReplicaTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(promocodeReplicaTests, cls).tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'john@snow.com', self.PW)
+        self.client.force_authenticate(self.admin)
+
+    def tearDown(self):
+        self.client.force_authenticate(None)
+        super(promocodeReplicaTests, self).tearDown()
+
+    def codes(self):
+        response = self.client.get('/promocode', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return [promoCode['code'] for promoCode in response.data]
+
+    def test_reads_go_to_replica(self):
+        """
+        Verify the listings read the replica, while the redeem validation and the writes use the primary.
+        """
+
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent')
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_READ_REPLICAS=['replica']):
+            self.assertEqual([], self.codes())
+
+            response = self.client.put('/promocode/%s/redeem' % promoCode.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(1, ClaimedPromoCode.objects.count())
+            self.assertEqual(0, ClaimedPromoCode.objects.using('replica').count())
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.assertEqual(['Wezaaaa'], self.codes())
+
+    def test_writer_is_pinned_to_primary(self):
+        """
+        Verify a client reads its own writes for a while after writing, and the replica again afterwards.
+        """
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_READ_REPLICAS=['replica']):
+            response = self.client.post('/promocode', {'code': 'Wezaaaa', 'type': 'percent'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(5, response.cookies[replicas.COOKIE]['max-age'])
+            self.assertEqual(['Wezaaaa'], self.codes())
+
+            # The cookie expired.
+            del self.client.cookies[replicas.COOKIE]
+            self.assertEqual([], self.codes())
+
+            # A client without cookies pins itself with the header.
+            response = self.client.get('/promocode', format='json', HTTP_X_PROMO_PRIMARY='1')
+            self.assertEqual(['Wezaaaa'], [promoCode['code'] for promoCode in response.data])
+
+    def test_asgi_chain_stays_async(self):
+        """
+        Verify the middlewares don't make Django run the whole ASGI chain in the thread sensitive executor.
+        """
+
+        self.assertNotIsInstance(ASGIHandler()._middleware_chain, SyncToAsync)
+
+    def test_export_streams_from_replica(self):
+        """
+        Verify the body of the export, streamed after the middleware returned, still reads the replica.
+        """
+
+        promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='percent')
+        ClaimedPromoCode.objects.create(promoCode=promoCode, user=self.admin)
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_READ_REPLICAS=['replica']):
+            response = self.client.get('/redeemed/export?output=ndjson')
+            self.assertEqual(b'', b''.join(response.streaming_content))
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            response = self.client.get('/redeemed/export?output=ndjson')
+            self.assertEqual(1, len(b''.join(response.streaming_content).splitlines()))
+
+    def test_state_is_per_context(self):
+        """
+        Verify the routing of a request doesn't leak into another one served by the same thread, as under ASGI.
+        """
+
+        def serve():
+            replicas._state.set(replicas._State(replica=True))
+            return replicas.ReplicaRouter().db_for_read(PromoCode)
+
+        with self.settings(PROMO_READ_REPLICAS=['replica']):
+            self.assertEqual('replica', contextvars.copy_context().run(serve))
+            self.assertEqual('default', replicas.ReplicaRouter().db_for_read(PromoCode))
+
+
+class promocodeLoggingTests(BasicTest):
+
+    def logger(self, handler):
+        logger = logging.getLogger('promo_codes.tests.logging')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        return logger
+
+    def test_background_json_file(self):
+        """
+        Verify the records are written by the background thread, as JSON with their extra fields.
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'promo.log')
+            handler = logs.BackgroundFileHandler(filename, batch_size=2)
+            handler.setFormatter(logs.JsonFormatter())
+            logger = self.logger(handler)
+
+            for i in range(5):
+                logger.info("Redeemed %s", i, extra={'promoCode': i})
+            try:
+                raise ValueError("Boom")
+            except ValueError:
+                logger.exception("Failed")
+            handler.close()
+
+            with open(filename) as f:
+                lines = [json.loads(line) for line in f]
+
+        self.assertEqual(["Redeemed %d" % i for i in range(5)] + ["Failed"], [line['message'] for line in lines])
+        self.assertEqual(list(range(5)), [line['promoCode'] for line in lines[:5]])
+        self.assertEqual('promo_codes.tests.logging', lines[0]['logger'])
+        self.assertIn('ValueError: Boom', lines[5]['exception'])
+
+    def test_full_queue_drops(self):
+        """
+        Verify records are dropped and counted instead of blocking while the writer is stuck, and the loss is logged.
+        """
+
+        writing = threading.Event()
+        release = threading.Event()
+
+        class SlowFormatter(logging.Formatter):
+            def format(self, record):
+                writing.set()
+                release.wait(5)
+                return super(SlowFormatter, self).format(record)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'promo.log')
+            handler = logs.BackgroundFileHandler(filename, maxsize=2)
+            handler.setFormatter(SlowFormatter())
+            logger = self.logger(handler)
+
+            logger.info("first")
+            writing.wait(5)
+            for i in range(5):
+                logger.info("more %s", i)
+            self.assertEqual(3, handler.dropped)
+
+            release.set()
+            handler.close()
+
+            with open(filename) as f:
+                lines = f.read().splitlines()
+
+        # The loss is noted after the batch the writer was stuck on.
+        self.assertEqual(["first", "3 log records dropped, the queue was full", "more 0", "more 1"], lines)
+
+    def test_record_left_intact(self):
+        """
+        Verify the other handlers still get the arguments and the traceback of the records queued.
+        """
+
+        seen = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                seen.append((record.args, record.exc_info))
+
+        with tempfile.TemporaryDirectory() as directory:
+            handler = logs.BackgroundFileHandler(os.path.join(directory, 'promo.log'))
+            logger = self.logger(handler)
+            logger.addHandler(Handler())
+            self.addCleanup(logger.removeHandler, logger.handlers[-1])
+
+            try:
+                raise ValueError("Boom")
+            except ValueError:
+                logger.exception("Failed %s", 1)
+            handler.close()
+
+        self.assertEqual((1,), seen[0][0])
+        self.assertIs(ValueError, seen[0][1][0])
+
+    def test_failed_write(self):
+        """
+        Verify a batch that can't be written is counted as lost and the writer carries on.
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'promo.log')
+            handler = logs.BackgroundFileHandler(filename, batch_size=1, encoding='ascii')
+            logger = self.logger(handler)
+
+            logger.info("café")
+            # Let the writer fail on the first batch before queuing the next one.
+            for _ in range(100):
+                if handler.lost:
+                    break
+                sleep(0.01)
+            logger.info("after")
+            handler.close()
+
+            with open(filename) as f:
+                lines = f.read().splitlines()
+
+        self.assertEqual(1, handler.lost)
+        self.assertEqual(["after", "1 log records lost, their write failed"], lines)
+
+    def test_sampling(self):
+        """
+        Verify the sampled loggers and their children lose their low level records, but never the warnings.
+        """
+
+        sample = logs.SamplingFilter({'django.db.backends': 0, 'django.db.backends.schema': 1})
+
+        def keep(name, level=logging.DEBUG):
+            return sample.filter(logging.LogRecord(name, level, __file__, 0, "SELECT 1", None, None))
+
+        self.assertFalse(keep('django.db.backends'))
+        self.assertFalse(keep('django.db.backends.mysql'))
+        self.assertTrue(keep('django.db.backends.schema'))
+        self.assertTrue(keep('django.db.backendsX'))
+        self.assertTrue(keep('django.db.backends', logging.WARNING))
+        self.assertTrue(keep('django.request'))
+
+
+@override_settings(PROMO_BLOOM_FILTER=True)
+class promocodeBloomTests(BasicTest):
+
+    def setUp(self):
+        get_user_model().objects.create_user('user', 'me@snow.com', self.PW)
+        PromoCode.objects.create(code='Known', code_l='known', type='percent')
+        bloom.code_filter = bloom.CodeFilter()
+        bloom.code_filter.build()
+
+    def tearDown(self):
+        super(promocodeBloomTests, self).tearDown()
+        bloom.code_filter = bloom.CodeFilter()
+
+    def test_unknown_code_is_rejected_without_query(self):
+        with self.assertNumQueries(0):
+            self.assertIsNone(cache.get_by_code('Unknown'))
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='user')
+            response = self.client.get('/promocode/UNKNOWN', format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get('/promocode/KNOWN', format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.logout()
+
+        self.assertEqual(2, bloom.code_filter.stats['rejected'])
+
+    def test_new_codes_are_found(self):
+        """
+        Verify a code created after the build is found by this process, and by another one through the version.
+        """
+
+        other = bloom.CodeFilter()
+        other.build()
+        PromoCode.objects.create(code='Fresh', code_l='fresh', type='percent')
+        generate_codes(3, prefix='BLOOM')
+
+        self.assertEqual('fresh', cache.get_by_code('Fresh').code_l)
+        self.assertTrue(other.might_contain('fresh'))
+        for code_l in PromoCode.objects.filter(code_l__startswith='bloom').values_list('code_l', flat=True):
+            self.assertTrue(other.might_contain(code_l))
+        self.assertEqual(1, other.stats['syncs'])
+
+        # Nothing changed since, a miss doesn't sync again.
+        self.assertFalse(other.might_contain('unknown'))
+        self.assertEqual(1, other.stats['syncs'])
+
+    def test_off_with_process_local_cache(self):
+        """
+        Verify the filter stays off by default when the cache can't tell the other processes about new codes.
+        """
+
+        with self.settings(PROMO_BLOOM_FILTER=None):
+            self.assertFalse(bloom.code_filter.enabled())
+            self.assertTrue(bloom.code_filter.might_contain('unknown'))
+
+    def test_false_positive_rate(self):
+        bloom_filter = bloom.BloomFilter(10000, 0.01)
+        for i in range(10000):
+            bloom_filter.add('code%d' % i)
+
+        false_positives = sum('other%d' % i in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(0.01, bloom_filter.fp_rate(), delta=0.002)
+
+        report = cache.cache_stats()['bloom']
+        self.assertTrue(report['ready'])
+        self.assertEqual(1, report['codes'])
+        self.assertIn('memory_bytes', report)
+
+
+class promocodeThrottleTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+        self.other = u.objects.create_user('other', 'other@snow.com', self.PW)
+        self.promoCode = PromoCode.objects.create(code='Wezaaaa', code_l='wezaaaa', type='value', repeat=10)
+        self.second = PromoCode.objects.create(code='Second', code_l='second', type='value', repeat=10)
+
+    def test_bucket_refills(self):
+        bucket = throttling.Bucket('test', '2/min')
+
+        self.assertIsNone(bucket.take('ip:1', at=6000))
+        self.assertIsNone(bucket.take('ip:1', at=6010))
+        self.assertAlmostEqual(80, bucket.take('ip:1', at=6010), places=3)
+        self.assertAlmostEqual(80, bucket.peek('ip:1', at=6010), places=3)
+        self.assertIsNone(bucket.take('ip:2', at=6010))
+
+        # Half way through the next period, half of the tokens are back.
+        self.assertIsNone(bucket.take('ip:1', at=6090))
+        self.assertIsNotNone(bucket.take('ip:1', at=6090))
+        self.assertIsNone(bucket.take('ip:1', at=6200))
+
+    def test_probes_are_throttled_per_ip(self):
+        rates = {'probe': {'ip': '3/min'}}
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_THROTTLE_RATES=rates):
+            for i in range(3):
+                response = self.client.get('/promocode/WEZAAAA', format='json')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            with self.assertNumQueries(0):
+                response = self.client.get('/promocode/WEZAAAA', format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn('Retry-After', response)
+
+            response = self.client.get('/promocode/WEZAAAA', format='json', REMOTE_ADDR='10.0.0.2')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_misses_have_a_stricter_budget(self):
+        """
+        Verify the failed lookups spend the miss budget, after which even existing codes are refused.
+        """
+
+        rates = {'probe': {'ip': '100/min'}, 'miss': {'ip': '2/min'}}
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_THROTTLE_RATES=rates):
+            for code in ('nope', 'guess'):
+                response = self.client.get('/promocode/%s' % code, format='json')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            response = self.client.get('/promocode/WEZAAAA', format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_redeems_are_throttled_per_user(self):
+        rates = {'redeem': {'user': '1/min'}, 'miss': {'user': '1/min'}}
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_THROTTLE_RATES=rates):
+            self.login(username='user')
+            response = self.client.put('/promocode/%s/redeem' % self.promoCode.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.put('/promocode/%s/redeem' % self.second.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+            self.login(username='other')
+            response = self.client.put('/promocode/999999/redeem', format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.put('/promocode/%s/redeem' % self.second.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.logout()
+
+    @override_settings(PROMO_ASYNC_THREAD_SENSITIVE=True)
+    async def test_async_misses_are_throttled(self):
+        rates = {'probe': {'ip': '100/min'}, 'miss': {'ip': '1/min'}}
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_THROTTLE_RATES=rates):
+            response = await self.async_client.get('/async/promocode/nope')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = await self.async_client.get('/async/promocode/WEZAAAA')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn('Retry-After', response)
+
+
+class promocodeRedeemableTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+        other = u.objects.create_user('other', 'other@snow.com', self.PW)
+
+        self.open = PromoCode.objects.create(code='Open', code_l='open', type='value', repeat=0)
+        self.twice = PromoCode.objects.create(code='Twice', code_l='twice', type='value', repeat=2)
+        self.mine = PromoCode.objects.create(code='Mine', code_l='mine', type='percent', repeat=1, bound=True,
+                                             user=self.user)
+        PromoCode.objects.create(code='Theirs', code_l='theirs', type='value', bound=True, user=other)
+        PromoCode.objects.create(code='Expired', code_l='expired', type='value', expires=now() - timedelta(days=1))
+        PromoCode.objects.create(code='Gone', code_l='gone', type='value', quota=1, reserved=1)
+        PromoCodeUsage.objects.create(promoCode=self.twice, user=self.user, used=1)
+
+    def test_redeemable_in_one_query(self):
+        """
+        Verify the redeemable codes come with their remaining uses from one query, then from the cache until the
+        user redeems.
+        """
+
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            with self.assertNumQueries(1):
+                response = self.client.get('/promocode/redeemable', format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual({'mine': 1, 'twice': 1, 'open': None},
+                             {row['code_l']: row['remaining'] for row in response.data})
+
+            with self.assertNumQueries(0):
+                response = self.client.get('/promocode/redeemable', format='json')
+            self.assertEqual(3, len(response.data))
+
+            response = self.client.put('/promocode/%s/redeem' % self.mine.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.put('/promocode/%s/redeem' % self.twice.id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+            response = self.client.get('/promocode/redeemable', format='json')
+            self.assertEqual({'open': None}, {row['code_l']: row['remaining'] for row in response.data})
+
+    def test_redeemable_pages(self):
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            response = self.client.get('/promocode/redeemable?page_size=2', format='json')
+            self.assertEqual(['mine', 'twice'], [row['code_l'] for row in response.data])
+
+            response = self.client.get(re.search('<([^>]+)>', response['Link']).group(1), format='json')
+            self.assertEqual(['open'], [row['code_l'] for row in response.data])
+            self.assertFalse(response.has_header('Link'))
+
+    def test_redeemable_needs_a_user(self):
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            response = self.client.get('/promocode/redeemable', format='json')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class promocodeQuoteTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+        self.percent = PromoCode.objects.create(code='Tenth', code_l='tenth', type='percent', value='0.15')
+        self.value = PromoCode.objects.create(code='Fifty', code_l='fifty', type='value', value=50, repeat=1)
+        PromoCode.objects.create(code='Old', code_l='old', type='value', value=5, expires=now() - timedelta(days=1))
+
+    def test_quote(self):
+        """
+        Verify every item gets its discount, or why the Promo Code can't be used, in one query, and that nothing is
+        redeemed.
+        """
+
+        items = [
+            {'code': 'TENTH', 'amount': '99.99'},
+            {'promoCode': self.value.id, 'amount': '120'},
+            {'code': 'fifty', 'amount': '20.00'},
+            {'code': 'old', 'amount': '10'},
+            {'code': 'nope', 'amount': '10'},
+            {'amount': '10'},
+        ]
+
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            # The Promo Codes, then the usage of the user.
+            with self.assertNumQueries(2):
+                response = self.client.post('/promocode/quote', items, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            results = response.data
+            self.assertEqual(('quoted', '99.99', '15.00', '84.99'),
+                             tuple(results[0][k] for k in ('status', 'amount', 'discount', 'total')))
+            self.assertEqual(('50.00', '70.00'), (results[1]['discount'], results[1]['total']))
+            self.assertEqual(('20.00', '0.00'), (results[2]['discount'], results[2]['total']))
+            self.assertEqual(["Promo Code has expired."], results[3]['errors']['non_field_errors'])
+            self.assertEqual(["Promo Code not found."], results[4]['errors']['non_field_errors'])
+            self.assertEqual('rejected', results[5]['status'])
+            self.assertFalse(ClaimedPromoCode.objects.exists())
+
+            # Cached now, only the usage is read.
+            self.client.put('/promocode/%s/redeem' % self.value.id, format='json')
+            with self.assertNumQueries(1):
+                response = self.client.post('/promocode/quote', items[:2], format='json')
+            self.assertEqual('quoted', response.data[0]['status'])
+            self.assertEqual(["Promo Code has been used to its limit."], response.data[1]['errors']['non_field_errors'])
+
+    def test_quote_limits(self):
+        with self.settings(ROOT_URLCONF='promo_codes.urls', PROMO_QUOTE_MAX=2,
+                           PROMO_THROTTLE_RATES={'probe': {'ip': '100/min'}, 'miss': {'ip': '3/min'}}):
+            response = self.client.post('/promocode/quote', {'code': 'tenth'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            items = [{'code': 'a', 'amount': 1}, {'code': 'b', 'amount': 1}, {'code': 'c', 'amount': 1}]
+            response = self.client.post('/promocode/quote', items, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            # Guessing codes spends the miss budget like the lookups do.
+            response = self.client.post('/promocode/quote', items[:2], format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post('/promocode/quote', items[:2], format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post('/promocode/quote', items[:1], format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_quote_capped_by_miss_budget(self):
+        """
+        Verify a quote full of unknown codes looks up no more of them than the miss budget allows, and the next one is
+        refused.
+        """
+
+        items = [{'code': 'guess%d' % i, 'amount': 1} for i in range(15)]
+        with self.settings(ROOT_URLCONF='promo_codes.urls',
+                           PROMO_THROTTLE_RATES={'probe': {'ip': '100/min'}, 'miss': {'ip': '10/min'}}):
+            response = self.client.post('/promocode/quote', items, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            errors = [result['errors']['non_field_errors'][0] for result in response.data]
+            self.assertEqual([quotes.NOT_FOUND] * 10 + [quotes.THROTTLED] * 5, errors)
+
+            response = self.client.post('/promocode/quote', items, format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+
+class promocodeBestTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.user = u.objects.create_user('user', 'me@snow.com', self.PW)
+        self.other = u.objects.create_user('other', 'other@snow.com', self.PW)
+
+        self.half = PromoCode.objects.create(code='Half', code_l='half', type='percent', value='0.5', repeat=1)
+        self.forty = PromoCode.objects.create(code='Forty', code_l='forty', type='value', value=40)
+        self.ten = PromoCode.objects.create(code='Ten', code_l='ten', type='value', value=10)
+        PromoCode.objects.create(code='Theirs', code_l='theirs', type='value', value=90, bound=True, user=self.other)
+        PromoCode.objects.create(code='Old', code_l='old', type='value', value=80, expires=now() - timedelta(days=1))
+
+    def test_best_code(self):
+        """
+        Verify the percent and value discounts are compared on the amount, among the codes the user can redeem.
+        """
+
+        self.assertEqual(self.half, best_code(self.user, Decimal('100')))
+        self.assertEqual(self.forty, best_code(self.user, Decimal('60')))
+        # Both take off the whole amount, the higher value wins.
+        self.assertEqual(self.forty, best_code(self.user, Decimal('5')))
+
+        mine = PromoCode.objects.create(code='Mine', code_l='mine', type='value', value=45, bound=True, user=self.user)
+        self.assertEqual(mine, best_code(self.user, Decimal('60')))
+        self.assertEqual('theirs', best_code(self.other, Decimal('60')).code_l)
+
+        PromoCodeUsage.objects.create(promoCode=self.half, user=self.user, used=1)
+        self.assertEqual(mine, best_code(self.user, Decimal('100')))
+
+    def test_best_code_skips_used_chunks(self):
+        for i in range(5):
+            code = PromoCode.objects.create(code='Big%d' % i, code_l='big%d' % i, type='value', value=100, repeat=1)
+            PromoCodeUsage.objects.create(promoCode=code, user=self.user, used=1)
+
+        self.assertEqual(self.forty, best_code(self.user, Decimal('60'), chunk_size=2))
+
+    def test_best_endpoint(self):
+        self.client.force_authenticate(self.user)
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            response = self.client.get('/promocode/best?total_price=120', format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.verify_built({'promoCode': self.half.id, 'amount': '120.00', 'discount': '60.00', 'total': '60.00'},
+                              response.data)
+
+            response = self.client.get('/promocode/best', format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            PromoCode.objects.all().delete()
+            response = self.client.get('/promocode/best?total_price=120', format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class promocodeChangeTests(BasicTest):
+
+    def setUp(self):
+        u = get_user_model()
+        self.admin = u.objects.create_superuser('admin', 'admin@paymob.com', self.PW)
+        self.user = u.objects.create_user('user', 'omar@paymob.com', self.PW)
+
+    def kinds(self):
+        return list(ChangeEvent.objects.order_by('id').values_list('kind', 'object_id'))
+
+    def test_writes_record_events(self):
+        """
+        Verify every write of a Promo Code or a claim appends its event, in order.
+        """
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode', {'code': 'Feed', 'type': 'value', 'value': 5}, format='json')
+            pk = response.data['id']
+            self.client.put('/promocode/%s' % pk, {'code': 'Feed', 'type': 'value', 'value': 7}, format='json')
+            first = self.client.put('/promocode/%s/redeem' % pk, format='json').data['id']
+            self.client.post('/promocode/redeem-batch', [{'promoCode': pk, 'user': self.user.id}], format='json')
+            self.client.delete('/redeemed/%s' % first)
+            second = ClaimedPromoCode.objects.get().id
+            self.client.delete('/promocode/%s' % pk)
+            self.logout()
+
+        self.assertEqual([('promocode.created', pk), ('promocode.updated', pk), ('claim.created', first),
+                          ('claim.created', second), ('claim.deleted', first), ('claim.deleted', second),
+                          ('promocode.deleted', pk)], self.kinds())
+        updated = ChangeEvent.objects.get(kind='promocode.updated')
+        self.assertEqual('7.00', updated.data['value'])
+        self.assertEqual(pk, ChangeEvent.objects.filter(kind='claim.deleted').last().data['promoCode'])
+
+    def test_batch_claims_have_ids(self):
+        """
+        Verify the claims of a batch carry their ids into the feed, even where bulk_create doesn't return them.
+        """
+
+        promoCode = PromoCode.objects.create(code='Many', code_l='many', type='value', value=5)
+        items = [{'promoCode': promoCode.id, 'user': self.user.id}] * 3 + [{'code': 'many', 'user': self.admin.id}]
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.post('/promocode/redeem-batch', items, format='json')
+            self.logout()
+
+        claims = [result['claim']['id'] for result in response.data]
+        self.assertEqual(sorted(ClaimedPromoCode.objects.values_list('id', flat=True)), sorted(claims))
+        self.assertEqual(claims, [pk for kind, pk in self.kinds()])
+        for event in ChangeEvent.objects.all():
+            claim = ClaimedPromoCode.objects.get(pk=event.object_id)
+            self.assertEqual((claim.id, claim.user_id), (event.data['id'], event.data['user']))
+
+    def test_rolled_back_write_records_nothing(self):
+        PromoCode.objects.create(code='Once', code_l='once', type='value', value=5, quota=1, reserved=1)
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.put('/promocode/%s/redeem' % PromoCode.objects.get().id, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.logout()
+
+        self.assertEqual([], self.kinds())
+
+    def test_generate_and_archive(self):
+        list(generate_codes(3, prefix='FEED', length=4, type='value', expires=now() - timedelta(days=100)))
+        self.assertEqual(['promocode.created'] * 3, [kind for kind, pk in self.kinds()])
+
+        list(archive_expired(days=90))
+        self.assertEqual(3, ChangeEvent.objects.filter(kind='promocode.archived').count())
+
+    def test_feed(self):
+        """
+        Verify the feed pages by position from ?after=, and the Link header carries the cursor even on an empty page.
+        """
+
+        promoCodes = [PromoCode.objects.create(code='C%d' % i, code_l='c%d' % i, type='value') for i in range(5)]
+        changes.record(changes.PROMOCODE_CREATED, promoCodes)
+        ids = list(ChangeEvent.objects.order_by('id').values_list('id', flat=True))
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='user')
+            response = self.client.get('/changes', format='json')
+            self.assertNotEqual(response.status_code, status.HTTP_200_OK)
+            self.logout()
+
+            self.login(username='admin')
+            response = self.client.get('/changes?limit=3', format='json')
+            self.assertEqual(ids[:3], [e['id'] for e in response.data])
+            self.assertEqual([1, 2, 3], [e['position'] for e in response.data])
+            self.assertEqual('c0', response.data[0]['data']['code_l'])
+            self.assertIn('after=3', response['Link'])
+
+            response = self.client.get('/changes?after=3&limit=3', format='json')
+            self.assertEqual(ids[3:], [e['id'] for e in response.data])
+
+            response = self.client.get('/changes?after=5', format='json')
+            self.assertEqual([], response.data)
+            self.assertIn('after=5', response['Link'])
+
+            response = self.client.get('/changes?after=nope', format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.logout()
+
+    def test_late_commit_isnt_skipped(self):
+        """
+        Verify an event committed after a later id was served still comes after the consumer's cursor.
+        """
+
+        promoCode = PromoCode.objects.create(code='Late', code_l='late', type='value')
+        ChangeEvent.objects.create(id=10, kind='promocode.created', object_id=promoCode.id, data={})
+        self.assertEqual(1, changes.publish())
+
+        # Its transaction took id 5 before the one of id 10, but only commits now.
+        ChangeEvent.objects.create(id=5, kind='promocode.updated', object_id=promoCode.id, data={})
+
+        with self.settings(ROOT_URLCONF='promo_codes.urls'):
+            self.login(username='admin')
+            response = self.client.get('/changes?after=1', format='json')
+            self.logout()
+
+        self.assertEqual([(5, 2)], [(e['id'], e['position']) for e in response.data])
+        self.assertEqual(0, changes.publish())
+
+    def test_purge(self):
+        changes.record(changes.PROMOCODE_CREATED, [PromoCode.objects.create(code='Old', code_l='old', type='value')])
+        ChangeEvent.objects.update(created=now() - timedelta(days=8))
+        changes.record(changes.PROMOCODE_CREATED, [PromoCode.objects.create(code='New', code_l='new', type='value')])
+
+        out = StringIO()
+        call_command('purge_change_events', stdout=out)
+        self.assertIn('1 events purged', out.getvalue())
+        self.assertEqual(['new'], [e.data['code_l'] for e in ChangeEvent.objects.all()])
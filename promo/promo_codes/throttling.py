@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import BaseThrottle
+
+# Token buckets in the shared cache for the code probes (retrieve, quote) and the redeems, per user and per client IP.
+# The lookups which found nothing also spend from a stricter miss budget, and once it is empty the probes and redeems
+# of that user or IP are refused before the lookup.  The buckets only use atomic increments of the cache, so all the
+# workers share them without any database write.
+
+DEFAULT_RATES = {
+    'probe': {'user': '120/min', 'ip': '300/min'},
+    'redeem': {'user': '30/min', 'ip': '120/min'},
+    'miss': {'user': '10/min', 'ip': '30/min'},
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def _cache():
+    return caches[getattr(settings, 'PROMO_THROTTLE_CACHE', getattr(settings, 'PROMO_CODE_CACHE', 'default'))]
+
+
+def parse_rate(rate):
+    """
+    '30/min' as (30, 60), like the DRF rates.
+    """
+
+    count, period = rate.split('/')
+
+    return int(count), PERIODS[period[0]]
+
+
+class Bucket(object):
+    """
+    Up to capacity tokens, refilled at capacity tokens per period.  The level of a real token bucket needs a
+    read-modify-write, so the tokens are counted per period instead, and the ones spent in the previous period come
+    back linearly during the current one: the level is capacity - current - previous * (1 - elapsed fraction).
+    """
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.capacity, self.period = parse_rate(rate)
+
+    def _keys(self, ident, at):
+        index, offset = divmod(at, self.period)
+        key = 'throttle:%s:%s:%%d' % (self.name, ident)
+
+        return key % index, key % (index - 1), offset / self.period
+
+    def _wait(self, current, previous, fraction):
+        """
+        Seconds until a token is back, with current tokens spent in this period.
+        """
+
+        room = self.capacity - current - 1
+        if room >= 0:
+            return max(1 - room / previous - fraction, 0) * self.period
+
+        # This period is spent too, the token comes back during the next one.
+        return (1 - fraction + max(1 - (self.capacity - 1) / current, 0)) * self.period
+
+    def _counts(self, ident, at):
+        current_key, previous_key, fraction = self._keys(ident, time.time() if at is None else at)
+        counts = _cache().get_many([current_key, previous_key])
+
+        return counts.get(current_key, 0), counts.get(previous_key, 0), fraction
+
+    def peek(self, ident, at=None):
+        """
+        None when there is a token left, else the seconds until there is one.
+        """
+
+        current, previous, fraction = self._counts(ident, at)
+
+        if current + 1 + previous * (1 - fraction) <= self.capacity:
+            return None
+
+        return self._wait(current, previous, fraction)
+
+    def remaining(self, ident, at=None):
+        """
+        How many tokens are left.
+        """
+
+        current, previous, fraction = self._counts(ident, at)
+
+        return max(int(self.capacity - current - previous * (1 - fraction)), 0)
+
+    def take(self, ident, at=None):
+        """
+        Take a token, returns None when there was one, else the seconds until there is one.  A refused request doesn't
+        spend any.
+        """
+
+        cache = _cache()
+        current_key, previous_key, fraction = self._keys(ident, time.time() if at is None else at)
+
+        cache.add(current_key, 0, self.period * 2)
+        try:
+            current = cache.incr(current_key)
+        except ValueError:
+            # Evicted since the add.
+            cache.add(current_key, 1, self.period * 2)
+            current = 1
+        previous = cache.get(previous_key, 0)
+
+        if current + previous * (1 - fraction) <= self.capacity:
+            return None
+
+        cache.decr(current_key)
+        return self._wait(current - 1, previous, fraction)
+
+    def spend(self, ident, tokens=1, at=None):
+        """
+        Take tokens whether there are enough or not.
+        """
+
+        cache = _cache()
+        current_key = self._keys(ident, time.time() if at is None else at)[0]
+
+        cache.add(current_key, 0, self.period * 2)
+        try:
+            cache.incr(current_key, tokens)
+        except ValueError:
+            cache.add(current_key, tokens, self.period * 2)
+
+
+def buckets(request, scope):
+    """
+    The (bucket, ident) pairs of the request in this scope, per user when authenticated and per client IP.
+    """
+
+    rates = getattr(settings, 'PROMO_THROTTLE_RATES', DEFAULT_RATES).get(scope) or {}
+
+    pairs = []
+    if rates.get('user') and request.user.is_authenticated:
+        pairs.append((Bucket(scope, rates['user']), 'user:%s' % request.user.id))
+    if rates.get('ip'):
+        pairs.append((Bucket(scope, rates['ip']), 'ip:%s' % BaseThrottle().get_ident(request)))
+
+    return pairs
+
+
+def refused(request, scope):
+    """
+    None when the request may go on, else the seconds to wait: it has no token left in scope, or its miss budget is
+    spent.
+    """
+
+    for bucket, ident in buckets(request, 'miss'):
+        wait = bucket.peek(ident)
+        if wait is not None:
+            return wait
+
+    for bucket, ident in buckets(request, scope):
+        wait = bucket.take(ident)
+        if wait is not None:
+            return wait
+
+    return None
+
+
+def check(request, scope):
+    """
+    Raise Throttled when the request is refused, for the views which don't go through PromoCodeThrottle.
+    """
+
+    wait = refused(request, scope)
+    if wait is not None:
+        raise Throttled(wait)
+
+
+def miss_budget(request):
+    """
+    How many more lookups of the request may find nothing, None when there is no miss budget.
+    """
+
+    left = [bucket.remaining(ident) for bucket, ident in buckets(request, 'miss')]
+
+    return min(left) if left else None
+
+
+def missed(request, count=1):
+    """
+    Spend from the miss budget of the request, count of its lookups found nothing.
+    """
+
+    for bucket, ident in buckets(request, 'miss'):
+        bucket.spend(ident, count)
+
+
+class PromoCodeThrottle(BaseThrottle):
+    """
+    Throttle the retrieve, quote, best and redeem actions of PromoCodeViewSet, the others aren't.
+    """
+
+    scopes = {
+        'retrieve': 'probe',
+        'quote': 'probe',
+        'best': 'probe',
+        'redeem': 'redeem',
+    }
+
+    def __init__(self):
+        self.seconds = None
+
+    def allow_request(self, request, view):
+        scope = self.scopes.get(getattr(view, 'action', None))
+        if scope is None:
+            return True
+
+        self.seconds = refused(request, scope)
+
+        return self.seconds is None
+
+    def wait(self):
+        return self.seconds
@@ -1,11 +1,18 @@
 from django.conf.urls import url, include
+from django.urls import path
 from rest_framework import routers
-from promo_codes import views
+from promo_codes import async_views, views
 
 router = routers.DefaultRouter(trailing_slash=False)
 router.register(r'promocode', views.PromoCodeViewSet, basename='promocode')
 router.register(r'redeemed', views.ClaimedPromoCodeViewSet, basename='redeemed')
+router.register(r'changes', views.ChangeEventViewSet, basename='changes')
 
 urlpatterns = [
     url(r'^', include(router.urls)),
+    path('metrics', views.prometheus_metrics, name='metrics'),
+    # Async native hot endpoints, for the ASGI application.
+    path('async/promocode/<str:pk>', async_views.retrieve, name='async-promocode-detail'),
+    path('async/promocode/<int:pk>/redeem', async_views.redeem, name='async-promocode-redeem'),
+    path('async/promocode/<int:pk>/redeemed', async_views.redeemed, name='async-promocode-redeemed'),
 ]
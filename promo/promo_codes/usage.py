@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+
+from promo_codes import redeemable
+from promo_codes.models import PromoCode, PromoCodeUsage
+
+
+def get_usage(promoCode, user):
+    """
+    Return how many times the user claimed the Promo Code, read from the counter row instead of counting claims.
+    """
+
+    used = PromoCodeUsage.objects.filter(promoCode=promoCode.id, user=user.id).values_list('used', flat=True).first()
+
+    return used or 0
+
+
+def claim_usage(promoCode, user, leased=False):
+    """
+    Take one usage slot of the Promo Code for the user.  Must be called inside the transaction inserting the claim.
+
+    The limit checks and the increments are conditional UPDATEs, so two concurrent redeems can't both pass them.
+    With leased, the slot of the quota was already taken from a lease and the Promo Code row is left alone.
+    Returns False if the Promo Code has been used to its limit.
+    """
+
+    qs = PromoCodeUsage.objects.filter(promoCode=promoCode.id, user=user.id)
+    if promoCode.repeat > 0:
+        qs = qs.filter(used__lt=promoCode.repeat)
+
+    if not qs.update(used=F('used') + 1):
+        # Either we're at the limit, or this is the first claim and there's no counter row yet.
+        try:
+            with transaction.atomic():
+                PromoCodeUsage.objects.create(promoCode_id=promoCode.id, user_id=user.id, used=1)
+        except IntegrityError:
+            # The row exists already (possibly inserted concurrently), so it was the limit after all, unless the
+            # concurrent insert left room.
+            if not qs.update(used=F('used') + 1):
+                return False
+
+    redeemable.changed(user.id)
+    if leased:
+        return True
+
+    qs = PromoCode.objects.filter(Q(quota=0) | Q(reserved__lt=F('quota')), pk=promoCode.id)
+
+    return qs.update(used=F('used') + 1, reserved=F('reserved') + 1) > 0
+
+
+def release_usage(promoCode_id, user_id):
+    """
+    Give back a usage slot when a claim is un-redeemed.
+    """
+
+    PromoCodeUsage.objects.filter(promoCode=promoCode_id, user=user_id, used__gt=0).update(used=F('used') - 1)
+    redeemable.changed(user_id)
+    # Not floored at zero: claims taken from a lease are only added to used when the lease is returned.
+    PromoCode.objects.filter(pk=promoCode_id).update(used=F('used') - 1, reserved=F('reserved') - 1)
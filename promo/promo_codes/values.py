@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import decimal
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+
+def _datetime_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    field_timezone = getattr(field, 'timezone', field.default_timezone())
+    if output_format is None or output_format.lower() != ISO_8601 or field_timezone is None:
+        return field.to_representation
+
+    def convert(value):
+        value = value.astimezone(field_timezone).isoformat()
+        if value.endswith('+00:00'):
+            return value[:-6] + 'Z'
+        return value
+
+    return convert
+
+
+def _decimal_converter(field):
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if not coerce_to_string or field.localize or field.decimal_places is None:
+        return field.to_representation
+
+    quantum = decimal.Decimal('.1') ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        return '{:f}'.format(value.quantize(quantum, rounding=rounding, context=context))
+
+    return convert
+
+
+# Fields which give the database value back as it is.
+_IDENTITY = (serializers.BooleanField, serializers.CharField, serializers.ChoiceField, serializers.IntegerField)
+
+
+def _converter(field):
+    """
+    The function the value of the field goes through, None when it's returned as it is.
+    """
+
+    if isinstance(field, serializers.DateTimeField):
+        return _datetime_converter(field)
+    if isinstance(field, serializers.DecimalField):
+        return _decimal_converter(field)
+    if isinstance(field, serializers.PrimaryKeyRelatedField) and field.pk_field is None:
+        return None
+    if type(field) in _IDENTITY:
+        return None
+
+    return field.to_representation
+
+
+class ValuesSerializer(object):
+    """
+    Read-only fast path of a ModelSerializer for listings.  Rows are fetched with values() and every field goes
+    through a converter compiled once from the serializer field, instead of building model instances and running
+    the serializer on each of them.  The result is the same list of dicts, so it renders to the same bytes.
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        model = serializer_class.Meta.model
+        fields = serializer_class().fields
+
+        self.names = []
+        self.columns = []
+        for name, field in fields.items():
+            if field.write_only:
+                continue
+            self.names.append(name)
+            try:
+                self.columns.append(model._meta.get_field(field.source).attname)
+            except FieldDoesNotExist:
+                # An annotation of the queryset.
+                self.columns.append(field.source)
+
+    def values(self, queryset):
+        """
+        The queryset of the rows to serialize.
+        """
+
+        return queryset.values(*self.columns)
+
+    def converters(self, context=None):
+        # Compiled per call: the datetime converters depend on the active timezone.
+        fields = self.serializer_class(context=context).fields
+
+        return [(name, column, _converter(fields[name])) for name, column in zip(self.names, self.columns)]
+
+    def serialize(self, rows, context=None):
+        converters = self.converters(context)
+
+        data = []
+        for row in rows:
+            item = {}
+            for name, column, convert in converters:
+                value = row[column]
+                item[name] = value if convert is None or value is None else convert(value)
+            data.append(item)
+
+        return data
@@ -1,18 +1,46 @@
 # -*- coding: utf-8 -*-
 
+import json
+
+from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
+from django.db import transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
 
 from django_filters.rest_framework import DjangoFilterBackend
 
-from rest_framework import filters, status, viewsets
+from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotAuthenticated, NotFound
 from rest_framework.response import Response
 
-from promo_codes.filters import PromoCodeFilter
-from promo_codes.models import PromoCode, ClaimedPromoCode
-from promo_codes.serializers import PromoCodeSerializer, ClaimedPromoCodeSerializer
+from promo_codes.batch import redeem_batch
+from promo_codes.best import best_code
+from promo_codes.cache import cache_stats, get_by_code, get_by_pk, shared
+from promo_codes.export import EXPORTS
+from promo_codes.filters import PromoCodeFilter, PromoCodeSearchFilter
+from promo_codes.generate import generate_codes
+from promo_codes import changes, metrics, quotes, replicas
+from promo_codes.idempotency import idempotent
+from promo_codes.models import PromoCode, ClaimedPromoCode, ArchivedPromoCode, ArchivedClaimedPromoCode
+from promo_codes.pagination import ChangeFeedPagination, ClaimedPromoCodePagination, PromoCodePagination
+from promo_codes.redeemable import page_key, page_timeout, redeemable_queryset
+from promo_codes.rollups import stats
+from promo_codes.serializers import PromoCodeSerializer, ClaimedPromoCodeSerializer, ClaimedPromoCodeBatchSerializer, \
+    BestPromoCodeSerializer, ChangeEventSerializer, ClaimedPromoCodeExportSerializer, PromoCodeGenerateSerializer, \
+    QuoteItemSerializer, RedeemablePromoCodeSerializer, RedemptionRollupSerializer, RedemptionStatsSerializer, \
+    RedeemedWindowSerializer
+from promo_codes.throttling import PromoCodeThrottle, miss_budget, missed
+from promo_codes.usage import release_usage
+from promo_codes.values import ValuesSerializer
+
+
+PROMOCODE_VALUES = ValuesSerializer(PromoCodeSerializer)
+REDEEMABLE_VALUES = ValuesSerializer(RedeemablePromoCodeSerializer)
+CLAIMED_VALUES = ValuesSerializer(ClaimedPromoCodeSerializer)
+CHANGE_VALUES = ValuesSerializer(ChangeEventSerializer)
 
 
 def group_required():
@@ -25,22 +53,121 @@ def group_required():
     return user_passes_test(in_groups)
 
 
-def get_redeemed_queryset(user, promoCode_id=None):
+def get_promocode_or_404(pk):
+    """
+    Return the Promo Code with this id through the lookup cache.
+    """
+
+    try:
+        promoCode = get_by_pk(pk)
+    except ValueError:
+        raise Http404
+
+    if promoCode is None:
+        raise Http404
+
+    return promoCode
+
+
+def redeem_promocode(request, pk):
+    """
+    Redeem the Promo Code for the user of the request, returns the response data and status.  With an Idempotency-Key
+    header, retries get the first response back.  A Promo Code which isn't found spends from the miss budget.
+    """
+
+    try:
+        return idempotent(request, pk, _redeem_promocode)
+    except Http404:
+        missed(request)
+        raise
+
+
+def _redeem_promocode(request, pk):
+
+    promoCode = get_promocode_or_404(pk)
+
+    data = {
+        'promoCode': promoCode.id,
+        'user': request.user.id,
+    }
+
+    serializer = ClaimedPromoCodeSerializer(data=data, context={'request': request})
+    if serializer.is_valid():
+        serializer.save()
+        return serializer.data, status.HTTP_201_CREATED
+
+    return serializer.errors, status.HTTP_400_BAD_REQUEST
+
+
+def list_redeemed(request, pk, view=None):
+    """
+    One page of the claims of the Promo Code the user of the request can see.
+    """
+
+    window = RedeemedWindowSerializer(data=request.query_params)
+    if not window.is_valid():
+        return Response(window.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    if include_archived(request) and not PromoCode.objects.filter(pk=pk).exists():
+        promoCode = get_object_or_404(ArchivedPromoCode.objects.all(), pk=pk)
+    else:
+        promoCode = get_object_or_404(PromoCode.objects.all(), pk=pk)
+
+    querysets = [CLAIMED_VALUES.values(get_redeemed_queryset(request.user, promoCode.id, model,
+                                                             **window.validated_data))
+                 for model in get_redeemed_models(request)]
+
+    paginator = ClaimedPromoCodePagination()
+    page = paginator.paginate_querysets(querysets, request, view=view)
+
+    return paginator.get_paginated_response(CLAIMED_VALUES.serialize(page, context={'request': request}))
+
+
+def include_archived(request):
+    """
+    Whether the request asks for the archived claims too, with ?archived=true.
+    """
+
+    return request.query_params.get('archived', '').lower() in ('1', 'true', 'yes')
+
+
+def get_redeemed_models(request):
+    if include_archived(request):
+        return ClaimedPromoCode, ArchivedClaimedPromoCode
+
+    return ClaimedPromoCode,
+
+
+def get_redeemed_queryset(user, promoCode_id=None, model=ClaimedPromoCode, since=None, until=None):
     """
-    Return a consistent list of the redeemed list.
+    Return a consistent list of the redeemed list, or of the archived one, redeemed from since and before until.  The
+    range on redeemed lets MySQL skip the partitions of the other months.
     """
 
     if promoCode_id is None:
-        qs_all = ClaimedPromoCode.objects.all()
-        qs_some = ClaimedPromoCode.objects.filter(user=user.id)
+        qs_all = model.objects.all()
+        qs_some = model.objects.filter(user=user.id)
     else:
-        qs_all = ClaimedPromoCode.objects.filter(promoCode_id=promoCode_id)
-        qs_some = ClaimedPromoCode.objects.filter(promoCode_id=promoCode_id, user=user.id)
+        qs_all = model.objects.filter(promoCode_id=promoCode_id)
+        qs_some = model.objects.filter(promoCode_id=promoCode_id, user=user.id)
 
-    if user.is_superuser:
-        return qs_all
+    qs = qs_all if user.is_superuser else qs_some
+    if since is not None:
+        qs = qs.filter(redeemed__gte=since)
+    if until is not None:
+        qs = qs.filter(redeemed__lt=until)
 
-    return qs_some
+    return qs
+
+
+def prometheus_metrics(request):
+    """
+    Endpoint for the per view request, latency, database and cache metrics of all workers, in Prometheus text
+    format.  It doesn't authenticate the scraper, so keep it private at the proxy.
+    """
+
+    return HttpResponse(metrics.render(metrics.collect()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 class PromoCodeViewSet(viewsets.ModelViewSet):
@@ -48,10 +175,11 @@ class PromoCodeViewSet(viewsets.ModelViewSet):
     API endpoint that lets you create, delete, retrieve Promo Codes.
     """
 
-    filter_backends = (filters.SearchFilter, DjangoFilterBackend)
+    filter_backends = (PromoCodeSearchFilter, DjangoFilterBackend)
     filter_class = PromoCodeFilter
-    search_fields = ('code', 'code_l')
+    pagination_class = PromoCodePagination
     serializer_class = PromoCodeSerializer
+    throttle_classes = (PromoCodeThrottle,)
 
     def get_queryset(self):
         """
@@ -65,6 +193,15 @@ class PromoCodeViewSet(viewsets.ModelViewSet):
 
         return qs_some
 
+    def list(self, request, *args, **kwargs):
+        """
+        List Promo Codes, serialized from values() rows.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(PROMOCODE_VALUES.values(queryset))
+
+        return self.get_paginated_response(PROMOCODE_VALUES.serialize(page, context=self.get_serializer_context()))
+
     @method_decorator(group_required())
     def create(self, request, **kwargs):
         """
@@ -84,6 +221,9 @@ class PromoCodeViewSet(viewsets.ModelViewSet):
         """
 
         promocode = get_object_or_404(PromoCode.objects.all(), pk=pk)
+
+        # The claims go with it, on delete cascade, the delete receivers take them out of the rollups and into the
+        # change feed.
         promocode.delete()
 
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -93,7 +233,7 @@ class PromoCodeViewSet(viewsets.ModelViewSet):
 
     def retrieve(self, request, pk=None, **kwargs):
         """
-        Anybody can retrieve a promo code
+        Anybody can retrieve a promo code, within the budgets of PromoCodeThrottle
         """
 
         value_is_int = False
@@ -105,9 +245,13 @@ class PromoCodeViewSet(viewsets.ModelViewSet):
             pass
 
         if value_is_int:
-            promocode = get_object_or_404(PromoCode.objects.all(), pk=pk)
+            promocode = get_by_pk(pk)
         else:
-            promocode = get_object_or_404(PromoCode.objects.all(), code_l=pk.lower())
+            promocode = get_by_code(pk)
+
+        if promocode is None:
+            missed(request)
+            raise Http404
 
         serializer = PromoCodeSerializer(promocode, context={'request': request})
 
@@ -131,15 +275,10 @@ class PromoCodeViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def redeemed(self, request, pk=None, **kwargs):
         """
-        Endpoint for getting a list of claimed promo codes.
+        Endpoint for getting a list of claimed promo codes, ?archived=true also reads the archive.
         """
 
-        promoCode = get_object_or_404(PromoCode.objects.all(), pk=pk)
-        qs = get_redeemed_queryset(self.request.user, promoCode.id)
-
-        serializer = ClaimedPromoCodeSerializer(qs, many=True, context={'request': request})
-
-        return Response(serializer.data)
+        return list_redeemed(request, pk, view=self)
 
     @action(detail=True, methods=['put'])
     def redeem(self, request, pk=None, **kwargs):
@@ -147,20 +286,160 @@ class PromoCodeViewSet(viewsets.ModelViewSet):
         Endpoint for redeeming.
         """
 
-        queryset = PromoCode.objects.all()
-        promoCode = get_object_or_404(queryset, pk=pk)
+        data, status_code = redeem_promocode(request, pk)
 
-        data = {
-            'promoCode': pk,
-            'user': self.request.user.id,
-        }
+        return Response(data, status=status_code)
 
-        serializer = ClaimedPromoCodeSerializer(data=data, context={'request': request})
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+    @action(detail=False, methods=['get'])
+    def redeemable(self, request, **kwargs):
+        """
+        Endpoint for the Promo Codes the user can still redeem, with how many more times.  The pages are cached until
+        the user redeems.
+        """
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not request.user.is_authenticated:
+            raise NotAuthenticated
+
+        paginator = PromoCodePagination()
+        paginator.request = request
+        key = page_key(request)
+
+        cached = shared().get(key)
+        if cached is None:
+            page = paginator.paginate_queryset(REDEEMABLE_VALUES.values(redeemable_queryset(request.user)), request)
+            cached = REDEEMABLE_VALUES.serialize(page, context={'request': request}), paginator.next_cursor
+            if page_timeout(page) > 0:
+                shared().set(key, cached, page_timeout(page))
+
+        data, paginator.next_cursor = cached
+
+        return paginator.get_paginated_response(data)
+
+    @action(detail=False, methods=['post'])
+    def quote(self, request, **kwargs):
+        """
+        Endpoint for the discounts of many (code, amount) items for the user, returns a result for each item.  Nothing
+        is redeemed.
+        """
+
+        if not isinstance(request.data, list):
+            return Response({'non_field_errors': ["Expected a list of items."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(request.data) > getattr(settings, 'PROMO_QUOTE_MAX', 1000):
+            return Response({'non_field_errors': ["Too many items in the quote."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Every lookup may miss, so a quote looks up no more items than the miss budget has left.
+        budget = miss_budget(request)
+
+        results = [None] * len(request.data)
+        items = []
+        indexes = []
+        for index, data in enumerate(request.data):
+            serializer = QuoteItemSerializer(data=data)
+            if not serializer.is_valid():
+                results[index] = {'status': 'rejected', 'errors': serializer.errors}
+            elif budget is not None and len(items) >= budget:
+                results[index] = {'status': 'rejected', 'errors': {'non_field_errors': [quotes.THROTTLED]}}
+            else:
+                items.append(serializer.validated_data)
+                indexes.append(index)
+
+        quoted, misses = quotes.quote(items, request.user)
+        if misses:
+            missed(request, misses)
+
+        for index, result in zip(indexes, quoted):
+            results[index] = result
+
+        return Response(results, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def best(self, request, **kwargs):
+        """
+        Endpoint for the Promo Code giving the user the biggest discount on ?total_price=, and that discount.
+        """
+
+        if not request.user.is_authenticated:
+            raise NotAuthenticated
+
+        serializer = BestPromoCodeSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        amount = serializer.validated_data['total_price']
+        promoCode = best_code(request.user, amount)
+        if promoCode is None:
+            raise NotFound("No Promo Code can be redeemed.")
+
+        return Response(quotes.quoted(promoCode, amount))
+
+    @method_decorator(group_required())
+    @action(detail=False, methods=['post'], url_path='redeem-batch')
+    def redeem_batch(self, request, **kwargs):
+        """
+        Endpoint for redeeming a batch of Promo Codes in one request, returns a result for each item.
+        """
+
+        if not isinstance(request.data, list):
+            return Response({'non_field_errors': ["Expected a list of items."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(request.data) > getattr(settings, 'PROMO_REDEEM_BATCH_MAX', 5000):
+            return Response({'non_field_errors': ["Too many items in the batch."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(request.data)
+        items = []
+        indexes = []
+        for index, data in enumerate(request.data):
+            serializer = ClaimedPromoCodeBatchSerializer(data=data)
+            if serializer.is_valid():
+                item = serializer.validated_data
+                item.setdefault('user', self.request.user.id)
+                items.append(item)
+                indexes.append(index)
+            else:
+                results[index] = {'status': 'rejected', 'errors': serializer.errors}
+
+        claims, errors = redeem_batch(items)
+
+        for index, claim, error in zip(indexes, claims, errors):
+            if claim is not None:
+                data = ClaimedPromoCodeSerializer(claim, context={'request': request}).data
+                results[index] = {'status': 'redeemed', 'claim': data}
+            else:
+                results[index] = {'status': 'rejected', 'errors': {'non_field_errors': [error]}}
+
+        return Response(results, status=status.HTTP_200_OK)
+
+    @method_decorator(group_required())
+    @action(detail=False, methods=['get'], url_path='cache-stats')
+    def cache_stats(self, request, **kwargs):
+        """
+        Endpoint for the hit/miss counters of the Promo Code lookup cache in this process.
+        """
+
+        return Response(cache_stats())
+
+    @method_decorator(group_required())
+    @action(detail=False, methods=['post'])
+    def generate(self, request, **kwargs):
+        """
+        Endpoint for generating many Promo Codes at once, streams the progress as one JSON line per chunk.
+        """
+
+        serializer = PromoCodeGenerateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        options = dict(serializer.validated_data)
+        count = options['count']
+
+        def progress():
+            for created in generate_codes(**options):
+                yield json.dumps({'created': created, 'count': count}) + '\n'
+
+        return StreamingHttpResponse(progress(), content_type='application/x-ndjson')
 
 
 class ClaimedPromoCodeViewSet(viewsets.ModelViewSet):
@@ -170,14 +449,75 @@ class ClaimedPromoCodeViewSet(viewsets.ModelViewSet):
 
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ('user',)
+    pagination_class = ClaimedPromoCodePagination
     serializer_class = ClaimedPromoCodeSerializer
 
     def get_queryset(self):
         return get_redeemed_queryset(self.request.user)
 
+    def list(self, request, *args, **kwargs):
+        """
+        List the claims the user can see, with the archived ones too when asked, serialized from values() rows.
+        """
+        window = RedeemedWindowSerializer(data=request.query_params)
+        if not window.is_valid():
+            return Response(window.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        querysets = [CLAIMED_VALUES.values(self.filter_queryset(
+            get_redeemed_queryset(request.user, model=model, **window.validated_data)))
+            for model in get_redeemed_models(request)]
+        page = self.paginator.paginate_querysets(querysets, request, view=self)
+
+        return self.get_paginated_response(CLAIMED_VALUES.serialize(page, context=self.get_serializer_context()))
+
     def create(self, request, **kwargs):
         return Response(status=status.HTTP_404_NOT_FOUND)
 
+    @action(detail=False, methods=['get'])
+    def export(self, request, **kwargs):
+        """
+        Endpoint for streaming the claimed promo codes as CSV or NDJSON (?output=), filtered by redeem time range,
+        company, service and promo code.
+        """
+
+        serializer = ClaimedPromoCodeExportSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = serializer.validated_data
+        qs = get_redeemed_queryset(self.request.user, filters.get('promoCode'), since=filters.get('since'),
+                                   until=filters.get('until'))
+        if 'company' in filters:
+            qs = qs.filter(company=filters['company'])
+        if 'service' in filters:
+            qs = qs.filter(service=filters['service'])
+
+        export, content_type = EXPORTS[filters['output']]
+        response = StreamingHttpResponse(replicas.stream(export(qs)), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="redeemed.%s"' % filters['output']
+
+        return response
+
+    @method_decorator(group_required())
+    @action(detail=False, methods=['get'])
+    def stats(self, request, **kwargs):
+        """
+        Endpoint for redemption counts and total price sums, read from the rollups only.
+        """
+
+        serializer = RedemptionStatsSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        query = dict(serializer.validated_data)
+        group_by = query.pop('group_by')
+        if 'since' in query:
+            query['day__gte'] = query.pop('since')
+        if 'until' in query:
+            query['day__lte'] = query.pop('until')
+
+        return Response(RedemptionRollupSerializer(stats(group_by, **query), many=True).data)
+
     @method_decorator(group_required())
     def destroy(self, request, pk=None, **kwargs):
         """
@@ -185,7 +525,10 @@ class ClaimedPromoCodeViewSet(viewsets.ModelViewSet):
         """
 
         redeemed = get_object_or_404(ClaimedPromoCode.objects.all(), pk=pk)
-        redeemed.delete()
+
+        with transaction.atomic():
+            redeemed.delete()
+            release_usage(redeemed.promoCode_id, redeemed.user_id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -197,3 +540,26 @@ class ClaimedPromoCodeViewSet(viewsets.ModelViewSet):
 
     def update(self, request, pk=None, **kwargs):
         return Response(status=status.HTTP_404_NOT_FOUND)
+
+
+class ChangeEventViewSet(viewsets.GenericViewSet):
+    """
+    API endpoint of the change feed of the Promo Codes and their claims, see promo_codes.changes.
+    """
+
+    pagination_class = ChangeFeedPagination
+    serializer_class = ChangeEventSerializer
+
+    def get_queryset(self):
+        return changes.published()
+
+    @method_decorator(group_required())
+    def list(self, request, *args, **kwargs):
+        """
+        The events after ?after=, in order.  The Link header carries the cursor to poll next.
+        """
+
+        changes.publish()
+        page = self.paginate_queryset(CHANGE_VALUES.values(self.get_queryset()))
+
+        return self.get_paginated_response(CHANGE_VALUES.serialize(page, context=self.get_serializer_context()))